@@ -42,6 +42,12 @@ ARGS.add_argument(
 ARGS.add_argument(
     '--lenient', action='store_false', dest='strict',
     default=False, help='Lenient host matching')  # 忽略掉url中的www.
+ARGS.add_argument(
+    '--state-dir', action='store', metavar='DIR', dest='state_dir',
+    help='Keep the frontier in DIR, and resume the crawl there if any')
+ARGS.add_argument(
+    '--checkpoint', action='store', type=float, metavar='SECS',
+    default=10.0, help='Seconds between checkpoints of the frontier')
 ARGS.add_argument(
     '-v', '--verbose', action='count', dest='level',
     default=2, help='Verbose logging (repeat for more verbose)')
@@ -65,7 +71,7 @@ def main():
     Parse arguments, set up event loop, run crawler, print report.
     """
     args = ARGS.parse_args()
-    if not args.roots:
+    if not args.roots and not args.state_dir:
         print('Use --help for command line help')
         return
 
@@ -91,6 +97,8 @@ def main():
                                max_redirect=args.max_redirect,
                                max_tries=args.max_tries,
                                max_tasks=args.max_tasks,
+                               state_dir=args.state_dir,
+                               checkpoint_interval=args.checkpoint,
                                )
     try:
         loop.run_until_complete(crawler.crawl())  # Crawler gonna crawl.
@@ -21,6 +21,8 @@ import aiohttp  # Install with "pip install aiohttp".
 # support to single thread IO
 # aiohttp could concurrent with coroutines
 
+from frontier import Frontier
+
 LOGGER = logging.getLogger(__name__)  # return a logger instance from factory method
 # logger's config is made in crawl.py. So just get it and use it. https://www.cnblogs.com/i-honey/p/8052579.html
 
@@ -51,12 +53,23 @@ class Crawler:
 
     This manages two sets of URLs: 'urls' and 'done'.  'urls' is a set of
     URLs seen, and 'done' is a list of FetchStatistics.
+
+    With a state_dir, the URLs seen and yet to fetch are kept on disk in a
+    Frontier there instead, and only a few at a time are in the queue. A
+    crawl with the same state_dir carries on where the last one stopped;
+    it needs no roots, but the same options as before.
     """
     def __init__(self, roots,
                  exclude=None, strict=True,  # What to crawl.
                  max_redirect=10, max_tries=4,  # Per-url limits.
-                 max_tasks=10, *, loop=None):
+                 max_tasks=10, *, loop=None,
+                 state_dir=None, checkpoint_interval=10.0):
         self.loop = loop or asyncio.get_event_loop()
+        self.frontier = None
+        if state_dir is not None:
+            self.frontier = Frontier(state_dir, checkpoint_interval)
+            self.frontier.add_roots(roots)
+            roots = self.frontier.roots
         self.roots = roots
         self.exclude = exclude
         self.strict = strict
@@ -64,7 +77,11 @@ class Crawler:
         self.max_tries = max_tries
         self.max_tasks = max_tasks
         self.q = Queue(loop=self.loop)  # url执行队列，使用put将url放入队列供爬虫爬取
-        self.seen_urls = set()
+        if self.frontier is None:
+            self.seen_urls = set()
+        else:
+            # Answers "in", which is all that's asked of seen_urls.
+            self.seen_urls = self.frontier
         self.done = []  # 完成列表，每个元素是访问url后的具名元组FetchStatistic
         self.session = aiohttp.ClientSession(loop=self.loop)  # 单线程IO操作
         self.root_domains = set()
@@ -83,12 +100,15 @@ class Crawler:
                     self.root_domains.add(lenient_host(host))
         for root in roots:
             self.add_url(root)  # add url to seen_urls set
+        self.fill_queue()
         self.t0 = time.time()  # bgn time
         self.t1 = None  # end time
 
     def close(self):
         """Close resources."""
         self.session.close()
+        if self.frontier is not None:
+            self.frontier.close()
 
     def host_okay(self, host):
         """Check if a host should be crawled.
@@ -166,7 +186,8 @@ class Crawler:
             content_type=content_type,
             encoding=encoding,
             num_urls=len(links),
-            num_new_urls=len(links - self.seen_urls))
+            num_new_urls=sum(1 for link in links
+                             if link not in self.seen_urls))
 
         return stat, links
 
@@ -230,9 +251,9 @@ class Crawler:
             else:  # 不是跳转下级，是完整link，则需要分析link，即下一环的协程工作
                 stat, links = yield from self.parse_links(response)  # 提取并分析link
                 self.record_statistic(stat)
-                for link in links.difference(self.seen_urls):  # 在links里，但不在seen_urls里
-                    self.q.put_nowait((link, self.max_redirect))  # 放入执行队列
-                self.seen_urls.update(links)
+                for link in links:
+                    if link not in self.seen_urls:  # 在links里，但不在seen_urls里
+                        self.add_url(link)  # 放入执行队列
         finally:
             yield from response.release()
 
@@ -244,6 +265,12 @@ class Crawler:
                 url, max_redirect = yield from self.q.get()
                 assert url in self.seen_urls  # 如果url不在seen_urls里，则跳进except
                 yield from self.fetch(url, max_redirect)
+                if self.frontier is not None:
+                    self.frontier.finish(url)
+                    # Before task_done, so that join() can't see an empty
+                    # queue while the frontier has more.
+                    self.fill_queue()
+                    self.frontier.maybe_checkpoint()
                 self.q.task_done()
         except asyncio.CancelledError:
             pass
@@ -266,9 +293,31 @@ class Crawler:
         if max_redirect is None:
             max_redirect = self.max_redirect
         LOGGER.debug('adding %r %r', url, max_redirect)
+        if self.frontier is not None:
+            # fill_queue moves it to the queue when there's room.
+            self.frontier.add(url, max_redirect)
+            return
         self.seen_urls.add(url)
         self.q.put_nowait((url, max_redirect))
 
+    def fill_queue(self):
+        """Top up the queue from the frontier, if there is one.
+
+        Two URLs per task are enough to keep every task busy.
+        """
+        if self.frontier is None:
+            return
+        room = 2 * self.max_tasks - self.q.qsize()
+        if room > 0:
+            for url, max_redirect in self.frontier.take(room):
+                self.q.put_nowait((url, max_redirect))
+
+    def todo(self):
+        """How many URLs are left to fetch."""
+        if self.frontier is not None:
+            return self.frontier.pending()
+        return self.q.qsize()
+
     @asyncio.coroutine  # 异步协程：爬取执行到yield from时并不会停止等待，而是立刻执行loop中的下一个爬取crawl函数
     def crawl(self):
         """Run the crawler until all finished."""
@@ -279,5 +328,7 @@ class Crawler:
         # yield from 解释见： https://www.cnblogs.com/wongbingming/p/9085268.html
         # 每个耗时的动作都编写一个@asyncio.coroutine下的def，然后在这个def内用yield from连接另外一个耗时的同candy的def
         self.t1 = time.time()
+        if self.frontier is not None:
+            self.frontier.checkpoint()
         for w in workers:
             w.cancel()  # cancel this task
@@ -0,0 +1,98 @@
+"""A crawl frontier kept on disk, so that a crawl can stop and resume."""
+
+import os
+import sqlite3
+import time
+
+# What's become of each URL.
+QUEUED, TAKEN, DONE = 0, 1, 2
+
+
+class Frontier:
+    """The URLs a crawl has seen and has yet to fetch, in a sqlite file.
+
+    Each URL seen is a row: queued, taken by the crawler to fetch, or done.
+    Memory use stays flat however many there are. Changes are committed by
+    checkpoint(), which maybe_checkpoint() calls every checkpoint_interval
+    seconds. A crash loses only what happened since, and URLs that were
+    taken but not done are queued again when the frontier is reopened.
+    """
+
+    def __init__(self, state_dir, checkpoint_interval=10.0):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, 'frontier.sqlite')
+        self.checkpoint_interval = checkpoint_interval
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS urls ('
+                        'url TEXT PRIMARY KEY, '
+                        'max_redirect INTEGER NOT NULL, '
+                        'state INTEGER NOT NULL)')
+        # Finds queued URLs in the order they were added, by rowid.
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS urls_state ON urls (state)')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS roots (url TEXT PRIMARY KEY)')
+        self.db.execute('UPDATE urls SET state = ? WHERE state = ?',
+                        (QUEUED, TAKEN))
+        self.db.commit()
+        self.last_checkpoint = time.time()
+
+    @property
+    def roots(self):
+        """The root URLs of the crawl, from every run so far."""
+        return {url for url, in self.db.execute('SELECT url FROM roots')}
+
+    def add_roots(self, urls):
+        self.db.executemany('INSERT OR IGNORE INTO roots VALUES (?)',
+                            [(url,) for url in urls])
+
+    def __contains__(self, url):
+        return self.db.execute('SELECT 1 FROM urls WHERE url = ?',
+                               (url,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM urls').fetchone()[0]
+
+    def add(self, url, max_redirect):
+        """Queue `url` if it hasn't been seen. Returns whether it was new."""
+        cursor = self.db.execute(
+            'INSERT OR IGNORE INTO urls VALUES (?, ?, ?)',
+            (url, max_redirect, QUEUED))
+        return cursor.rowcount == 1
+
+    def take(self, count):
+        """Take up to `count` queued (url, max_redirect) pairs, oldest
+        first, to fetch."""
+        taken = self.db.execute(
+            'SELECT url, max_redirect FROM urls WHERE state = ? '
+            'ORDER BY rowid LIMIT ?', (QUEUED, count)).fetchall()
+        self.db.executemany('UPDATE urls SET state = ? WHERE url = ?',
+                            [(TAKEN, url) for url, _ in taken])
+        return taken
+
+    def finish(self, url):
+        """Record that `url` has been fetched."""
+        self.db.execute('UPDATE urls SET state = ? WHERE url = ?',
+                        (DONE, url))
+
+    def pending(self):
+        """How many URLs are queued or taken, and not done yet."""
+        return self.db.execute('SELECT COUNT(*) FROM urls WHERE state != ?',
+                               (DONE,)).fetchone()[0]
+
+    def maybe_checkpoint(self):
+        if time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Commit everything so far, to resume from after a crash."""
+        self.db.commit()
+        self.last_checkpoint = time.time()
+
+    def close(self):
+        if self.db is not None:
+            self.checkpoint()
+            self.db.close()
+            self.db = None
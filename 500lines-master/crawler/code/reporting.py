@@ -40,7 +40,7 @@ def report(crawler, file=None):
           '(%.3f urls/sec/task)' % speed,
           file=file)
     stats.report(file=file)  # 打印统计信息
-    print('Todo:', crawler.q.qsize(), file=file)
+    print('Todo:', crawler.todo(), file=file)
     print('Done:', len(crawler.done), file=file)
     print('Date:', time.ctime(), 'local time', file=file)
 
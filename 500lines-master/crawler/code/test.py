@@ -2,12 +2,15 @@ import asyncio
 from contextlib import contextmanager
 import io
 import logging
+import shutil
 import socket
+import tempfile
 import unittest
 
 from aiohttp import ClientError, web
 
 import crawling
+from frontier import Frontier
 
 
 @contextmanager
@@ -334,6 +337,86 @@ class TestCrawler(unittest.TestCase):
         self.crawl()
         self.assertStat(num_urls=0)
 
+    def make_state_dir(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        return state_dir
+
+    def test_state_dir(self):
+        state_dir = self.make_state_dir()
+        self.add_page('/', ['/foo', '/bar'])
+        self.add_page('/foo', ['/bar'])
+        self.crawl(state_dir=state_dir, max_tasks=1)
+        self.assertDoneCount(3)
+        [foo] = [stat for stat in self.crawler.done
+                 if stat.url == self.app_url + '/foo']
+        self.assertEqual((1, 0), (foo.num_urls, foo.num_new_urls))
+        self.assertEqual(0, self.crawler.todo())
+
+        # It's all been fetched, so carrying on fetches nothing more.
+        self.crawl([], state_dir=state_dir)
+        self.assertDoneCount(0)
+
+    def test_resume(self):
+        # A crawl stopped after fetching the root, while fetching /foo.
+        state_dir = self.make_state_dir()
+        self.add_page('/', ['/foo'])
+        self.add_page('/foo', [])
+        frontier = Frontier(state_dir)
+        frontier.add_roots([self.app_url])
+        frontier.add(self.app_url, 10)
+        frontier.finish(self.app_url)
+        frontier.add(self.app_url + '/foo', 10)
+        frontier.take(1)
+        frontier.close()
+
+        self.crawl([], state_dir=state_dir)
+        self.assertDoneCount(1)
+        self.assertStat(url=self.app_url + '/foo', status=200)
+
+
+class TestFrontier(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+
+    def test_add_and_take(self):
+        frontier = Frontier(self.state_dir)
+        self.addCleanup(frontier.close)
+        self.assertTrue(frontier.add('http://a', 10))
+        self.assertFalse(frontier.add('http://a', 10))
+        self.assertTrue(frontier.add('http://b', 3))
+        self.assertIn('http://b', frontier)
+        self.assertNotIn('http://c', frontier)
+        self.assertEqual([('http://a', 10)], frontier.take(1))
+        self.assertEqual([('http://b', 3)], frontier.take(5))
+        self.assertEqual([], frontier.take(5))
+        self.assertEqual(2, frontier.pending())
+        frontier.finish('http://a')
+        self.assertEqual(1, frontier.pending())
+        self.assertEqual(2, len(frontier))
+
+    def test_reopen(self):
+        frontier = Frontier(self.state_dir)
+        frontier.add_roots(['http://a'])
+        frontier.add('http://a', 10)
+        frontier.add('http://b', 10)
+        frontier.take(1)
+        frontier.checkpoint()
+        # Not checkpointed, so lost in a crash.
+        frontier.add('http://c', 10)
+        frontier.db.rollback()
+        frontier.close()
+
+        frontier = Frontier(self.state_dir)
+        self.addCleanup(frontier.close)
+        self.assertEqual({'http://a'}, frontier.roots)
+        self.assertNotIn('http://c', frontier)
+        # What was taken but never finished is queued again.
+        self.assertEqual([('http://a', 10), ('http://b', 10)],
+                         frontier.take(5))
+
 
 if __name__ == '__main__':
     unittest.main()
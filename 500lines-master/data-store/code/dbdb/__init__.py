@@ -1,16 +1,132 @@
 import os
 
-from dbdb.interface import DBDB
+from dbdb.avl_tree import AVLTree
+from dbdb.binary_tree import BinaryTree
+from dbdb.bplus_tree import BPlusTree
+from dbdb.cache import NodeCache
+from dbdb.interface import TREES, DBDB, ConflictError, Snapshot, Transaction
+from dbdb.logical import WrongTreeError
+from dbdb.physical import (
+    NO_SYNC, SYNC_EACH_COMMIT, SYNC_PERIODICALLY, CorruptRecordError,
+    MmapStorage, Storage)
+from dbdb.sharding import HashRouter, RangeRouter, ShardedDB
 
 
-__all__ = ['DBDB', 'connect']  # 表示在import dbdb时，只会import DBDB类和connect方法
+__all__ = ['DBDB', 'connect', 'compact', 'bulk_load', 'BinaryTree', 'AVLTree', 'BPlusTree',
+           'NodeCache', 'Snapshot', 'Transaction', 'ConflictError', 'recover',
+           'CorruptRecordError', 'WrongTreeError', 'TREES', 'NO_SYNC',
+           'SYNC_EACH_COMMIT', 'SYNC_PERIODICALLY', 'ShardedDB', 'HashRouter', 'RangeRouter']  # 表示在import dbdb时，只会import DBDB类和connect方法
 
 
-def connect(dbname):
+def connect(dbname, tree_class=None, cache=None, readonly=False,
+            group_commit=False, durability=NO_SYNC, sync_interval=1.0,
+            compression=None, overflow_threshold=None, bloom=False):
+    """Open the database in `dbname`, creating it if need be.
+
+    The file says what kind of tree it holds, and `tree_class` defaults to
+    that, or to BinaryTree for a new file. Opening a file as a different
+    kind of tree raises WrongTreeError; files from before the kind was
+    recorded can't be checked until they are compacted.
+
+    `durability` says when commits reach the disk: 'none' leaves it to the
+    OS, 'commit' syncs before each commit returns, and 'periodic' syncs
+    within `sync_interval` seconds of a commit. Whatever the policy, a crash
+    never leaves a root pointing at missing nodes that opening can't undo.
+
+    Values written are compressed with `compression`, 'zlib' or 'lzma', when
+    that makes them smaller. Values of `overflow_threshold` bytes or more,
+    once compressed, are kept in a segment file beside the database. Either
+    way, whatever was written before can still be read.
+
+    With `bloom`, a Bloom filter of the keys is kept in DBNAME.bloom, so
+    that looking up a missing key seldom has to read the tree.
+    """
+    bloom_path = dbname + '.bloom' if bloom else None
+    if readonly:
+        # Reads come straight out of an mmap of the file.
+        return DBDB(open(dbname, 'rb'), tree_class=tree_class, cache=cache,
+                    storage_class=MmapStorage, bloom_path=bloom_path)
     try:
         f = open(dbname, 'r+b')
     except IOError:
         fd = os.open(dbname, os.O_RDWR | os.O_CREAT)
         # O_RDWR只读打开 O_CREAT创建并打开 http://www.runoob.com/python/os-open.html
-        f = os.fdopen(fd, 'r+b')  # # http://www.runoob.com/python/os-fdopen.html
-    return DBDB(f)
+        os.close(fd)
+        # Opened again by name, which the overflow segment is named after.
+        f = open(dbname, 'r+b')
+    return DBDB(f, tree_class=tree_class, cache=cache,
+                group_commit=group_commit, durability=durability,
+                sync_interval=sync_interval, compression=compression,
+                overflow_threshold=overflow_threshold, bloom_path=bloom_path)
+
+
+def compact(dbname, tree_class=None, compression=None,
+            overflow_threshold=None):
+    """Rewrite `dbname` keeping only what its current root can reach.
+
+    The live tree is copied into a new file, which then atomically replaces
+    the old one. Readers that already have the old file open carry on
+    reading it undisturbed; writers waiting on its lock get a
+    RetiredStorageError, and should reconnect.
+
+    Values are rewritten with `compression` and `overflow_threshold`, as
+    for connect(), and the old file's overflow segment is deleted. The tree
+    is copied as `tree_class`, which defaults as for connect().
+    """
+    temp_name = dbname + '.compact'
+    with open(dbname, 'r+b') as f:
+        storage = Storage(f)
+        storage.lock()
+        if tree_class is None:
+            tree_class = TREES.get(storage.tree_kind, BinaryTree)
+        tree = tree_class(storage, compression=compression)
+        fd = os.open(temp_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        with os.fdopen(fd, 'r+b') as new_f:
+            new_storage = Storage(new_f, overflow_threshold=overflow_threshold,
+                                  name=dbname)
+            tree.copy_to(new_storage)
+            new_storage.sync()
+            new_storage.close()
+        os.rename(temp_name, dbname)
+        storage.retire()
+        storage.remove_blobs()
+        storage.close()
+
+
+def recover(dbname):
+    """Roll `dbname` back to its last commit with every record intact.
+
+    Opening a database already cuts off whatever a crashed writer left after
+    its last commit. This also checks every record before that, for damage
+    that only shows up when it's read. Returns the recovered root address.
+    """
+    with open(dbname, 'r+b') as f:
+        return Storage(f).recover()
+
+
+def bulk_load(dbname, pairs, tree_class=BinaryTree, compression=None,
+              overflow_threshold=None):
+    """Create `dbname` from (key, value) pairs given in ascending key order.
+
+    The pairs are streamed straight into a balanced tree: every node is
+    written exactly once and nothing unreachable is left in the file. The
+    file appears complete, or not at all; an existing database with data
+    in it is left alone. Values are written with `compression` and
+    `overflow_threshold`, as for connect().
+    """
+    if os.path.exists(dbname):
+        with open(dbname, 'r+b') as f:
+            if Storage(f).get_root_address():
+                raise ValueError('%s already has data in it.' % dbname)
+    temp_name = dbname + '.load'
+    fd = os.open(temp_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+    try:
+        with os.fdopen(fd, 'r+b') as f:
+            storage = Storage(f, overflow_threshold=overflow_threshold,
+                              name=dbname)
+            tree_class(storage, compression=compression).load_sorted(pairs)
+            os.fsync(f.fileno())
+    except Exception:
+        os.remove(temp_name)
+        raise
+    os.rename(temp_name, dbname)
@@ -0,0 +1,240 @@
+import pickle
+import struct
+
+from dbdb import encoding
+from dbdb.binary_tree import BinaryNode, BinaryNodeRef, BinaryTree
+from dbdb.logical import ValueRef
+
+
+# After the header: address and length of the left child, the value address,
+# address and length of the right child, the node's own length, the key's
+# tag and length, then the three heights; then the key.
+NODE_FORMATS = {
+    False: struct.Struct('!IIIIIIcIBBB'),
+    True: struct.Struct('!QQQQQQcIBBB'),
+}
+
+
+class AVLNode(BinaryNode):
+    def __init__(self, left_ref, key, value_ref, right_ref, length, height):
+        super(AVLNode, self).__init__(
+            left_ref, key, value_ref, right_ref, length)
+        self.height = height
+
+
+class AVLNodeRef(BinaryNodeRef):
+    # A parent records the length and height of each child next to its
+    # address, so rebalancing never has to load a sibling just to learn how
+    # tall it is.
+    def __init__(self, referent=None, address=0, length=0, height=0):
+        super(AVLNodeRef, self).__init__(referent=referent, address=address)
+        self._length = length
+        self._height = height
+
+    @property
+    def length(self):
+        if self._referent:
+            return self._referent.length
+        return self._length
+
+    @property
+    def height(self):
+        if self._referent:
+            return self._referent.height
+        return self._height
+
+    @staticmethod
+    def referent_to_string(referent):
+        numbers = (
+            referent.left_ref.address,
+            referent.left_ref.length,
+            referent.value_ref.address,
+            referent.right_ref.address,
+            referent.right_ref.length,
+            referent.length,
+        )
+        tag, key = encoding.pack_key(referent.key)
+        wide = encoding.is_wide(numbers)
+        return encoding.header(wide) + NODE_FORMATS[wide].pack(*(numbers + (
+            tag, len(key),
+            referent.left_ref.height,
+            referent.right_ref.height,
+            referent.height,
+        ))) + key
+
+    @staticmethod
+    def string_to_referent(string):
+        if not encoding.is_encoded(string):
+            return AVLNodeRef.pickle_to_referent(string)
+        node_format = NODE_FORMATS[encoding.header_is_wide(string)]
+        (left, left_length, value, right, right_length, length, tag,
+         key_length, left_height, right_height, height) = \
+            node_format.unpack_from(string, encoding.HEADER_LENGTH)
+        key_start = encoding.HEADER_LENGTH + node_format.size
+        return AVLNode(
+            AVLNodeRef(address=left, length=left_length, height=left_height),
+            encoding.unpack_key(
+                tag, string[key_start:key_start + key_length]),
+            ValueRef(address=value),
+            AVLNodeRef(address=right, length=right_length, height=right_height),
+            length,
+            height,
+        )
+
+    @staticmethod
+    def referent_to_pickle(referent):
+        return pickle.dumps({
+            'left': referent.left_ref.address,
+            'left_length': referent.left_ref.length,
+            'left_height': referent.left_ref.height,
+            'key': referent.key,
+            'value': referent.value_ref.address,
+            'right': referent.right_ref.address,
+            'right_length': referent.right_ref.length,
+            'right_height': referent.right_ref.height,
+            'length': referent.length,
+            'height': referent.height,
+        })
+
+    @staticmethod
+    def pickle_to_referent(string):
+        """Read a node written before nodes had their own encoding."""
+        d = pickle.loads(string)
+        return AVLNode(
+            AVLNodeRef(address=d['left'], length=d['left_length'],
+                       height=d['left_height']),
+            d['key'],
+            ValueRef(address=d['value']),
+            AVLNodeRef(address=d['right'], length=d['right_length'],
+                       height=d['right_height']),
+            d['length'],
+            d['height'],
+        )
+
+
+class AVLTree(BinaryTree):
+    """A BinaryTree that keeps itself height-balanced.
+
+    Every update rebuilds the path from the root anyway, so rotations come
+    almost for free: they only touch nodes that are being rewritten already.
+    This keeps lookups at O(log n) disk reads even for sorted inserts.
+    """
+    node_ref_class = AVLNodeRef
+    tree_kind = 'avl'
+
+    def _node_ref(self, left_ref, key, value_ref, right_ref):
+        return self.node_ref_class(referent=AVLNode(
+            left_ref,
+            key,
+            value_ref,
+            right_ref,
+            left_ref.length + right_ref.length + 1,
+            max(left_ref.height, right_ref.height) + 1,
+        ))
+
+    def _balance(self, left_ref, key, value_ref, right_ref):
+        if left_ref.height > right_ref.height + 1:
+            left = self._follow(left_ref)
+            if left.left_ref.height >= left.right_ref.height:
+                return self._node_ref(
+                    left.left_ref, left.key, left.value_ref,
+                    self._node_ref(left.right_ref, key, value_ref, right_ref))
+            pivot = self._follow(left.right_ref)
+            return self._node_ref(
+                self._node_ref(
+                    left.left_ref, left.key, left.value_ref, pivot.left_ref),
+                pivot.key, pivot.value_ref,
+                self._node_ref(pivot.right_ref, key, value_ref, right_ref))
+        elif right_ref.height > left_ref.height + 1:
+            right = self._follow(right_ref)
+            if right.right_ref.height >= right.left_ref.height:
+                return self._node_ref(
+                    self._node_ref(left_ref, key, value_ref, right.left_ref),
+                    right.key, right.value_ref, right.right_ref)
+            pivot = self._follow(right.left_ref)
+            return self._node_ref(
+                self._node_ref(left_ref, key, value_ref, pivot.left_ref),
+                pivot.key, pivot.value_ref,
+                self._node_ref(
+                    pivot.right_ref, right.key, right.value_ref,
+                    right.right_ref))
+        return self._node_ref(left_ref, key, value_ref, right_ref)
+
+    def _insert(self, node, key, value_ref):
+        if node is None:
+            return self._node_ref(
+                self.node_ref_class(), key, value_ref, self.node_ref_class())
+        elif key < node.key:
+            return self._balance(
+                self._insert(self._follow(node.left_ref), key, value_ref),
+                node.key, node.value_ref, node.right_ref)
+        elif node.key < key:
+            return self._balance(
+                node.left_ref, node.key, node.value_ref,
+                self._insert(self._follow(node.right_ref), key, value_ref))
+        else:
+            return self._node_ref(
+                node.left_ref, node.key, value_ref, node.right_ref)
+
+    def _delete(self, node, key):
+        if node is None:
+            raise KeyError
+        elif key < node.key:
+            return self._balance(
+                self._delete(self._follow(node.left_ref), key),
+                node.key, node.value_ref, node.right_ref)
+        elif node.key < key:
+            return self._balance(
+                node.left_ref, node.key, node.value_ref,
+                self._delete(self._follow(node.right_ref), key))
+        else:
+            left = self._follow(node.left_ref)
+            right = self._follow(node.right_ref)
+            if left and right:
+                replacement = self._find_max(left)
+                left_ref = self._delete(left, replacement.key)
+                return self._balance(
+                    left_ref, replacement.key, replacement.value_ref,
+                    node.right_ref)
+            elif left:
+                return node.left_ref
+            else:
+                return node.right_ref
+
+    def _nth(self, node, index):
+        # Children's lengths are stored in their parent, so only the nodes on
+        # the way down get read.
+        while True:
+            left_length = node.left_ref.length
+            if index < left_length:
+                node = self._peek(node.left_ref)
+            elif index == left_length:
+                return node.key, node.value_ref
+            else:
+                index -= left_length + 1
+                node = self._peek(node.right_ref)
+
+    def _copy(self, ref, storage):
+        node = ref.peek(self._storage)
+        if node is None:
+            return self.node_ref_class()
+        new_ref = self._node_ref(
+            self._copy(node.left_ref, storage),
+            node.key,
+            self._copy_value(node.value_ref, storage),
+            self._copy(node.right_ref, storage),
+        )
+        new_ref.store(storage)
+        return self.node_ref_class(
+            address=new_ref.address, length=node.length, height=node.height)
+
+    def _write_subtree(self, left, key, value_ref, right):
+        ref = self._node_ref(left[0], key, value_ref, right[0])
+        ref.store(self._storage)
+        length, height = ref.length, ref.height
+        return (
+            self.node_ref_class(
+                address=ref.address, length=length, height=height),
+            length,
+            height,
+        )
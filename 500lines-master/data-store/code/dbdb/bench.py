@@ -0,0 +1,390 @@
+"""Benchmarks for dbdb.
+
+Usage::
+
+    python -m dbdb.bench [trees] [COUNT]
+    python -m dbdb.bench workloads [COUNT]
+    python -m dbdb.bench encoding [COUNT]
+    python -m dbdb.bench server [COUNT]
+
+`trees` compares the tree backends on sequential and random insert
+workloads. Each workload inserts COUNT keys into a fresh database file,
+commits, then looks every key up again from a freshly opened file. Reads per
+lookup are counted at the Storage layer, so they show how deep the tree
+really is.
+
+`workloads` runs the standard workloads against each tree backend, through
+DBDB, committing after every write: sequential and random insert, point
+read, read-after-write, a 95/5 mix of reads and writes, and delete-heavy.
+Each runs COUNT operations against a fresh file, holding COUNT keys to begin
+with unless it's an insert workload. It prints JSON, one result per backend
+and workload, with operations per second, p50 and p99 latency, file growth,
+and records read and written per operation, for comparing across runs.
+
+`encoding` compares the node encoding against the pickled dicts older
+versions wrote: bytes per node, and nodes encoded and decoded per second.
+
+`server` runs dbdb.server in a thread and drives it from a growing number of
+client threads, each making COUNT requests, 95% reads and 5% writes, one at
+a time and then pipelined. It prints requests per second and how many
+writes went into each commit.
+"""
+from __future__ import print_function
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import dbdb
+from dbdb.avl_tree import AVLNode, AVLNodeRef
+from dbdb.binary_tree import BinaryNode, BinaryNodeRef
+from dbdb.bplus_tree import BPlusBranch, BPlusLeaf, BPlusNodeRef
+from dbdb.logical import ValueRef
+from dbdb.physical import Storage
+
+
+TREES = [
+    ('binary', dbdb.BinaryTree),
+    ('avl', dbdb.AVLTree),
+    ('bplus', dbdb.BPlusTree),
+]
+
+
+class CountingStorage(Storage):
+    """A Storage that counts the records it reads and writes."""
+
+    def __init__(self, f, **options):
+        self.reads = 0
+        self.writes = 0
+        super(CountingStorage, self).__init__(f, **options)
+
+    def read(self, address):
+        self.reads += 1
+        return super(CountingStorage, self).read(address)
+
+    def write(self, data):
+        self.writes += 1
+        return super(CountingStorage, self).write(data)
+
+
+def sequential_keys(count):
+    return ['%010d' % i for i in range(count)]
+
+
+def random_keys(count):
+    keys = sequential_keys(count)
+    random.shuffle(keys)
+    return keys
+
+
+WORKLOADS = [
+    ('sequential', sequential_keys),
+    ('random', random_keys),
+]
+
+
+def _open(path, tree_class):
+    f = open(path, 'r+b') if os.path.exists(path) else open(path, 'w+b')
+    storage = CountingStorage(f)
+    return storage, tree_class(storage)
+
+
+def run(tree_class, keys, path):
+    storage, tree = _open(path, tree_class)
+    start = time.time()
+    for key in keys:
+        tree.set(key, key)
+    tree.commit()
+    insert_seconds = time.time() - start
+    storage.close()
+
+    storage, tree = _open(path, tree_class)
+    start = time.time()
+    for key in keys:
+        tree.get(key)
+    lookup_seconds = time.time() - start
+    storage.close()
+
+    return {
+        'insert_seconds': insert_seconds,
+        'lookup_seconds': lookup_seconds,
+        # Every lookup also reads the value it finds.
+        'reads_per_lookup': float(storage.reads) / len(keys),
+        'file_bytes': os.path.getsize(path),
+    }
+
+
+def trees(count):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for workload_name, make_keys in WORKLOADS:
+            keys = make_keys(count)
+            for tree_name, tree_class in TREES:
+                path = os.path.join(
+                    temp_dir, '%s-%s.db' % (workload_name, tree_name))
+                try:
+                    result = run(tree_class, keys, path)
+                except RuntimeError:
+                    # RecursionError: the unbalanced tree got too deep for
+                    # the recursive _insert to reach the bottom.
+                    print('%-10s %-6s failed: tree too deep' % (
+                        workload_name, tree_name))
+                    continue
+                print(
+                    '%-10s %-6s insert %8.3fs  lookup %8.3fs  '
+                    '%6.1f reads/lookup  %10d bytes' % (
+                        workload_name, tree_name,
+                        result['insert_seconds'], result['lookup_seconds'],
+                        result['reads_per_lookup'], result['file_bytes']))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+
+def _insert(db, keys, i):
+    db[keys[i]] = keys[i]
+    db.commit()
+
+
+def _point_read(db, keys, i):
+    db[random.choice(keys)]
+
+
+def _read_after_write(db, keys, i):
+    key = random.choice(keys)
+    db[key] = 'v%d' % i
+    db.commit()
+    db[key]
+
+
+def _mixed(db, keys, i):
+    key = random.choice(keys)
+    if random.random() < 0.05:
+        db[key] = 'v%d' % i
+        db.commit()
+    else:
+        db[key]
+
+
+def _delete_heavy(db, keys, i):
+    # Four deletes to every read, which often misses.
+    if i % 5 == 4:
+        db.get(random.choice(keys))
+    else:
+        del db[keys[i - i // 5]]
+        db.commit()
+
+
+# (name, how keys are ordered, whether the file starts out full, operation)
+STANDARD_WORKLOADS = [
+    ('sequential_insert', sequential_keys, False, _insert),
+    ('random_insert', random_keys, False, _insert),
+    ('point_read', random_keys, True, _point_read),
+    ('read_after_write', random_keys, True, _read_after_write),
+    ('mixed_95_5', random_keys, True, _mixed),
+    ('delete_heavy', random_keys, True, _delete_heavy),
+]
+
+
+def _percentile(ordered, fraction):
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def run_workload(tree_class, make_keys, prefilled, operation, count, path):
+    keys = make_keys(count)
+    if prefilled:
+        dbdb.bulk_load(path, sorted((key, key) for key in keys), tree_class)
+    else:
+        open(path, 'wb').close()
+    db = dbdb.DBDB(open(path, 'r+b'), tree_class=tree_class,
+                   storage_class=CountingStorage)
+    try:
+        storage = db._storage
+        size_before = os.path.getsize(path)
+        latencies = []
+        start = _clock()
+        for i in range(count):
+            began = _clock()
+            operation(db, keys, i)
+            latencies.append(_clock() - began)
+        seconds = _clock() - start
+    finally:
+        db.close()
+    latencies.sort()
+    return {
+        'ops': count,
+        'seconds': seconds,
+        'ops_per_second': count / max(seconds, 1e-9),
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'file_growth_bytes': os.path.getsize(path) - size_before,
+        'reads_per_op': float(storage.reads) / count,
+        'writes_per_op': float(storage.writes) / count,
+    }
+
+
+def workloads(count):
+    results = []
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for tree_name, tree_class in TREES:
+            for name, make_keys, prefilled, operation in STANDARD_WORKLOADS:
+                path = os.path.join(temp_dir, '%s-%s.db' % (name, tree_name))
+                result = {'backend': tree_name, 'workload': name}
+                try:
+                    result.update(run_workload(
+                        tree_class, make_keys, prefilled, operation, count,
+                        path))
+                except RuntimeError as e:
+                    # RecursionError: the unbalanced tree got too deep.
+                    result['error'] = '%s: %s' % (type(e).__name__, e)
+                results.append(result)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    print(json.dumps({'count': count, 'results': results}, indent=2,
+                     sort_keys=True))
+    return results
+
+
+def _address():
+    # Somewhere in a file of a few hundred megabytes.
+    return random.randrange(Storage.SUPERBLOCK_SIZE, 2 ** 28)
+
+
+def sample_nodes(count):
+    keys = sorted(random_keys(count))
+    return [
+        ('binary', BinaryNodeRef, [
+            BinaryNode(
+                BinaryNodeRef(address=_address()), key,
+                ValueRef(address=_address()),
+                BinaryNodeRef(address=_address()), count)
+            for key in keys]),
+        ('avl', AVLNodeRef, [
+            AVLNode(
+                AVLNodeRef(address=_address(), length=count, height=20), key,
+                ValueRef(address=_address()),
+                AVLNodeRef(address=_address(), length=count, height=20),
+                2 * count + 1, 21)
+            for key in keys]),
+        ('leaf', BPlusNodeRef, [
+            BPlusLeaf(
+                keys[i:i + 256],
+                [ValueRef(address=_address()) for _ in keys[i:i + 256]])
+            for i in range(0, count, 256)]),
+        ('branch', BPlusNodeRef, [
+            BPlusBranch(
+                keys[i:i + 256],
+                [BPlusNodeRef(address=_address())
+                 for _ in range(len(keys[i:i + 256]) + 1)],
+                [count] * (len(keys[i:i + 256]) + 1))
+            for i in range(0, count, 256)]),
+    ]
+
+
+def _rate(function, items):
+    start = time.time()
+    for item in items:
+        function(item)
+    return len(items) / max(time.time() - start, 1e-9)
+
+
+def encoding(count):
+    for name, ref_class, nodes in sample_nodes(count):
+        for format_name, encode, decode in [
+                ('pickle', ref_class.referent_to_pickle,
+                 ref_class.pickle_to_referent),
+                ('encoded', ref_class.referent_to_string,
+                 ref_class.string_to_referent)]:
+            strings = [encode(node) for node in nodes]
+            print(
+                '%-6s %-7s %8.1f bytes/node  %10.0f encodes/s  '
+                '%10.0f decodes/s' % (
+                    name, format_name,
+                    float(sum(len(s) for s in strings)) / len(strings),
+                    _rate(encode, nodes), _rate(decode, strings)))
+
+
+def _client_load(client, keys, count, pipeline_depth):
+    requests = []
+    for i in range(count):
+        key = random.choice(keys)
+        if random.random() < 0.05:
+            requests.append(('set', (key, 'v%d' % i)))
+        else:
+            requests.append(('get', (key,)))
+    for i in range(0, count, pipeline_depth):
+        client.pipeline(requests[i:i + pipeline_depth])
+
+
+def server(count):
+    from dbdb.client import Client
+    from dbdb.server import serve_in_thread
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        keys = random_keys(10000)
+        path = os.path.join(temp_dir, 'server.db')
+        dbdb.bulk_load(path, sorted((key, key) for key in keys),
+                       tree_class=dbdb.BPlusTree)
+        db = dbdb.connect(path, tree_class=dbdb.BPlusTree,
+                          cache=dbdb.NodeCache())
+        service, stop = serve_in_thread(db, path + '.sock')
+        try:
+            for pipeline_depth in (1, 32):
+                for threads in (1, 4, 16):
+                    client = Client(path + '.sock', pool_size=threads)
+                    commits_before = service.commits
+                    workers = [
+                        threading.Thread(target=_client_load, args=(
+                            client, keys, count, pipeline_depth))
+                        for _ in range(threads)]
+                    start = time.time()
+                    for worker in workers:
+                        worker.start()
+                    for worker in workers:
+                        worker.join()
+                    seconds = time.time() - start
+                    client.close()
+                    commits = service.commits - commits_before
+                    print(
+                        'pipeline %2d  %2d clients  %9.0f requests/s  '
+                        '%5.1f writes/commit' % (
+                            pipeline_depth, threads,
+                            threads * count / seconds,
+                            threads * count * 0.05 / max(commits, 1)))
+        finally:
+            stop()
+            db.close()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    'trees': trees,
+    'workloads': workloads,
+    'encoding': encoding,
+    'server': server,
+}
+
+
+def main(argv):
+    args = argv[1:]
+    benchmark = trees
+    if args and args[0] in BENCHMARKS:
+        benchmark = BENCHMARKS[args.pop(0)]
+    benchmark(int(args[0]) if args else 1000)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
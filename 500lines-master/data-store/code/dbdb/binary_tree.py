@@ -1,9 +1,18 @@
 import pickle
+import struct
 
-
+from dbdb import encoding
 from dbdb.logical import LogicalBase, ValueRef
 
 
+# After the header: left address, value address, right address, length, and
+# the key's tag and length; then the key.
+NODE_FORMATS = {
+    False: struct.Struct('!IIIIcI'),
+    True: struct.Struct('!QQQQcI'),
+}
+
+
 class BinaryNode(object):
     @classmethod
     def from_node(cls, node, **kwargs):
@@ -35,6 +44,8 @@ class BinaryNode(object):
 
 
 class BinaryNodeRef(ValueRef):
+    overflows = False
+
     def prepare_to_store(self, storage):
         if self._referent:
             self._referent.store_refs(storage)
@@ -50,6 +61,36 @@ class BinaryNodeRef(ValueRef):
 
     @staticmethod
     def referent_to_string(referent):
+        numbers = (
+            referent.left_ref.address,
+            referent.value_ref.address,
+            referent.right_ref.address,
+            referent.length,
+        )
+        tag, key = encoding.pack_key(referent.key)
+        wide = encoding.is_wide(numbers)
+        return encoding.header(wide) + NODE_FORMATS[wide].pack(
+            *(numbers + (tag, len(key)))) + key
+
+    @staticmethod
+    def string_to_referent(string):
+        if not encoding.is_encoded(string):
+            return BinaryNodeRef.pickle_to_referent(string)
+        node_format = NODE_FORMATS[encoding.header_is_wide(string)]
+        left, value, right, length, tag, key_length = node_format.unpack_from(
+            string, encoding.HEADER_LENGTH)
+        key_start = encoding.HEADER_LENGTH + node_format.size
+        return BinaryNode(
+            BinaryNodeRef(address=left),
+            encoding.unpack_key(
+                tag, string[key_start:key_start + key_length]),
+            ValueRef(address=value),
+            BinaryNodeRef(address=right),
+            length,
+        )
+
+    @staticmethod
+    def referent_to_pickle(referent):
         return pickle.dumps({
             'left': referent.left_ref.address,
             'key': referent.key,
@@ -59,7 +100,8 @@ class BinaryNodeRef(ValueRef):
         })
 
     @staticmethod
-    def string_to_referent(string):
+    def pickle_to_referent(string):
+        """Read a node written before nodes had their own encoding."""
         d = pickle.loads(string)
         return BinaryNode(
             BinaryNodeRef(address=d['left']),
@@ -72,6 +114,7 @@ class BinaryNodeRef(ValueRef):
 
 class BinaryTree(LogicalBase):  # 详见BasicPython 二叉树部分。二叉树的已有结构是不会发生改变的，而且搜索效率较高。
     node_ref_class = BinaryNodeRef
+    tree_kind = 'binary'
 
     def _get(self, node, key):  # # 这个具体实现在LogicalBase中被抽象get所调用
         while node is not None:
@@ -80,7 +123,7 @@ class BinaryTree(LogicalBase):  # 详见BasicPython 二叉树部分。二叉树
             elif node.key < key:
                 node = self._follow(node.right_ref)
             else:
-                return self._follow(node.value_ref)
+                return node.value_ref
         raise KeyError
 
     def _insert(self, node, key, value_ref):
@@ -140,3 +183,94 @@ class BinaryTree(LogicalBase):  # 详见BasicPython 二叉树部分。二叉树
             if next_node is None:
                 return node
             node = next_node
+
+    def _items(self, ref, start, stop, reverse):
+        # An in-order walk, keeping only the path to the next node on a
+        # stack. Subtrees that lie wholly outside the range are never read.
+        if reverse:
+            near, far = 'right_ref', 'left_ref'
+            before = lambda key: stop is not None and not key < stop
+            after = lambda key: start is not None and key < start
+        else:
+            near, far = 'left_ref', 'right_ref'
+            before = lambda key: start is not None and key < start
+            after = lambda key: stop is not None and not key < stop
+        path = []
+        node = self._peek(ref)
+        while True:
+            while node is not None:
+                if before(node.key):
+                    node = self._peek(getattr(node, far))
+                else:
+                    path.append(node)
+                    node = self._peek(getattr(node, near))
+            if not path:
+                return
+            node = path.pop()
+            if after(node.key):
+                return
+            yield node.key, node.value_ref
+            node = self._peek(getattr(node, far))
+
+    def _nth(self, node, index):
+        while True:
+            left = self._peek(node.left_ref)
+            left_length = left.length if left else 0
+            if index < left_length:
+                node = left
+            elif index == left_length:
+                return node.key, node.value_ref
+            else:
+                index -= left_length + 1
+                node = self._peek(node.right_ref)
+
+    def _copy(self, ref, storage):
+        node = ref.peek(self._storage)
+        if node is None:
+            return self.node_ref_class()
+        new_ref = self.node_ref_class(referent=BinaryNode(
+            self._copy(node.left_ref, storage),
+            node.key,
+            self._copy_value(node.value_ref, storage),
+            self._copy(node.right_ref, storage),
+            node.length,
+        ))
+        new_ref.store(storage)
+        # Only keep the address, or the whole copy would end up in memory.
+        return self.node_ref_class(address=new_ref.address)
+
+    def load_sorted(self, pairs):
+        """Write a tree of minimal height from sorted pairs, and commit it.
+
+        Finished subtrees are perfectly balanced and get written as soon as
+        they're complete; each waits for the next key to become its parent.
+        Only one waiting parent per level is kept in memory, and they're
+        written last, along the right hand edge of the tree.
+        """
+        empty = (self.node_ref_class(), 0, 0)
+        waiting = []
+        done = None
+        for key, value_ref in self._sorted_value_refs(pairs):
+            if done is not None:
+                waiting.append((done, key, value_ref))
+                done = None
+                continue
+            done = self._write_subtree(empty, key, value_ref, empty)
+            while waiting and waiting[-1][0][2] == done[2]:
+                left, parent_key, parent_value_ref = waiting.pop()
+                done = self._write_subtree(
+                    left, parent_key, parent_value_ref, done)
+        root = done or empty
+        while waiting:
+            left, key, value_ref = waiting.pop()
+            root = self._write_subtree(left, key, value_ref, root)
+        self._commit_root_address(self._storage, root[0].address)
+
+    def _write_subtree(self, left, key, value_ref, right):
+        """Write a node; subtrees are (ref, length, height) triples."""
+        length = left[1] + right[1] + 1
+        height = max(left[2], right[2]) + 1
+        ref = self.node_ref_class(referent=BinaryNode(
+            left[0], key, value_ref, right[0], length))
+        ref.store(self._storage)
+        return self.node_ref_class(address=ref.address), length, height
@@ -0,0 +1,124 @@
+# A Bloom filter answers "might this key be in the database?" from a bit
+# array held in memory. "No" is always right, so a lookup of a missing key
+# can usually stop there, instead of reading a path of nodes from the file.
+# "Maybe" is wrong now and then (a false positive), and the lookup goes on to
+# the tree as before.
+#
+# The filter is kept in a sidecar file next to the database, tagged with the
+# file id and root address that it describes. Deleted keys are never taken
+# out, which only costs false positives. A filter whose tag doesn't match the
+# database's current root, because someone committed without one, isn't
+# trusted, and is rebuilt from the tree by the next writer that commits.
+
+import hashlib
+import math
+import os
+import struct
+
+from dbdb import encoding
+
+DEFAULT_CAPACITY = 1024
+DEFAULT_ERROR_RATE = 0.01
+
+
+class BloomFilter(object):
+    # Magic, file id, root address, capacity, keys added, hash count.
+    HEADER = struct.Struct('!8sQQQQI')
+    MAGIC = b'dbdbbloo'
+
+    def __init__(self, capacity=DEFAULT_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE, file_id=0, root_address=0):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.file_id = file_id
+        self.root_address = root_address
+        self.count = 0
+        # The usual optimum: m = -n ln(p) / ln(2)^2 bits and k = m/n ln(2)
+        # hashes, for n keys and a false positive rate of p.
+        bit_count = int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(
+            bit_count / float(self.capacity) * math.log(2))))
+        self._bits = bytearray((bit_count + 7) // 8)
+
+    @classmethod
+    def from_keys(cls, keys, count, file_id, root_address,
+                  error_rate=DEFAULT_ERROR_RATE):
+        """A filter holding `count` `keys`, with room for as many again."""
+        bloom = cls(max(2 * count, DEFAULT_CAPACITY), error_rate, file_id,
+                    root_address)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    @property
+    def bit_count(self):
+        return len(self._bits) * 8
+
+    def _positions(self, key):
+        tag, data = encoding.pack_key(key)
+        digest = hashlib.blake2b(tag + data, digest_size=16).digest()
+        first, second = struct.unpack('!QQ', digest)
+        # Two hashes are as good as k: positions first + i * second.
+        second |= 1
+        bit_count = self.bit_count
+        return [(first + i * second) % bit_count
+                for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def full(self):
+        return self.count > self.capacity
+
+    @property
+    def expected_false_positive_rate(self):
+        """The false positive rate to expect with as many keys as it has."""
+        return (1 - math.exp(
+            -self.hash_count * self.count / float(self.bit_count))
+        ) ** self.hash_count
+
+    def describes(self, file_id, root_address):
+        return self.file_id == file_id and self.root_address == root_address
+
+    def save(self, path):
+        """Write the filter to `path`, replacing what was there atomically."""
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(self.HEADER.pack(
+                self.MAGIC, self.file_id, self.root_address, self.capacity,
+                self.count, self.hash_count))
+            f.write(self._bits)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def load(cls, path, error_rate=DEFAULT_ERROR_RATE):
+        """Read a filter saved at `path`, or return None if there isn't a
+        whole one."""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        if len(data) < cls.HEADER.size:
+            return None
+        (magic, file_id, root_address, capacity, count,
+         hash_count) = cls.HEADER.unpack_from(data)
+        bloom = cls(capacity, error_rate, file_id, root_address)
+        bits = data[cls.HEADER.size:]
+        if (magic != cls.MAGIC or len(bits) != len(bloom._bits) or
+                hash_count != bloom.hash_count):
+            return None
+        bloom.count = count
+        bloom._bits = bytearray(bits)
+        return bloom
@@ -0,0 +1,383 @@
+import pickle
+import struct
+from bisect import bisect_left, bisect_right
+
+from dbdb import encoding
+from dbdb.logical import LogicalBase, ValueRef
+
+
+# After the header, a page is its kind and key count, a run of addresses (and
+# for branches, child lengths), then the keys.
+PAGE_HEADER = struct.Struct('!cI')
+LEAF_PAGE = b'L'
+BRANCH_PAGE = b'B'
+
+
+class BPlusLeaf(object):
+    is_leaf = True
+
+    def __init__(self, keys, value_refs):
+        self.keys = keys
+        self.value_refs = value_refs
+
+    @property
+    def length(self):
+        return len(self.keys)
+
+    def store_refs(self, storage):
+        for value_ref in self.value_refs:
+            value_ref.store(storage)
+
+    def split(self):
+        middle = len(self.keys) // 2
+        return self.keys[middle], [
+            BPlusLeaf(self.keys[:middle], self.value_refs[:middle]),
+            BPlusLeaf(self.keys[middle:], self.value_refs[middle:]),
+        ]
+
+    def merge(self, separator, other):
+        return BPlusLeaf(
+            self.keys + other.keys, self.value_refs + other.value_refs)
+
+
+class BPlusBranch(object):
+    is_leaf = False
+
+    def __init__(self, keys, child_refs, lengths):
+        # keys[i] is the smallest key under child_refs[i + 1]. Each child's
+        # length is kept here too, so a rewritten branch can count its keys
+        # without loading the children it didn't touch.
+        self.keys = keys
+        self.child_refs = child_refs
+        self.lengths = lengths
+        self.length = sum(lengths)
+
+    def store_refs(self, storage):
+        for child_ref in self.child_refs:
+            child_ref.store(storage)
+
+    def split(self):
+        middle = len(self.keys) // 2
+        return self.keys[middle], [
+            BPlusBranch(
+                self.keys[:middle],
+                self.child_refs[:middle + 1],
+                self.lengths[:middle + 1]),
+            BPlusBranch(
+                self.keys[middle + 1:],
+                self.child_refs[middle + 1:],
+                self.lengths[middle + 1:]),
+        ]
+
+    def merge(self, separator, other):
+        return BPlusBranch(
+            self.keys + [separator] + other.keys,
+            self.child_refs + other.child_refs,
+            self.lengths + other.lengths)
+
+    def replace(self, index, count, separators, child_refs):
+        """Swap `count` children starting at `index` for `child_refs`."""
+        return BPlusBranch(
+            self.keys[:index] + separators + self.keys[index + count - 1:],
+            self.child_refs[:index] + child_refs +
+            self.child_refs[index + count:],
+            self.lengths[:index] + [ref.length for ref in child_refs] +
+            self.lengths[index + count:])
+
+
+def _numbers_format(wide, count):
+    return '!%d%s' % (count, 'Q' if wide else 'I')
+
+
+class BPlusNodeRef(ValueRef):
+    overflows = False
+
+    def prepare_to_store(self, storage):
+        if self._referent:
+            self._referent.store_refs(storage)
+
+    @property
+    def length(self):
+        if self._referent is None and self._address:
+            raise RuntimeError('Asking for BPlusNodeRef length of unloaded node')
+        if self._referent:
+            return self._referent.length
+        else:
+            return 0
+
+    @staticmethod
+    def referent_to_string(referent):
+        count = len(referent.keys)
+        if referent.is_leaf:
+            kind = LEAF_PAGE
+            numbers = [ref.address for ref in referent.value_refs]
+        else:
+            kind = BRANCH_PAGE
+            numbers = ([ref.address for ref in referent.child_refs] +
+                       referent.lengths)
+        wide = encoding.is_wide(numbers)
+        return (
+            encoding.header(wide) +
+            PAGE_HEADER.pack(kind, count) +
+            struct.pack(_numbers_format(wide, len(numbers)), *numbers) +
+            encoding.pack_keys(referent.keys))
+
+    @staticmethod
+    def string_to_referent(string):
+        if not encoding.is_encoded(string):
+            return BPlusNodeRef.pickle_to_referent(string)
+        kind, count = PAGE_HEADER.unpack_from(string, encoding.HEADER_LENGTH)
+        numbers_format = struct.Struct(_numbers_format(
+            encoding.header_is_wide(string),
+            count if kind == LEAF_PAGE else 2 * (count + 1)))
+        offset = encoding.HEADER_LENGTH + PAGE_HEADER.size
+        numbers = numbers_format.unpack_from(string, offset)
+        keys = encoding.unpack_keys(string, offset + numbers_format.size, count)
+        if kind == LEAF_PAGE:
+            return BPlusLeaf(
+                keys, [ValueRef(address=address) for address in numbers])
+        return BPlusBranch(
+            keys,
+            [BPlusNodeRef(address=address)
+             for address in numbers[:count + 1]],
+            list(numbers[count + 1:]),
+        )
+
+    @staticmethod
+    def referent_to_pickle(referent):
+        if referent.is_leaf:
+            return pickle.dumps({
+                'keys': referent.keys,
+                'values': [ref.address for ref in referent.value_refs],
+            })
+        return pickle.dumps({
+            'keys': referent.keys,
+            'children': [ref.address for ref in referent.child_refs],
+            'lengths': referent.lengths,
+        })
+
+    @staticmethod
+    def pickle_to_referent(string):
+        """Read a page written before pages had their own encoding."""
+        d = pickle.loads(string)
+        if 'values' in d:
+            return BPlusLeaf(
+                d['keys'],
+                [ValueRef(address=address) for address in d['values']],
+            )
+        return BPlusBranch(
+            d['keys'],
+            [BPlusNodeRef(address=address) for address in d['children']],
+            d['lengths'],
+        )
+
+
+class BPlusTree(LogicalBase):
+    """A copy-on-write B+tree.
+
+    Nodes are pages of up to `max_keys` keys, so a lookup in a tree of
+    millions of keys only loads three or four of them. Values live outside
+    the leaves, as they do in BinaryTree, so pages stay small enough to
+    rewrite on every update.
+    """
+    node_ref_class = BPlusNodeRef
+    tree_kind = 'bplus'
+    max_keys = 256
+
+    @property
+    def min_keys(self):
+        return self.max_keys // 2
+
+    def _get(self, node, key):
+        while node is not None:
+            if node.is_leaf:
+                index = bisect_left(node.keys, key)
+                if index < len(node.keys) and node.keys[index] == key:
+                    return node.value_refs[index]
+                break
+            node = self._follow(node.child_refs[bisect_right(node.keys, key)])
+        raise KeyError
+
+    def _insert(self, node, key, value_ref):
+        if node is None:
+            return self.node_ref_class(referent=BPlusLeaf([key], [value_ref]))
+        separators, nodes = self._insert_into(node, key, value_ref)
+        if len(nodes) == 1:
+            return self.node_ref_class(referent=nodes[0])
+        # The root split: grow the tree by one level.
+        child_refs = [self.node_ref_class(referent=n) for n in nodes]
+        return self.node_ref_class(referent=BPlusBranch(
+            separators, child_refs, [ref.length for ref in child_refs]))
+
+    def _insert_into(self, node, key, value_ref):
+        if node.is_leaf:
+            index = bisect_left(node.keys, key)
+            if index < len(node.keys) and node.keys[index] == key:
+                new_node = BPlusLeaf(
+                    node.keys,
+                    node.value_refs[:index] + [value_ref] +
+                    node.value_refs[index + 1:])
+            else:
+                new_node = BPlusLeaf(
+                    node.keys[:index] + [key] + node.keys[index:],
+                    node.value_refs[:index] + [value_ref] +
+                    node.value_refs[index:])
+        else:
+            index = bisect_right(node.keys, key)
+            separators, children = self._insert_into(
+                self._follow(node.child_refs[index]), key, value_ref)
+            new_node = node.replace(
+                index, 1, separators,
+                [self.node_ref_class(referent=n) for n in children])
+        return self._fit(new_node)
+
+    def _fit(self, node):
+        if len(node.keys) > self.max_keys:
+            separator, nodes = node.split()
+            return [separator], nodes
+        return [], [node]
+
+    def _delete(self, node, key):
+        if node is None:
+            raise KeyError
+        new_root = self._delete_from(node, key)
+        if new_root.is_leaf and not new_root.keys:
+            return self.node_ref_class()
+        if not new_root.is_leaf and len(new_root.child_refs) == 1:
+            # The root's children merged: shrink the tree by one level.
+            return new_root.child_refs[0]
+        return self.node_ref_class(referent=new_root)
+
+    def _delete_from(self, node, key):
+        if node.is_leaf:
+            index = bisect_left(node.keys, key)
+            if index == len(node.keys) or node.keys[index] != key:
+                raise KeyError
+            return BPlusLeaf(
+                node.keys[:index] + node.keys[index + 1:],
+                node.value_refs[:index] + node.value_refs[index + 1:])
+
+        index = bisect_right(node.keys, key)
+        child = self._delete_from(self._follow(node.child_refs[index]), key)
+        if len(child.keys) >= self.min_keys:
+            return node.replace(
+                index, 1, [], [self.node_ref_class(referent=child)])
+
+        # The child underflowed: merge it with a neighbour, and split the
+        # result again if the neighbour was full enough to share.
+        if index + 1 < len(node.child_refs):
+            low = index
+            merged = child.merge(
+                node.keys[low], self._follow(node.child_refs[index + 1]))
+        else:
+            low = index - 1
+            merged = self._follow(node.child_refs[low]).merge(
+                node.keys[low], child)
+        separators, nodes = self._fit(merged)
+        return node.replace(
+            low, 2, separators,
+            [self.node_ref_class(referent=n) for n in nodes])
+
+    def _items(self, ref, start, stop, reverse):
+        node = self._peek(ref)
+        if node is None:
+            return
+        if node.is_leaf:
+            low = 0 if start is None else bisect_left(node.keys, start)
+            high = (len(node.keys) if stop is None
+                    else bisect_left(node.keys, stop))
+            indexes = range(low, high)
+            for index in reversed(indexes) if reverse else indexes:
+                yield node.keys[index], node.value_refs[index]
+            return
+        # Only the children whose keys overlap the range.
+        low = 0 if start is None else bisect_right(node.keys, start)
+        high = (len(node.child_refs) if stop is None
+                else bisect_left(node.keys, stop) + 1)
+        indexes = range(low, high)
+        for index in reversed(indexes) if reverse else indexes:
+            for item in self._items(
+                    node.child_refs[index], start, stop, reverse):
+                yield item
+
+    def _nth(self, node, index):
+        while not node.is_leaf:
+            for child_ref, length in zip(node.child_refs, node.lengths):
+                if index < length:
+                    break
+                index -= length
+            node = self._peek(child_ref)
+        return node.keys[index], node.value_refs[index]
+
+    def _copy(self, ref, storage):
+        node = ref.peek(self._storage)
+        if node is None:
+            return self.node_ref_class()
+        if node.is_leaf:
+            new_node = BPlusLeaf(node.keys, [
+                self._copy_value(value_ref, storage)
+                for value_ref in node.value_refs])
+        else:
+            new_node = BPlusBranch(node.keys, [
+                self._copy(child_ref, storage)
+                for child_ref in node.child_refs], node.lengths)
+        new_ref = self.node_ref_class(referent=new_node)
+        new_ref.store(storage)
+        return self.node_ref_class(address=new_ref.address)
+
+    def load_sorted(self, pairs):
+        """Write a tree of full pages from sorted pairs, and commit it.
+
+        Each level fills one page at a time, from the left. A full page is
+        only written once the page after it fills up too, so that the last
+        two pages of a level can share their entries evenly if the last one
+        would otherwise be left short.
+        """
+        # Per level, a full page that isn't written yet and the page being
+        # filled. Entries are (first key, ref, length) triples.
+        levels = []
+
+        def add(level, entry):
+            if level == len(levels):
+                levels.append([None, []])
+            held, current = levels[level]
+            current.append(entry)
+            if len(current) == self._page_entries(level):
+                if held is not None:
+                    add(level + 1, self._write_page(level, held))
+                levels[level] = [current, []]
+
+        for key, value_ref in self._sorted_value_refs(pairs):
+            add(0, (key, value_ref, 1))
+
+        root_ref = self.node_ref_class()
+        level = 0
+        while level < len(levels):
+            held, current = levels[level]
+            minimum = self.min_keys + (1 if level else 0)
+            if held is not None and 0 < len(current) < minimum:
+                entries = held + current
+                half = len(entries) // 2
+                pages = [entries[:half], entries[half:]]
+            else:
+                pages = [page for page in (held, current) if page]
+            if level == len(levels) - 1 and len(pages) == 1:
+                root_ref = self._write_page(level, pages[0])[1]
+            else:
+                for page in pages:
+                    add(level + 1, self._write_page(level, page))
+            level += 1
+        self._commit_root_address(self._storage, root_ref.address)
+
+    def _page_entries(self, level):
+        return self.max_keys if level == 0 else self.max_keys + 1
+
+    def _write_page(self, level, entries):
+        keys, refs, lengths = [list(column) for column in zip(*entries)]
+        if level == 0:
+            page = BPlusLeaf(keys, refs)
+        else:
+            page = BPlusBranch(keys[1:], refs, lengths)
+        ref = self.node_ref_class(referent=page)
+        ref.store(self._storage)
+        return keys[0], self.node_ref_class(address=ref.address), page.length
@@ -0,0 +1,71 @@
+# Nodes are never overwritten in the append-only file, so whatever was
+# decoded from an address stays correct for as long as that file exists. That
+# makes a cache keyed by address trivially coherent: nothing ever needs
+# invalidating, things just fall out of the back when the budget runs out.
+
+import threading
+from collections import OrderedDict
+
+
+class NodeCache(object):
+    """A bounded LRU cache of decoded referents, keyed by storage address.
+
+    One instance can be shared by every database opened in the process; keys
+    include the identity of the file, so different files never collide.
+    `max_bytes` is measured in encoded record bytes.
+    """
+
+    DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, referent, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (referent, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,161 @@
+"""A client for dbdb.server.
+
+A Client keeps a pool of connections, so that threads sharing it each get a
+connection of their own without opening a new one per request::
+
+    client = Client('example.db.sock')
+    client['a'] = 'aye'
+    client['a']
+    list(client.items('a', 'b'))
+
+pipeline() sends a whole list of requests before reading any of the
+answers, which saves a round trip per request.
+"""
+import contextlib
+import itertools
+import socket
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from dbdb import protocol
+
+
+class ServerError(RuntimeError):
+    """The server failed a request for a reason other than a missing key."""
+    pass
+
+
+class Connection(object):
+    def __init__(self, path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._reader = self._socket.makefile('rb')
+        self._ids = itertools.count()
+
+    def close(self):
+        self._reader.close()
+        self._socket.close()
+
+    def pipeline(self, requests):
+        """Send (op, args) requests, and return their results in order.
+
+        A failed request's result is the exception it would have raised.
+        """
+        ids = []
+        frames = []
+        for op, args in requests:
+            request_id = next(self._ids)
+            ids.append(request_id)
+            frames.append(protocol.encode_frame([request_id, op, list(args)]))
+        self._socket.sendall(b''.join(frames))
+        results = []
+        for request_id, (op, args) in zip(ids, requests):
+            response_id, status, result = self._read_frame()
+            assert response_id == request_id
+            if status == protocol.OK:
+                results.append(result)
+            elif result[0] == 'KeyError':
+                results.append(KeyError(args[0]))
+            else:
+                results.append(ServerError('%s: %s' % tuple(result)))
+        return results
+
+    def call(self, op, *args):
+        result, = self.pipeline([(op, args)])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _read_frame(self):
+        header = self._reader.read(protocol.FRAME_HEADER.size)
+        if len(header) < protocol.FRAME_HEADER.size:
+            raise EOFError('Server closed the connection.')
+        length, = protocol.FRAME_HEADER.unpack(header)
+        return protocol.decode_frame(self._reader.read(length))
+
+
+class ConnectionPool(object):
+    def __init__(self, path, size=8):
+        self._path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, waiting while `size` are already lent out."""
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = Connection(self._path)
+            try:
+                yield connection
+            except Exception:
+                # It may be half way through a request: don't reuse it.
+                connection.close()
+                raise
+            else:
+                self._idle.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Client(object):
+    def __init__(self, path, pool_size=8):
+        self._pool = ConnectionPool(path, pool_size)
+
+    def close(self):
+        self._pool.close()
+
+    def _call(self, op, *args):
+        result, = self.pipeline([(op, args)])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def pipeline(self, requests):
+        with self._pool.connection() as connection:
+            return connection.pipeline(requests)
+
+    def __getitem__(self, key):
+        return self._call('get', key)
+
+    def __setitem__(self, key, value):
+        self._call('set', key, value)
+
+    def __delitem__(self, key):
+        self._call('delete', key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __len__(self):
+        return self._call('len')
+
+    def items(self, start=None, stop=None):
+        """Yield (key, value) for start <= key < stop, a page at a time."""
+        while True:
+            pairs = self._call('scan', start, stop, protocol.SCAN_LIMIT)
+            for key, value in pairs:
+                yield key, value
+            if len(pairs) < protocol.SCAN_LIMIT:
+                return
+            start = protocol.key_after(pairs[-1][0])
+
+    def keys(self, start=None, stop=None):
+        for key, value in self.items(start, stop):
+            yield key
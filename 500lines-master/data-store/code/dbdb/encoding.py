@@ -0,0 +1,191 @@
+# Nodes used to be pickled dicts, which spend most of their bytes spelling out
+# the same key names over and over. Encoded nodes are instead a fixed struct
+# of addresses and counts, followed by the key bytes.
+#
+# Every encoded node starts with a three byte header: a zero byte, which never
+# starts a pickle, the format version, and the width of the integers in the
+# struct that follows: 'I' while they all fit in 32 bits, 'Q' once the file
+# has grown past 4GB. Anything without the header is taken to be a pickle
+# written by an older dbdb.
+
+import codecs
+import pickle
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+VERSION = 1
+PREFIX = b'\x00' + struct.pack('!B', VERSION)
+NARROW = b'I'
+WIDE = b'Q'
+HEADER_LENGTH = len(PREFIX) + 1
+NARROW_LIMIT = 2 ** 32
+
+# Keys are tagged with their type so that they come back as they went in.
+TEXT_KEY = b's'
+BYTES_KEY = b'b'
+INT_KEY = b'i'
+PICKLED_KEY = b'p'
+INT_FORMAT = struct.Struct('!q')
+INT_LIMIT = 2 ** 63
+
+text_type = type(u'')
+
+
+def is_encoded(string):
+    return string[:len(PREFIX)] == PREFIX
+
+
+def is_wide(numbers):
+    return max(numbers) >= NARROW_LIMIT
+
+
+def header(wide):
+    return PREFIX + (WIDE if wide else NARROW)
+
+
+def header_is_wide(string):
+    return string[len(PREFIX):HEADER_LENGTH] == WIDE
+
+
+def _key_tag(key):
+    if isinstance(key, text_type):
+        return TEXT_KEY
+    elif isinstance(key, bytes):
+        return BYTES_KEY
+    elif type(key) is int and -INT_LIMIT <= key < INT_LIMIT:
+        return INT_KEY
+    return PICKLED_KEY
+
+
+def pack_key(key):
+    """Return the tag and the bytes for a single key."""
+    tag = _key_tag(key)
+    if tag == TEXT_KEY:
+        return tag, key.encode('utf-8')
+    elif tag == BYTES_KEY:
+        return tag, key
+    elif tag == INT_KEY:
+        return tag, INT_FORMAT.pack(key)
+    return tag, pickle.dumps(key)
+
+
+def unpack_key(tag, data):
+    if tag == TEXT_KEY:
+        return codecs.decode(data, 'utf-8')
+    elif tag == BYTES_KEY:
+        return bytes(data)
+    elif tag == INT_KEY:
+        return INT_FORMAT.unpack(data)[0]
+    return pickle.loads(data)
+
+
+# A page of keys starts with a tag and a layout. Text and bytes keys are
+# usually joined with NUL separators (layout 'z'), after the total length, so
+# that they can be split apart again in one call. Keys that contain NULs
+# instead follow a run of their lengths ('H' or 'I' wide). Integer keys are a
+# run of 64 bit integers. Anything else, including a mixture of types, is one
+# pickled list.
+BLOCK_HEADER = struct.Struct('!cc')
+JOINED = b'z'
+LENGTH_FORMAT = struct.Struct('!I')
+
+
+def pack_keys(keys):
+    types = set(map(type, keys))
+    if types == set([int]) and -INT_LIMIT <= min(keys) and \
+            max(keys) < INT_LIMIT:
+        return BLOCK_HEADER.pack(INT_KEY, b'q') + struct.pack(
+            '!%dq' % len(keys), *keys)
+    elif types == set([text_type]):
+        tag, separator = TEXT_KEY, u'\x00'
+    elif types == set([bytes]):
+        tag, separator = BYTES_KEY, b'\x00'
+    else:
+        data = pickle.dumps(list(keys))
+        return (BLOCK_HEADER.pack(PICKLED_KEY, JOINED) +
+                LENGTH_FORMAT.pack(len(data)) + data)
+
+    data = separator.join(keys)
+    if data.count(separator) == len(keys) - 1:
+        if tag == TEXT_KEY:
+            data = data.encode('utf-8')
+        return (BLOCK_HEADER.pack(tag, JOINED) +
+                LENGTH_FORMAT.pack(len(data)) + data)
+    if tag == TEXT_KEY:
+        keys = [key.encode('utf-8') for key in keys]
+    lengths = list(map(len, keys))
+    width = b'H' if max(lengths) < 2 ** 16 else b'I'
+    return (BLOCK_HEADER.pack(tag, width) +
+            struct.pack('!%d%s' % (len(lengths), width.decode()), *lengths) +
+            b''.join(keys))
+
+
+def unpack_keys(string, offset, count):
+    tag, layout = BLOCK_HEADER.unpack_from(string, offset)
+    offset += BLOCK_HEADER.size
+    if tag == INT_KEY:
+        return list(struct.unpack_from('!%dq' % count, string, offset))
+    elif layout == JOINED:
+        length, = LENGTH_FORMAT.unpack_from(string, offset)
+        start = offset + LENGTH_FORMAT.size
+        data = string[start:start + length]
+        if tag == PICKLED_KEY:
+            return pickle.loads(data)
+        elif not count:
+            return []
+        elif tag == TEXT_KEY:
+            return codecs.decode(data, 'utf-8').split(u'\x00')
+        return bytes(data).split(b'\x00')
+
+    length_format = struct.Struct('!%d%s' % (count, layout.decode()))
+    lengths = length_format.unpack_from(string, offset)
+    start = offset + length_format.size
+    keys = []
+    for length in lengths:
+        end = start + length
+        keys.append(unpack_key(tag, string[start:end]))
+        start = end
+    return keys
+
+
+# Values are stored as bare UTF-8, unless they're compressed. A compressed
+# value starts with the header prefix and a byte naming its compressor. A
+# bare value that happens to start with the prefix gets the RAW_VALUE byte,
+# so that it isn't mistaken for one.
+RAW_VALUE = b'r'
+ZLIB_VALUE = b'z'
+LZMA_VALUE = b'x'
+COMPRESSORS = {'zlib': (ZLIB_VALUE, zlib.compress)}
+DECOMPRESSORS = {ZLIB_VALUE: zlib.decompress}
+if lzma is not None:
+    COMPRESSORS['lzma'] = (LZMA_VALUE, lzma.compress)
+    DECOMPRESSORS[LZMA_VALUE] = lzma.decompress
+# Shorter values seldom come out any smaller.
+COMPRESS_MIN_LENGTH = 64
+
+
+def pack_value(value, compression=None):
+    data = value.encode('utf-8')
+    if compression is not None and len(data) >= COMPRESS_MIN_LENGTH:
+        tag, compress = COMPRESSORS[compression]
+        packed = compress(data)
+        if len(packed) + HEADER_LENGTH < len(data):
+            return PREFIX + tag + packed
+    if is_encoded(data):
+        return PREFIX + RAW_VALUE + data
+    return data
+
+
+def unpack_value(data):
+    if not is_encoded(data):
+        return codecs.decode(data, 'utf-8')
+    tag = bytes(data[len(PREFIX):HEADER_LENGTH])
+    body = data[HEADER_LENGTH:]
+    if tag != RAW_VALUE:
+        body = DECOMPRESSORS[tag](body)
+    return codecs.decode(body, 'utf-8')
@@ -1,35 +1,486 @@
+import contextlib
+import os
+import threading
+
+from dbdb.avl_tree import AVLTree
 from dbdb.binary_tree import BinaryTree
-from dbdb.physical import Storage
+from dbdb.bloom import BloomFilter
+from dbdb.bplus_tree import BPlusTree
+from dbdb.physical import NO_SYNC, Storage
+
+try:
+    _unichr = unichr
+except NameError:
+    _unichr = chr
+
+LAST_CHARACTER = u'\U0010ffff'
+
+# The tree classes, by the kind recorded in the files they write.
+TREES = dict((tree_class.tree_kind, tree_class)
+             for tree_class in [BinaryTree, AVLTree, BPlusTree])
+
+
+class ConflictError(RuntimeError):
+    """Raised when a transaction keeps losing to other writers."""
+    pass
 
 
 class DBDB(object):
 
-    def __init__(self, f):
-        self._storage = Storage(f)
-        self._tree = BinaryTree(self._storage)
+    def __init__(self, f, tree_class=None, cache=None,
+                 storage_class=Storage, group_commit=False,
+                 durability=NO_SYNC, sync_interval=1.0, compression=None,
+                 overflow_threshold=None, bloom_path=None):
+        self._storage = storage_class(
+            f, durability=durability, sync_interval=sync_interval,
+            overflow_threshold=overflow_threshold)
+        if tree_class is None:
+            tree_class = TREES.get(self._storage.tree_kind, BinaryTree)
+        self._tree = tree_class(
+            self._storage, cache=cache, compression=compression)
+        # Threads sharing this DBDB take turns with the tree and the file.
+        self._lock = threading.RLock()
+        self._group_commit = group_commit
+        # With group commit, whether a thread is part way through one, and
+        # where the others wait for it to finish.
+        self._committing = False
+        self._commit_done = threading.Condition(self._lock)
+        self._changes = 0
+        self._committed_changes = 0
+        self._batch_depth = 0
+        self._read_only_storage = None
+        # An optional Bloom filter, saved at `bloom_path`, that answers most
+        # lookups of missing keys without reading the tree. Keys set since
+        # the last commit aren't in it yet.
+        self._bloom_path = bloom_path
+        self._bloom = None
+        self._bloom_pending = set()
+        self._bloom_negatives = 0
+        self._bloom_false_positives = 0
+        self._bloom_stale = 0
+        self._bloom_checked = None
+        if bloom_path is not None:
+            self._bloom = BloomFilter.load(bloom_path)
+            if not self._bloom_is_current():
+                self._rebuild_bloom()
 
     def _assert_not_closed(self):
         if self._storage.closed:
             raise ValueError('Database closed.')
 
     def close(self):
-        self._storage.close()
+        with self._lock:
+            self._wait_for_commit()
+            if self._read_only_storage not in (None, self._storage):
+                self._read_only_storage.close()
+            self._storage.close()
 
-    def commit(self):
-        self._assert_not_closed()
-        self._tree.commit()
+    def commit(self, unlock=True):
+        """Commit every change so far.
+
+        With `unlock` false, other writers are kept waiting until rollback()
+        is called, which then has nothing to throw away.
+
+        With group commit, threads that commit while another thread's
+        commit is syncing wait for it, and then one of them commits all
+        their changes with one sync, while the rest find theirs committed.
+        """
+        if self._group_commit:
+            return self._commit_in_group(unlock)
+        with self._lock:
+            self._assert_not_closed()
+            if self._bloom is None:
+                self._tree.commit(unlock)
+            else:
+                base = self._bloom_tag()
+                self._tree.commit(unlock)
+                self._update_bloom(
+                    base, self._tree.root_address, self._bloom_pending)
+                self._bloom_pending = set()
+            self._committed_changes = self._changes
+
+    def _wait_for_commit(self):
+        while self._committing:
+            self._commit_done.wait()
+
+    def _commit_in_group(self, unlock):
+        with self._lock:
+            self._assert_not_closed()
+            target = self._changes
+            while self._committing and self._committed_changes < target:
+                self._commit_done.wait()
+            self._assert_not_closed()
+            if self._committed_changes >= target:
+                # Another thread's commit took our changes with it.
+                if unlock and not self._committing and not self.dirty:
+                    # Let go of the lock, if lock() took it.
+                    self._storage.unlock()
+                return
+            self._committing = True
+        try:
+            self._lead_commit(target, unlock)
+        finally:
+            with self._lock:
+                self._committing = False
+                self._commit_done.notify_all()
+
+    def _lead_commit(self, target, unlock):
+        # Syncs are made without holding self._lock, so that other threads
+        # can carry on making changes, and queue up to commit them next.
+        storage = self._storage
+        with self._lock:
+            base = self._bloom_tag() if self._bloom is not None else None
+            begun = self._tree.begin_commit()
+            if begun is None:
+                self._committed_changes = target
+                return
+            root_address, commit_address = begun
+            # Keys set from here on belong to the next commit.
+            keys, self._bloom_pending = self._bloom_pending, set()
+        try:
+            if storage.syncs_each_commit:
+                storage.sync_flushed()
+            with self._lock:
+                storage.finish_commit(root_address, commit_address)
+            if storage.syncs_each_commit:
+                storage.sync_flushed()
+        except BaseException:
+            with self._lock:
+                self._bloom_pending |= keys
+            raise
+        with self._lock:
+            if base is not None:
+                self._update_bloom(base, root_address, keys)
+            self._committed_changes = target
+            if unlock and not self.dirty:
+                # Changes made since begin_commit() were made under the lock,
+                # on top of this commit, and so have to keep it.
+                storage.unlock()
+
+    @property
+    def dirty(self):
+        """Whether there are changes that haven't been committed."""
+        return self._changes != self._committed_changes
+
+    def lock(self):
+        """Take the file's write lock now, rather than with the first
+        change, so that no other writer commits in between."""
+        with self._lock:
+            self._assert_not_closed()
+            self._tree.lock()
+
+    def prepare_commit(self):
+        """Write out and sync the changes so far, keeping the lock, but
+        don't commit them yet.
+
+        Returns the root address as committed, and the root address that
+        commit() will make it.
+        """
+        with self._lock:
+            self._assert_not_closed()
+            self._tree.lock()
+            committed = self._storage.get_root_address()
+            root_address = self._tree.store()
+            self._storage.sync()
+            return committed, root_address
+
+    def rollback(self):
+        """Throw away the changes since the last commit, and unlock."""
+        with self._lock:
+            self._wait_for_commit()
+            self._assert_not_closed()
+            self._tree.rollback()
+            self._bloom_pending = set()
+            self._committed_changes = self._changes
+
+    def sync(self):
+        """Make sure everything committed so far is on the disk."""
+        with self._lock:
+            self._assert_not_closed()
+            self._storage.sync()
+
+    def _bloom_tag(self):
+        # Which commit a filter has to describe to be of use.
+        return self._storage.identity[-1], self._storage.get_root_address()
+
+    def _bloom_is_current(self):
+        return (self._bloom is not None and
+                self._bloom.describes(*self._bloom_tag()))
+
+    def _bloom_mtime(self):
+        try:
+            return os.stat(self._bloom_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _update_bloom(self, base, root_address, keys):
+        # The filter from the commit we built on, plus the `keys` we've set,
+        # is the filter for our commit. Without one, or once it's over capacity,
+        # the filter is built afresh.
+        bloom = self._bloom
+        if not bloom.describes(*base):
+            bloom = BloomFilter.load(self._bloom_path)
+        if bloom is None or not bloom.describes(*base) or bloom.full:
+            self._rebuild_bloom()
+        else:
+            for key in keys:
+                bloom.add(key)
+            bloom.file_id = self._storage.identity[-1]
+            bloom.root_address = root_address
+            bloom.save(self._bloom_path)
+            self._bloom = bloom
+
+    def _rebuild_bloom(self):
+        snapshot = self._tree.snapshot()
+        self._bloom = BloomFilter.from_keys(
+            snapshot.keys(), len(snapshot), self._storage.identity[-1],
+            snapshot.root_address)
+        self._bloom.save(self._bloom_path)
+
+    def _bloom_might_contain(self, key):
+        """False if `key` is certainly missing, True if the filter can't
+        tell, or None if there's no filter to ask."""
+        if self._bloom is None or key in self._bloom_pending:
+            return None
+        tag = self._bloom_tag()
+        if not self._bloom.describes(*tag):
+            # Someone committed since; they may have saved its filter. It's
+            # only worth reading again once there's another commit or the
+            # file has been saved since.
+            checked = tag, self._bloom_mtime()
+            if checked != self._bloom_checked:
+                self._bloom_checked = checked
+                self._bloom = (BloomFilter.load(self._bloom_path) or
+                               self._bloom)
+            if not self._bloom.describes(*tag):
+                self._bloom_stale += 1
+                return None
+        if key in self._bloom:
+            return True
+        self._bloom_negatives += 1
+        return False
+
+    def bloom_stats(self):
+        """Counts of what the Bloom filter has answered, or None without
+        one.
+
+        `false_positive_rate` is the share of lookups of missing keys that
+        the filter let through to the tree; `stale` counts lookups that
+        couldn't use it because another writer committed without updating
+        it.
+        """
+        if self._bloom_path is None:
+            return None
+        with self._lock:
+            missing = self._bloom_negatives + self._bloom_false_positives
+            return {
+                'negatives': self._bloom_negatives,
+                'false_positives': self._bloom_false_positives,
+                'false_positive_rate': (
+                    float(self._bloom_false_positives) / missing
+                    if missing else 0.0),
+                'expected_false_positive_rate':
+                    self._bloom.expected_false_positive_rate,
+                'stale': self._bloom_stale,
+                'keys': self._bloom.count,
+                'capacity': self._bloom.capacity,
+                'bits': self._bloom.bit_count,
+            }
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Make the sets and deletes in a `with` block one commit.
+
+        If the block raises, or the commit does, its changes are thrown away
+        instead. A batch with no changes commits nothing. A batch inside
+        another batch just becomes part of it.
+        """
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                if self._batch_depth == 1:
+                    self.rollback()
+                raise
+            else:
+                if self._batch_depth == 1:
+                    self._commit_batch()
+            finally:
+                self._batch_depth -= 1
+
+    def _commit_batch(self):
+        if not self.dirty:
+            # Just let go of the lock, if the block took it.
+            self.rollback()
+            return
+        try:
+            self.commit()
+        except BaseException:
+            self.rollback()
+            raise
+
+    def snapshot(self):
+        """Return a read-only view of the database as of the last commit.
+
+        Nothing is ever overwritten in place, so a snapshot reads straight
+        out of an mmap of the file, without locks, however much gets
+        committed after it.
+        """
+        with self._lock:
+            self._assert_not_closed()
+            if self._read_only_storage is None:
+                self._read_only_storage = self._storage.read_only()
+            return Snapshot(self._tree.snapshot(self._read_only_storage))
+
+    def transaction(self, function, retries=10):
+        """Call `function` with a Transaction, and commit what it wrote.
+
+        The function runs without holding any lock, reading from a snapshot.
+        If other writers commit meanwhile, its writes still go in on top of
+        theirs, as long as none of the keys it read or wrote were changed.
+        Otherwise it is run again on a fresh snapshot, up to `retries` more
+        times, before ConflictError is raised. Returns what `function`
+        returned.
+
+        Changes not yet committed would go in with the transaction's, so
+        there mustn't be any: ValueError is raised if there are.
+        """
+        with self._lock:
+            self._assert_not_closed()
+            if self.dirty:
+                raise ValueError(
+                    'Commit or roll back changes before a transaction.')
+        for attempt in range(retries + 1):
+            transaction = Transaction(self.snapshot())
+            result = function(transaction)
+            with self._lock:
+                self._assert_not_closed()
+                if not self._tree.changed_keys(
+                        transaction.snapshot.tree, transaction.keys()):
+                    for key, value in transaction.writes.items():
+                        if value is _DELETED:
+                            self._tree.pop(key)
+                        else:
+                            self._tree.set(key, value)
+                            self._note_set(key)
+                        self._changes += 1
+                    self.commit()
+                    return result
+                if not self.dirty:
+                    # Let other writers go ahead while we try again. Changes
+                    # another thread made meanwhile keep the lock until
+                    # they're committed.
+                    self._tree.rollback()
+                    self._bloom_pending = set()
+        raise ConflictError(
+            'Transaction conflicted with other writers %d times.' %
+            (retries + 1))
 
     def __getitem__(self, key):
-        self._assert_not_closed()
-        return self._tree.get(key)
+        with self._lock:
+            self._assert_not_closed()
+            might_contain = self._bloom_might_contain(key)
+            if might_contain is False:
+                raise KeyError(key)
+            try:
+                return self._tree.get(key)
+            except KeyError:
+                if might_contain:
+                    self._bloom_false_positives += 1
+                raise
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
     def __setitem__(self, key, value):
-        self._assert_not_closed()
-        return self._tree.set(key, value)
+        with self._lock:
+            self._assert_not_closed()
+            self._tree.set(key, value)
+            self._note_set(key)
+            self._changes += 1
+
+    def _note_set(self, key):
+        if self._bloom is not None:
+            self._bloom_pending.add(key)
 
     def __delitem__(self, key):
+        with self._lock:
+            self._assert_not_closed()
+            self._tree.pop(key)
+            self._changes += 1
+
+    def items(self, start=None, stop=None, reverse=False):
+        """Yield (key, value) for start <= key < stop, in key order.
+
+        Either end can be left open. Nodes are read lazily, and other
+        threads can use the database between one item and the next.
+        """
+        return self._locked_scan(
+            self._tree.items(start, stop, reverse))
+
+    def keys(self, start=None, stop=None, reverse=False):
+        return self._locked_scan(self._tree.keys(start, stop, reverse))
+
+    def prefix_items(self, prefix, reverse=False):
+        """Yield (key, value) for each key that starts with `prefix`."""
+        return self.items(prefix, _prefix_stop(prefix), reverse)
+
+    def nth(self, index):
+        """Return the (key, value) pair at `index` in key order."""
+        with self._lock:
+            self._assert_not_closed()
+            return self._tree.nth(index)
+
+    def _locked_scan(self, items):
+        while True:
+            with self._lock:
+                self._assert_not_closed()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def __iter__(self):
+        return self.keys()
+
+    def __reversed__(self):
+        return self.keys(reverse=True)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tree)
+
+
+class Snapshot(object):
+    """The database as it was at one commit. See DBDB.snapshot()."""
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    @property
+    def root_address(self):
+        return self.tree.root_address
+
+    def _assert_not_closed(self):
+        if self.tree._storage.closed:
+            raise ValueError('Database closed.')
+
+    def __getitem__(self, key):
         self._assert_not_closed()
-        return self._tree.pop(key)
+        return self.tree.get(key)
 
     def __contains__(self, key):
         try:
@@ -40,4 +491,91 @@ class DBDB(object):
             return True
 
     def __len__(self):
-        return len(self._tree)
+        self._assert_not_closed()
+        return len(self.tree)
+
+    def items(self, start=None, stop=None, reverse=False):
+        self._assert_not_closed()
+        return self.tree.items(start, stop, reverse)
+
+    def keys(self, start=None, stop=None, reverse=False):
+        self._assert_not_closed()
+        return self.tree.keys(start, stop, reverse)
+
+    def prefix_items(self, prefix, reverse=False):
+        return self.items(prefix, _prefix_stop(prefix), reverse)
+
+    def nth(self, index):
+        self._assert_not_closed()
+        return self.tree.nth(index)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __reversed__(self):
+        return self.keys(reverse=True)
+
+
+# Marks a key deleted by a transaction.
+_DELETED = object()
+
+
+class Transaction(object):
+    """Reads from a snapshot, and holds on to writes until they commit.
+
+    Only point reads are tracked for conflicts, so there are no scans here;
+    scan `snapshot` directly if a changed range needn't force a retry.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.reads = set()
+        self.writes = {}
+
+    def keys(self):
+        """Every key read or written, which nobody else may have changed."""
+        return self.reads | set(self.writes)
+
+    def __getitem__(self, key):
+        if key in self.writes:
+            value = self.writes[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        self.reads.add(key)
+        return self.snapshot[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def __setitem__(self, key, value):
+        self.writes[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self.writes[key] = _DELETED
+
+
+def _prefix_stop(prefix):
+    """The smallest key after all the keys starting with `prefix`, if any."""
+    if isinstance(prefix, bytes):
+        stop = bytearray(prefix.rstrip(b'\xff'))
+        if not stop:
+            return None
+        stop[-1] += 1
+        return bytes(stop)
+    stop = prefix.rstrip(LAST_CHARACTER)
+    if not stop:
+        return None
+    return stop[:-1] + _unichr(ord(stop[-1]) + 1)
@@ -1,14 +1,33 @@
+import copy
+
+from dbdb import encoding
+
+
+class WrongTreeError(ValueError):
+    """Raised when a file is opened as a different kind of tree than it
+    was written with."""
+    pass
+
+
 class ValueRef(object):
+    # The name of a compressor in encoding.COMPRESSORS, for values written
+    # through this class. Any value can be read, however it was written.
+    compression = None
+    # Whether what's stored may go to the storage's overflow segment. Node
+    # refs turn this off.
+    overflows = True
+
     def prepare_to_store(self, storage):
         pass
 
-    @staticmethod
-    def referent_to_string(referent):
-        return referent.encode('utf-8')
+    @classmethod
+    def referent_to_string(cls, referent):
+        return encoding.pack_value(referent, cls.compression)
 
     @staticmethod
     def string_to_referent(string):
-        return string.decode('utf-8')
+        # Decoding takes any buffer, including Storage.read()'s memoryviews.
+        return encoding.unpack_value(string)
 
     def __init__(self, referent=None, address=0):
         self._referent = referent
@@ -18,56 +37,245 @@ class ValueRef(object):
     def address(self):
         return self._address
 
-    def get(self, storage):
+    def get(self, storage, cache=None):
         if self._referent is None and self._address:
-            self._referent = self.string_to_referent(storage.read(self._address))
+            self._referent = self._load(storage, cache)
         return self._referent
 
+    def peek(self, storage, cache=None):
+        """Like get(), but don't hold on to a referent read from storage."""
+        if self._referent is None and self._address:
+            return self._load(storage, cache)
+        return self._referent
+
+    def _load(self, storage, cache):
+        if cache is None:
+            return self.string_to_referent(storage.read(self._address))
+        key = (storage.identity, self._address)
+        referent = cache.get(key)
+        if referent is None:
+            string = storage.read(self._address)
+            referent = self.string_to_referent(string)
+            cache.put(key, referent, len(string))
+        return referent
+
     def store(self, storage):
         if self._referent is not None and not self._address:
             self.prepare_to_store(storage)
-            self._address = storage.write(self.referent_to_string(self._referent))
+            string = self.referent_to_string(self._referent)
+            if self.overflows:
+                self._address = storage.write_value(string)
+            else:
+                self._address = storage.write(string)
+
+
+_compressed_value_ref_classes = {}
+
+
+def compressed_value_ref_class(value_ref_class, compression):
+    """A subclass of `value_ref_class` that compresses what it stores."""
+    if compression not in encoding.COMPRESSORS:
+        raise ValueError('Unknown compression: %r' % (compression,))
+    key = (value_ref_class, compression)
+    if key not in _compressed_value_ref_classes:
+        _compressed_value_ref_classes[key] = type(
+            'Compressed' + value_ref_class.__name__, (value_ref_class,),
+            {'compression': compression})
+    return _compressed_value_ref_classes[key]
 
 
 class LogicalBase(object):
     node_ref_class = None  # 类属性，非实例属性，实例无法直接访问
     value_ref_class = ValueRef
+    # What files written by this class say they hold.
+    tree_kind = None
+    # A snapshot's root never moves on to later commits.
+    _pinned = False
 
-    def __init__(self, storage):
+    def __init__(self, storage, cache=None, compression=None):
+        if storage.tree_kind not in (None, self.tree_kind):
+            raise WrongTreeError(
+                'The database holds a %r tree, not a %r one.' %
+                (storage.tree_kind, self.tree_kind))
         self._storage = storage
+        self._cache = cache
+        if compression is not None:
+            self.value_ref_class = compressed_value_ref_class(
+                self.value_ref_class, compression)
         self._refresh_tree_ref()
 
-    def commit(self):
+    def lock(self):
+        """Take the write lock, catching up with the latest commit."""
+        if self._storage.lock():
+            self._refresh_tree_ref()  # 获取最新视图
+
+    def store(self):
+        """Write out every new node, and return the root's address."""
         self._tree_ref.store(self._storage)
-        self._storage.commit_root_address(self._tree_ref.address)
+        return self._tree_ref.address
+
+    def commit(self, unlock=True):
+        if not self._storage.locked:
+            # Nothing was set or popped, and a root read without the lock
+            # may be older than someone else's commit: leave theirs be.
+            return
+        self._commit_root_address(self._storage, self.store(), unlock)
+
+    def begin_commit(self):
+        """Write out every new node, as the first half of a commit that
+        Storage.finish_commit() completes.
+
+        Returns the root address and what to pass finish_commit(), or None
+        if there's nothing to commit.
+        """
+        if not self._storage.locked:
+            return None
+        root_address = self.store()
+        self._storage.record_tree_kind(self.tree_kind)
+        return root_address, self._storage.begin_commit(root_address)
+
+    def _commit_root_address(self, storage, root_address, unlock=True):
+        storage.record_tree_kind(self.tree_kind)
+        storage.commit_root_address(root_address, unlock=unlock)
+
+    def rollback(self):
+        """Throw away everything set or popped since the last commit."""
+        self._refresh_tree_ref()
+        self._storage.unlock()
 
     def _refresh_tree_ref(self):  # 最新视图在硬盘上存的数据库文件上
         self._tree_ref = self.node_ref_class(
             address=self._storage.get_root_address())
 
-    def get(self, key):
-        if not self._storage.locked:
+    def _refresh_for_read(self):
+        # A writer reads its own changes, and a snapshot its own root; anyone
+        # else reads the latest commit.
+        if not self._storage.locked and not self._pinned:
             self._refresh_tree_ref()  # 获取最新视图
-        return self._get(self._follow(self._tree_ref), key)
+
+    def get(self, key):
+        self._refresh_for_read()
+        return self._follow(self._get(self._follow(self._tree_ref), key))
+
+    def snapshot(self, storage=None):
+        """Return a read-only copy of this tree, as of the last commit.
+
+        Committed nodes are never overwritten, so the copy can keep reading
+        from its root however many commits come after it. It reads through
+        `storage` if given, which must be onto the same file.
+        """
+        snapshot = copy.copy(self)
+        snapshot._pinned = True
+        snapshot._storage = storage or self._storage
+        snapshot._tree_ref = self.node_ref_class(
+            address=snapshot._storage.get_root_address())
+        return snapshot
+
+    @property
+    def root_address(self):
+        return self._tree_ref.address
+
+    def changed_keys(self, snapshot, keys):
+        """Lock for writing, and return which of `keys` have changed since
+        `snapshot` was taken.
+
+        A key has changed if it now has a different value record, or has been
+        added or deleted.
+        """
+        self.lock()
+        if self._tree_ref.address == snapshot.root_address:
+            return []
+        return [key for key in keys
+                if self._value_address(key) != snapshot._value_address(key)]
+
+    def _value_address(self, key):
+        try:
+            return self._get(self._follow(self._tree_ref), key).address
+        except KeyError:
+            return 0
 
     def set(self, key, value):
-        if self._storage.lock():
-            self._refresh_tree_ref()  # 获取最新视图
+        self.lock()
         self._tree_ref = self._insert(
             self._follow(self._tree_ref), key, self.value_ref_class(value))
 
     def pop(self, key):
-        if self._storage.lock():
-            self._refresh_tree_ref()  # 获取最新视图
+        self.lock()
         self._tree_ref = self._delete(
             self._follow(self._tree_ref), key)
 
+    def items(self, start=None, stop=None, reverse=False):
+        """Yield (key, value) for start <= key < stop, in key order.
+
+        Nodes are read one at a time as the scan reaches them, and the scan
+        sees the tree as it was when it started.
+        """
+        self._refresh_for_read()
+        for key, value_ref in self._items(
+                self._tree_ref, start, stop, reverse):
+            yield key, self._peek(value_ref)
+
+    def keys(self, start=None, stop=None, reverse=False):
+        """Like items(), without reading any of the values."""
+        self._refresh_for_read()
+        for key, value_ref in self._items(
+                self._tree_ref, start, stop, reverse):
+            yield key
+
+    def nth(self, index):
+        """Return the (key, value) pair with `index` smaller keys."""
+        self._refresh_for_read()
+        root = self._peek(self._tree_ref)
+        length = root.length if root else 0
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('Index out of range: %r' % index)
+        key, value_ref = self._nth(root, index)
+        return key, self._peek(value_ref)
+
+    def copy_to(self, storage):
+        """Write just the live part of this tree into `storage`, and commit.
+
+        Nodes go out in tree order, so every subtree ends up in one
+        contiguous run of the new file.
+        """
+        self._commit_root_address(
+            storage, self._copy(self._tree_ref, storage).address)
+
+    def _sorted_value_refs(self, pairs):
+        """Write out each value in turn, checking that keys go up."""
+        previous = missing = object()
+        for key, value in pairs:
+            if previous is not missing and not previous < key:
+                raise ValueError(
+                    'Keys must be unique and in ascending order: %r' % (key,))
+            previous = key
+            value_ref = self.value_ref_class(referent=value)
+            value_ref.store(self._storage)
+            yield key, self.value_ref_class(address=value_ref.address)
+
+    def _copy_value(self, value_ref, storage):
+        new_ref = self.value_ref_class(referent=value_ref.peek(self._storage))
+        new_ref.store(storage)
+        return self.value_ref_class(address=new_ref.address)
+
     def _follow(self, ref):
-        return ref.get(self._storage)
+        if self._storage.locked and not self._pinned:
+            # A writer builds its new nodes out of the ones it reads, so it
+            # keeps them on the refs it followed.
+            return ref.get(self._storage, self._cache)
+        # Readers don't: a node held in the shared cache would otherwise
+        # pin every node ever read beneath it, whatever the cache's budget.
+        return ref.peek(self._storage, self._cache)
+
+    def _peek(self, ref):
+        # Scans never keep what they read, even for a writer, so that walking
+        # a huge range doesn't pull the whole tree into memory.
+        return ref.peek(self._storage, self._cache)
 
     def __len__(self):
-        if not self._storage.locked:
-            self._refresh_tree_ref()
+        self._refresh_for_read()
         root = self._follow(self._tree_ref)
         if root:
             return root.length
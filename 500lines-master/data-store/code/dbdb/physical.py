@@ -6,20 +6,98 @@
 # (Degenerate because you can't pick the keys, and it never releases storage,
 # even when it becomes unreachable!)
 
+import io
+import mmap
 import os
 import struct
+import threading
+import time
+import zlib
 
 import portalocker
 
 
+class RetiredStorageError(RuntimeError):
+    """Raised when locking a file that compaction has replaced."""
+    pass
+
+
+class CorruptRecordError(IOError):
+    """Raised when a record doesn't match its checksum."""
+    pass
+
+
+# When commits reach the disk. With NO_SYNC that's up to the OS; with
+# SYNC_EACH_COMMIT, before commit returns; with SYNC_PERIODICALLY, within
+# `sync_interval` seconds of the commit.
+NO_SYNC = 'none'
+SYNC_EACH_COMMIT = 'commit'
+SYNC_PERIODICALLY = 'periodic'
+DURABILITY_POLICIES = (NO_SYNC, SYNC_EACH_COMMIT, SYNC_PERIODICALLY)
+
+_sync = getattr(os, 'fdatasync', os.fsync)
+
+
+def _checksum(prefix, data):
+    return zlib.crc32(data, zlib.crc32(prefix)) & 0xffffffff
+
+
+def _file_name(f, name):
+    # Files opened from a descriptor are named by its number instead.
+    if name is None and isinstance(getattr(f, 'name', None), str):
+        name = f.name
+    return name
+
+
 class Storage(object):
     SUPERBLOCK_SIZE = 4096
     INTEGER_FORMAT = "!Q"
     INTEGER_LENGTH = 8
+    # The superblock holds the root address, then these integers.
+    RETIRED_ADDRESS = 8
+    FILE_ID_ADDRESS = 16
+    RECORD_FORMAT_ADDRESS = 24
+    COMMIT_ADDRESS = 32
+    # The kind of tree in the file, as up to eight bytes of ASCII. Files
+    # from before it was recorded have zeros here.
+    TREE_KIND_ADDRESS = 40
+
+    # Files from before checksums have records that are just a length and
+    # the data. Newer records carry a kind and a CRC of the whole record,
+    # and every commit appends a commit record naming the new root, so that
+    # the file doubles as its own write-ahead log.
+    PLAIN_RECORDS = 0
+    CHECKED_RECORDS = 1
+    RECORD_HEADER = struct.Struct('!QcI')
+    RECORD_PREFIX_LENGTH = 9
+    DATA_RECORD = b'd'
+    COMMIT_RECORD = b'c'
+    # Values of `overflow_threshold` bytes or more go to a segment file of
+    # their own, leaving just a pointer in the database file, so that big
+    # values don't spread the nodes out. The pointer is the data's offset
+    # and length in the segment, and its CRC.
+    OVERFLOW_RECORD = b'o'
+    OVERFLOW_POINTER = struct.Struct('!QQI')
 
-    def __init__(self, f):
+    def __init__(self, f, durability=NO_SYNC, sync_interval=1.0,
+                 overflow_threshold=None, name=None):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError('Unknown durability policy: %r' % (durability,))
         self._f = f
+        self._name = _file_name(f, name)
+        self._overflow_threshold = overflow_threshold
+        self._blobs = None
         self.locked = False
+        st = os.fstat(f.fileno())
+        self._inode = (st.st_dev, st.st_ino)
+        self._file_id = 0
+        self._tree_kind = None
+        self._durability = durability
+        self._sync_interval = sync_interval
+        self._sync_lock = threading.Lock()
+        self._sync_timer = None
+        self._synced_at = time.time()
+        self._unsynced = False
         self._ensure_superblock()
 
     def _ensure_superblock(self):
@@ -28,16 +106,120 @@ class Storage(object):
         end_address = self._f.tell()
         if end_address < self.SUPERBLOCK_SIZE:
             self._f.write(b'\x00' * (self.SUPERBLOCK_SIZE - end_address))
+            self._f.seek(self.RECORD_FORMAT_ADDRESS)
+            self._write_integer(self.CHECKED_RECORDS)
+        elif self.get_root_address():
+            self._ensure_file_id()
+        self._f.seek(self.RECORD_FORMAT_ADDRESS)
+        self._record_format = self._read_integer()
+        if self._record_format == self.CHECKED_RECORDS:
+            self._cut_torn_tail()
         self.unlock()
+        if self._file_id:
+            # Open the segment, if there is one, while it's sure to exist:
+            # compaction deletes it once this file is retired.
+            self._open_blobs(create=False)
+
+    def _cut_torn_tail(self):
+        # Nobody else can be half way through a commit while we hold the
+        # lock, so anything after the last commit record was left by a
+        # writer that crashed or gave up. If the commit record itself is
+        # damaged, fall back to looking for the last good one.
+        self._f.seek(self.COMMIT_ADDRESS)
+        commit_address = self._read_integer()
+        end = self.SUPERBLOCK_SIZE
+        if commit_address:
+            record = self._read_record(commit_address)
+            if (record is None or record[0] != self.COMMIT_RECORD or
+                    self._bytes_to_integer(record[1]) !=
+                    self.get_root_address()):
+                self.recover()
+                return
+            end = (commit_address + self.RECORD_HEADER.size +
+                   self.INTEGER_LENGTH)
+        self._seek_end()
+        if self._f.tell() > end:
+            self._f.truncate(end)
+
+    def _ensure_file_id(self):
+        # A file gets a random id with its first commit. Inode numbers are
+        # reused once a compacted file is deleted, so (device, inode) alone
+        # can't tell a cache which file an address belongs to.
+        self._f.seek(self.FILE_ID_ADDRESS)
+        self._file_id = self._read_integer()
+        if not self._file_id:
+            self._new_file_id()
+
+    def _new_file_id(self):
+        old_file_id = self._file_id
+        while self._file_id in (0, old_file_id):
+            self._file_id = self._bytes_to_integer(
+                os.urandom(self.INTEGER_LENGTH))
+        self._f.seek(self.FILE_ID_ADDRESS)
+        self._write_integer(self._file_id)
+
+    @property
+    def identity(self):
+        """A key naming this file, for caches of what's stored in it."""
+        if not self._file_id:
+            # Nothing has been committed yet, or someone else committed the
+            # first root since we looked.
+            self._f.flush()
+            self._f.seek(self.FILE_ID_ADDRESS)
+            self._file_id = self._read_integer()
+        return self._inode + (self._file_id,)
+
+    @property
+    def tree_kind(self):
+        """The kind of tree the file holds, or None if it doesn't say."""
+        if self._tree_kind is None:
+            kind = self._read_tree_kind().rstrip(b'\x00')
+            if kind:
+                self._tree_kind = kind.decode('ascii')
+        return self._tree_kind
+
+    def _read_tree_kind(self):
+        self._f.flush()
+        self._f.seek(self.TREE_KIND_ADDRESS)
+        return self._f.read(self.INTEGER_LENGTH)
+
+    def record_tree_kind(self, kind):
+        """Record that the file holds a `kind` tree, unless it says already."""
+        if kind is None or self.tree_kind is not None:
+            return
+        self.lock()
+        self._f.seek(self.TREE_KIND_ADDRESS)
+        self._f.write(kind.encode('ascii').ljust(self.INTEGER_LENGTH, b'\x00'))
+        self._tree_kind = kind
 
     def lock(self):
         if not self.locked:
             portalocker.lock(self._f, portalocker.LOCK_EX)
             self.locked = True
+            # Whatever we read before taking the lock may have changed since.
+            self._f.flush()
+            if self.retired:
+                self.unlock()
+                raise RetiredStorageError(
+                    'Database file was replaced by compaction; reopen it.')
             return True
         else:
             return False
 
+    @property
+    def retired(self):
+        self._f.seek(self.RETIRED_ADDRESS)
+        flag = self._f.read(self.INTEGER_LENGTH)
+        return (len(flag) == self.INTEGER_LENGTH and
+                self._bytes_to_integer(flag) != 0)
+
+    def retire(self):
+        """Mark this file as replaced, so that no writer commits to it."""
+        self.lock()
+        self._f.seek(self.RETIRED_ADDRESS)
+        self._write_integer(1)
+        self._f.flush()
+
     def unlock(self):
         if self.locked:
             self._f.flush()
@@ -48,6 +230,9 @@ class Storage(object):
         self._f.seek(0, os.SEEK_END)
 
     def _seek_superblock(self):
+        # Flushing also drops the read buffer, which might otherwise still
+        # hold the superblock as it was before someone else's commit.
+        self._f.flush()
         self._f.seek(0)
 
     def _bytes_to_integer(self, integer_bytes):
@@ -64,36 +249,409 @@ class Storage(object):
         self._f.write(self._integer_to_bytes(integer))
 
     def write(self, data):
+        return self._append(data, self.DATA_RECORD)
+
+    def write_value(self, data):
+        """Like write(), but for a value, which may go to the overflow
+        segment. Nodes never do: every lookup has to read them."""
+        if (self._overflow_threshold is not None and
+                len(data) >= self._overflow_threshold and
+                self._record_format == self.CHECKED_RECORDS):
+            return self._append(self._write_blob(data), self.OVERFLOW_RECORD)
+        return self.write(data)
+
+    @property
+    def blobs_name(self):
+        """The name of this file's overflow segment, if it has one."""
+        if self._name is None or not self.identity[-1]:
+            return None
+        return '%s.%016x.blobs' % (self._name, self.identity[-1])
+
+    def _open_blobs(self, create):
+        # The segment is only opened for writing, and so created, by the
+        # first value to overflow.
+        if self._blobs is not None and (not create or
+                                        '+' in self._blobs.mode):
+            return self._blobs
+        name = self.blobs_name
+        if name is None:
+            if create:
+                raise io.UnsupportedOperation(
+                    'Overflow needs a database opened by name.')
+            return None
+        if create:
+            if self._blobs is not None:
+                self._blobs.close()
+            self._blobs = open(name, 'a+b')
+        else:
+            try:
+                self._blobs = open(name, 'rb')
+            except IOError:
+                pass
+        return self._blobs
+
+    def _write_blob(self, data):
+        self.lock()
+        if not self._file_id:
+            # The segment is named after the file id.
+            self._ensure_file_id()
+        blobs = self._open_blobs(create=True)
+        blobs.seek(0, os.SEEK_END)
+        offset = blobs.tell()
+        blobs.write(data)
+        return self.OVERFLOW_POINTER.pack(
+            offset, len(data), zlib.crc32(data) & 0xffffffff)
+
+    def _read_blob(self, pointer, address):
+        offset, length, checksum = self.OVERFLOW_POINTER.unpack(pointer)
+        blobs = self._open_blobs(create=False)
+        if blobs is None:
+            raise CorruptRecordError(
+                'Record at %d is in a missing overflow segment.' % address)
+        blobs.flush()
+        data = os.pread(blobs.fileno(), length, offset)
+        if len(data) < length or zlib.crc32(data) & 0xffffffff != checksum:
+            raise CorruptRecordError(
+                'Record at %d is damaged or cut short.' % address)
+        return data
+
+    def _append(self, data, kind):
         self.lock()
         self._seek_end()
         object_address = self._f.tell()
-        self._write_integer(len(data))
+        if self._record_format == self.CHECKED_RECORDS:
+            prefix = self.RECORD_HEADER.pack(len(data), kind, 0)[
+                :self.RECORD_PREFIX_LENGTH]
+            self._f.write(prefix + struct.pack('!I', _checksum(prefix, data)))
+        else:
+            self._write_integer(len(data))
         self._f.write(data)
         return object_address
 
     def read(self, address):
+        if self._record_format == self.CHECKED_RECORDS:
+            record = self._read_record(address)
+            if record is None:
+                raise CorruptRecordError(
+                    'Record at %d is damaged or cut short.' % address)
+            if record[0] == self.OVERFLOW_RECORD:
+                return self._read_blob(record[1], address)
+            return record[1]
         self._f.seek(address)
         length = self._read_integer()
         data = self._f.read(length)
         return data
 
-    def commit_root_address(self, root_address):
+    def _read_record(self, address):
+        """Return the kind and data of the record at `address`, or None if it
+        doesn't check out."""
+        self._f.seek(address)
+        header = self._f.read(self.RECORD_HEADER.size)
+        if len(header) < self.RECORD_HEADER.size:
+            return None
+        length, kind, checksum = self.RECORD_HEADER.unpack(header)
+        data = self._f.read(length)
+        if (len(data) < length or checksum !=
+                _checksum(header[:self.RECORD_PREFIX_LENGTH], data)):
+            return None
+        return kind, data
+
+    def commit_root_address(self, root_address, unlock=True):
+        """Make `root_address` the root, and let other writers go ahead,
+        unless `unlock` is false."""
+        commit_address = self.begin_commit(root_address)
+        if self.syncs_each_commit:
+            # The new nodes have to be on disk before anything points at
+            # them.
+            self.sync()
+        self.finish_commit(root_address, commit_address)
+        if self.syncs_each_commit:
+            self.sync()
+        if unlock:
+            self.unlock()
+
+    @property
+    def syncs_each_commit(self):
+        return self._durability == SYNC_EACH_COMMIT
+
+    def begin_commit(self, root_address):
+        """The first half of commit_root_address(): write and flush what
+        has to reach the disk before the root can change. Returns what to
+        pass to finish_commit()."""
         self.lock()
         self._f.flush()
+        if not self._file_id:
+            self._ensure_file_id()
+        if self._blobs is not None:
+            self._blobs.flush()
+        commit_address = None
+        if self._record_format == self.CHECKED_RECORDS:
+            commit_address = self._append(
+                self._integer_to_bytes(root_address), self.COMMIT_RECORD)
+            self._f.flush()
+        return commit_address
+
+    def finish_commit(self, root_address, commit_address):
+        """The second half of commit_root_address(): point the superblock
+        at the new root, and flush it. It's synced by then under
+        SYNC_PERIODICALLY, but under SYNC_EACH_COMMIT only once the caller
+        calls sync() or sync_flushed()."""
+        self.lock()
+        if commit_address is not None:
+            self._f.seek(self.COMMIT_ADDRESS)
+            self._write_integer(commit_address)
         self._seek_superblock()
         self._write_integer(root_address)
         self._f.flush()
+        if self._durability == SYNC_PERIODICALLY:
+            self._sync_soon()
+
+    def sync(self):
+        """Make sure everything written so far is on the disk."""
+        self._f.flush()
+        if self._blobs is not None:
+            self._blobs.flush()
+        self.sync_flushed()
+
+    def sync_flushed(self):
+        """Like sync(), once everything has been flushed. It doesn't touch
+        the file objects, so other threads can read meanwhile."""
+        with self._sync_lock:
+            self._sync_unlocked()
+
+    def _sync_unlocked(self):
+        if self._blobs is not None:
+            _sync(self._blobs.fileno())
+        _sync(self._f.fileno())
+        self._synced_at = time.time()
+        self._unsynced = False
+
+    def _sync_soon(self):
+        with self._sync_lock:
+            self._unsynced = True
+            if self._sync_timer is not None:
+                return
+            delay = self._synced_at + self._sync_interval - time.time()
+            if delay <= 0:
+                self._sync_unlocked()
+                return
+            self._sync_timer = threading.Timer(delay, self._sync_from_timer)
+            self._sync_timer.daemon = True
+            self._sync_timer.start()
+
+    def _sync_from_timer(self):
+        with self._sync_lock:
+            self._sync_timer = None
+            if self._unsynced and not self._f.closed:
+                if self._blobs is not None:
+                    self._blobs.flush()
+                self._sync_unlocked()
+
+    def recover(self):
+        """Go back to the last commit whose records are all intact.
+
+        Every record is checked, from the start of the file, up to the first
+        that is cut short or fails its checksum. Everything after the last
+        commit before that point is cut off, and that commit's root becomes
+        the root again. Returns the root address.
+        """
+        if self._record_format != self.CHECKED_RECORDS:
+            raise io.UnsupportedOperation(
+                'Files without checksums have to be compacted first.')
+        self.lock()
+        old_root_address = self.get_root_address()
+        self._f.seek(self.COMMIT_ADDRESS)
+        old_commit_address = self._read_integer()
+        self._seek_end()
+        size = self._f.tell()
+        address = end = self.SUPERBLOCK_SIZE
+        root_address = commit_address = 0
+        while address + self.RECORD_HEADER.size <= size:
+            self._f.seek(address)
+            length = self._read_integer()
+            next_address = address + self.RECORD_HEADER.size + length
+            if next_address > size:
+                break
+            record = self._read_record(address)
+            if record is None:
+                break
+            if record[0] == self.OVERFLOW_RECORD:
+                try:
+                    self._read_blob(record[1], address)
+                except CorruptRecordError:
+                    break
+            if record[0] == self.COMMIT_RECORD:
+                commit_address, end = address, next_address
+                root_address = self._bytes_to_integer(record[1])
+            address = next_address
+        self._f.truncate(end)
+        if (root_address, commit_address) != (old_root_address,
+                                               old_commit_address):
+            # Committed records were cut off, and new ones will be written
+            # at their addresses: whatever caches hold for them is stale.
+            self._renew_file_id()
+        self._f.seek(self.COMMIT_ADDRESS)
+        self._write_integer(commit_address)
+        self._seek_superblock()
+        self._write_integer(root_address)
+        self.sync()
         self.unlock()
+        return root_address
+
+    def _renew_file_id(self):
+        # The segment is named after the file id, so it goes with it.
+        old_blobs_name = self.blobs_name
+        self._new_file_id()
+        if self._blobs is not None:
+            self._blobs.close()
+            self._blobs = None
+        if old_blobs_name is not None and os.path.exists(old_blobs_name):
+            os.rename(old_blobs_name, self.blobs_name)
+            self._open_blobs(create=False)
 
     def get_root_address(self):
         self._seek_superblock()
         root_address = self._read_integer()
+        # Recovery gives the file a new id, so it's read again with each
+        # root.
+        self._f.seek(self.FILE_ID_ADDRESS)
+        self._file_id = self._read_integer()
         return root_address
 
+    def read_only(self):
+        """Return a MmapStorage onto this same file, for lock-free readers."""
+        return MmapStorage(os.fdopen(os.dup(self._f.fileno()), 'rb'),
+                           name=self._name)
+
+    def remove_blobs(self):
+        """Delete the overflow segment of a retired file."""
+        name = self.blobs_name
+        if name is not None and os.path.exists(name):
+            os.remove(name)
+
     def close(self):
+        with self._sync_lock:
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+                self._sync_timer = None
+        if self._unsynced and not self._f.closed:
+            self.sync()
         self.unlock()
+        if self._blobs is not None:
+            self._blobs.close()
         self._f.close()
 
     @property
     def closed(self):
         return self._f.closed
+
+
+class MmapStorage(Storage):
+    """A read-only Storage that serves records straight out of an mmap.
+
+    read() returns a memoryview of the mapping rather than a copy, so the
+    only work per record is decoding it. When a record or root lies past the
+    end of the mapping, some writer has committed since we mapped the file,
+    and it gets mapped again at its new length.
+    """
+
+    def __init__(self, f, durability=NO_SYNC, sync_interval=None,
+                 overflow_threshold=None, name=None):
+        # Durability and overflow are up to the writer; nothing is written
+        # here.
+        self._f = f
+        self._name = _file_name(f, name)
+        self._blobs = None
+        self.locked = False
+        st = os.fstat(f.fileno())
+        self._inode = (st.st_dev, st.st_ino)
+        self._file_id = 0
+        self._tree_kind = None
+        self._map = None
+        self._view = memoryview(b'')
+        self._remap()
+        if self.identity[-1]:
+            self._open_blobs(create=False)
+
+    def _remap(self):
+        length = os.fstat(self._f.fileno()).st_size
+        if length < self.SUPERBLOCK_SIZE:
+            return
+        # Any memoryviews handed out keep the old mapping alive until they
+        # are done with, so it isn't closed here.
+        self._map = mmap.mmap(
+            self._f.fileno(), length, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def _integer_at(self, address):
+        end = address + self.INTEGER_LENGTH
+        if end > len(self._view):
+            self._remap()
+            if end > len(self._view):
+                return 0
+        return struct.unpack_from(self.INTEGER_FORMAT, self._view, address)[0]
+
+    def lock(self):
+        raise io.UnsupportedOperation('MmapStorage is read-only.')
+
+    def write(self, data):
+        raise io.UnsupportedOperation('MmapStorage is read-only.')
+
+    write_value = write
+
+    def commit_root_address(self, root_address, unlock=True):
+        raise io.UnsupportedOperation('MmapStorage is read-only.')
+
+    def read_only(self):
+        return self
+
+    @property
+    def identity(self):
+        if not self._file_id:
+            self._file_id = self._integer_at(self.FILE_ID_ADDRESS)
+        return self._inode + (self._file_id,)
+
+    @property
+    def _record_format(self):
+        return self._integer_at(self.RECORD_FORMAT_ADDRESS)
+
+    def _read_tree_kind(self):
+        start = self.TREE_KIND_ADDRESS
+        return bytes(self._view[start:start + self.INTEGER_LENGTH])
+
+    def read(self, address):
+        if self._record_format != self.CHECKED_RECORDS:
+            start = address + self.INTEGER_LENGTH
+            end = start + self._integer_at(address)
+            if end > len(self._view):
+                self._remap()
+            return self._view[start:end]
+        start = address + self.RECORD_HEADER.size
+        if start > len(self._view):
+            self._remap()
+        length, kind, checksum = self.RECORD_HEADER.unpack_from(
+            self._view, address)
+        end = start + length
+        if end > len(self._view):
+            self._remap()
+        data = self._view[start:end]
+        if len(data) < length or checksum != _checksum(
+                self._view[address:address + self.RECORD_PREFIX_LENGTH],
+                data):
+            raise CorruptRecordError(
+                'Record at %d is damaged or cut short.' % address)
+        if kind == self.OVERFLOW_RECORD:
+            return self._read_blob(data, address)
+        return data
+
+    def get_root_address(self):
+        self._file_id = self._integer_at(self.FILE_ID_ADDRESS)
+        return self._integer_at(0)
+
+    def close(self):
+        # The mapping is unmapped once the last memoryview of it goes away.
+        self._view = memoryview(b'')
+        self._map = None
+        if self._blobs is not None:
+            self._blobs.close()
+        self._f.close()
@@ -0,0 +1,34 @@
+# The dbdb server and its clients exchange frames: a four byte length, then
+# that many bytes of JSON. A request is [id, op, args] and its response is
+# [id, status, result], where status is 'ok', or 'error' with a result of
+# [error type name, message]. Responses come back in the order the requests
+# were sent on that connection, so a client can send many before reading any.
+# Keys and values are strings; a request with anything else in its args is
+# answered with a BadRequest error.
+import json
+import struct
+
+FRAME_HEADER = struct.Struct('!I')
+OK = 'ok'
+ERROR = 'error'
+
+READ_OPS = {'get', 'scan', 'len'}
+WRITE_OPS = {'set', 'delete'}
+
+# The most pairs one scan request answers with. Clients page through longer
+# ranges a request at a time.
+SCAN_LIMIT = 1000
+
+
+def encode_frame(message):
+    data = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def decode_frame(data):
+    return json.loads(data.decode('utf-8'))
+
+
+def key_after(key):
+    """The smallest text key greater than `key`."""
+    return key + u'\x00'
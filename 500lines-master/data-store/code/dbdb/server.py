@@ -0,0 +1,304 @@
+"""Serve one dbdb database to many clients over a local socket.
+
+Usage::
+
+    python -m dbdb.server DBNAME [--socket PATH] [--tree binary|avl|bplus]
+                                 [--cache-mb N] [--durability POLICY]
+
+Every process that opens a database file fights the others for its lock.
+The server opens it once instead, and:
+
+* reads from a snapshot of the last commit, through a shared node cache, so
+  reads never wait for the file lock or for a commit in progress;
+* gathers the writes that arrive while a commit is running, from every
+  connection, and commits them all together when it's done;
+* answers each connection's requests in order, but lets clients send as many
+  as they like before reading the answers. A read waits for that
+  connection's earlier writes to commit, so clients see their own writes.
+
+The protocol is described in dbdb.protocol; dbdb.client speaks it.
+"""
+import argparse
+import asyncio
+import sys
+import threading
+
+import dbdb
+from dbdb import protocol
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _is_key(arg):
+    return isinstance(arg, str)
+
+
+def _is_bound(arg):
+    return arg is None or isinstance(arg, str)
+
+
+def _is_limit(arg):
+    return arg is None or (type(arg) is int and arg >= 1)
+
+
+# What each op's args have to be.
+ARG_CHECKS = {
+    'get': [_is_key],
+    'len': [],
+    'scan': [_is_bound, _is_bound, _is_limit],
+    'set': [_is_key, _is_key],
+    'delete': [_is_key],
+}
+
+
+def check_request(request):
+    """Return the id, op and args of `request`, or raise BadRequest if it
+    isn't one that can be carried out."""
+    if not (isinstance(request, list) and len(request) == 3):
+        raise BadRequest('Not a request: %r' % (request,))
+    request_id, op, args = request
+    if op not in ARG_CHECKS:
+        raise BadRequest('Unknown op: %r' % (op,))
+    checks = ARG_CHECKS[op]
+    if not (isinstance(args, list) and len(args) == len(checks) and
+            all(check(arg) for check, arg in zip(checks, args))):
+        raise BadRequest('Bad args for %s: %r' % (op, args))
+    return request_id, op, args
+
+
+def _request_id(request):
+    # What to answer a bad request with, if it has an id at all.
+    if isinstance(request, list) and request:
+        return request[0]
+    return None
+
+
+class Server(object):
+    def __init__(self, db):
+        self._db = db
+        self._snapshot = db.snapshot()
+        self._pending = []
+        self._committing = False
+        self._connections = set()
+        self._listener = None
+        self.commits = 0
+
+    async def start(self, path):
+        """Start listening on the unix socket at `path`."""
+        self._listener = await asyncio.start_unix_server(self._handle, path)
+
+    async def serve(self, path):
+        """Serve on the unix socket at `path` until cancelled."""
+        await self.start(path)
+        try:
+            await self._listener.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Stop listening, and hang up on the clients still connected."""
+        self._listener.close()
+        await self._listener.wait_closed()
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            await self._serve_connection(reader, writer)
+        except asyncio.CancelledError:
+            pass  # close() hung up on this client.
+        finally:
+            self._connections.discard(task)
+
+    async def _serve_connection(self, reader, writer):
+        responses = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send(responses, writer))
+        last_write = last_read = None
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(
+                        protocol.FRAME_HEADER.size)
+                    length, = protocol.FRAME_HEADER.unpack(header)
+                    data = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                request = None
+                try:
+                    request = protocol.decode_frame(data)
+                    request_id, op, args = check_request(request)
+                except ValueError as e:
+                    # Answered, but never queued where it could spoil the
+                    # commit other connections' writes are in.
+                    future = asyncio.get_event_loop().create_future()
+                    future.set_exception(BadRequest(str(e)))
+                    responses.put_nowait((_request_id(request), future))
+                    continue
+                if op in protocol.WRITE_OPS:
+                    if last_read is not None:
+                        # A read still waiting for an earlier write mustn't
+                        # see this one, so keep it out of the same commit.
+                        await asyncio.wait([last_read])
+                        last_read = None
+                    last_write = future = self._write(op, args)
+                else:
+                    last_read = future = asyncio.ensure_future(
+                        self._read(op, args, last_write))
+                responses.put_nowait((request_id, future))
+        finally:
+            responses.put_nowait(None)
+            await sender
+            writer.close()
+
+    async def _send(self, responses, writer):
+        while True:
+            item = await responses.get()
+            if item is None:
+                return
+            request_id, future = item
+            try:
+                response = [request_id, protocol.OK, await future]
+            except Exception as e:
+                response = [request_id, protocol.ERROR,
+                            [type(e).__name__, str(e)]]
+            writer.write(protocol.encode_frame(response))
+            if responses.empty():
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    return
+
+    async def _read(self, op, args, after):
+        if after is not None:
+            await asyncio.wait([after])
+        snapshot = self._snapshot
+        if op == 'get':
+            return snapshot[args[0]]
+        elif op == 'len':
+            return len(snapshot)
+        elif op == 'scan':
+            start, stop, limit = args
+            limit = min(limit or protocol.SCAN_LIMIT, protocol.SCAN_LIMIT)
+            pairs = []
+            for key, value in snapshot.items(start, stop):
+                if len(pairs) == limit:
+                    break
+                pairs.append([key, value])
+            return pairs
+        raise BadRequest('Unknown op: %r' % (op,))
+
+    def _write(self, op, args):
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((op, args, future))
+        if not self._committing:
+            self._committing = True
+            asyncio.ensure_future(self._commit_pending())
+        return future
+
+    async def _commit_pending(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self._pending:
+                # Let every write that's already arrived join this commit.
+                await asyncio.sleep(0)
+                batch, self._pending = self._pending, []
+                try:
+                    errors = await loop.run_in_executor(
+                        None, self._apply, batch)
+                except Exception as e:
+                    if len(batch) == 1:
+                        errors = [e]
+                    else:
+                        # Don't fail every connection's writes for the sake
+                        # of one: commit them one at a time instead.
+                        errors = await loop.run_in_executor(
+                            None, self._apply_each, batch)
+                else:
+                    self.commits += 1
+                self._snapshot = self._db.snapshot()
+                for (op, args, future), error in zip(batch, errors):
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+        finally:
+            self._committing = False
+
+    def _apply(self, batch):
+        errors = []
+        with self._db.batch():
+            for op, args, future in batch:
+                try:
+                    if op == 'set':
+                        self._db[args[0]] = args[1]
+                    else:
+                        del self._db[args[0]]
+                except KeyError as e:
+                    errors.append(e)
+                else:
+                    errors.append(None)
+        return errors
+
+    def _apply_each(self, batch):
+        errors = []
+        for write in batch:
+            try:
+                error, = self._apply([write])
+            except Exception as e:
+                error = e
+            else:
+                self.commits += 1
+            errors.append(error)
+        return errors
+
+
+def serve_in_thread(db, path):
+    """Serve `db` at `path` from a thread of its own.
+
+    Returns the Server and a function that stops it.
+    """
+    server = Server(db)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start(path))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+    return server, stop
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m dbdb.server')
+    parser.add_argument('dbname')
+    parser.add_argument('--socket', help='defaults to DBNAME.sock')
+    parser.add_argument('--tree', choices=sorted(dbdb.TREES),
+                        help="defaults to the file's own")
+    parser.add_argument('--cache-mb', type=int, default=64)
+    parser.add_argument('--durability', default=dbdb.NO_SYNC, choices=[
+        dbdb.NO_SYNC, dbdb.SYNC_EACH_COMMIT, dbdb.SYNC_PERIODICALLY])
+    args = parser.parse_args(argv[1:])
+    db = dbdb.connect(
+        args.dbname, tree_class=dbdb.TREES.get(args.tree),
+        cache=dbdb.NodeCache(args.cache_mb * 1024 * 1024),
+        durability=args.durability)
+    try:
+        asyncio.run(Server(db).serve(args.socket or args.dbname + '.sock'))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,306 @@
+# Every writer to a dbdb file waits for the one lock on it. A ShardedDB
+# spreads its keys over several files instead, each an ordinary dbdb, so
+# writers whose keys land in different shards never wait for each other,
+# whether they're threads or processes.
+#
+# Which shard a key lives in is up to a router, kept in a small JSON manifest
+# under the database's own name; the shards sit beside it, as NAME.000,
+# NAME.001 and so on. A HashRouter spreads keys evenly, and a scan has to
+# merge every shard. A RangeRouter gives each shard a run of keys, so a scan
+# only reads the shards its range overlaps, one after another.
+#
+# Each shard commits on its own. commit(coordinated=True) makes the changes
+# in several shards survive a crash together or not at all: their new nodes
+# are synced, then an undo log of the roots before and after goes next to the
+# manifest, the shards are committed while still locked, and the log is
+# removed. Opening the database finds any log left by a crashed commit, and
+# puts back the old roots. Readers can still see one shard's commit before
+# another's; only crashes are covered.
+
+import bisect
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import zlib
+
+import portalocker
+
+from dbdb import encoding
+from dbdb.interface import _prefix_stop
+from dbdb.physical import Storage
+
+
+class HashRouter(object):
+    ordered = False
+
+    def __init__(self, shard_count):
+        if shard_count < 1:
+            raise ValueError('Need at least one shard.')
+        self.shard_count = shard_count
+
+    def shard_for(self, key):
+        tag, data = encoding.pack_key(key)
+        return zlib.crc32(tag + data) % self.shard_count
+
+    def shards_for(self, start, stop):
+        return list(range(self.shard_count))
+
+    def to_json(self):
+        return {'router': 'hash', 'shards': self.shard_count}
+
+
+class RangeRouter(object):
+    """Shard i holds the keys from boundaries[i - 1] up to boundaries[i]."""
+    ordered = True
+
+    def __init__(self, boundaries):
+        boundaries = list(boundaries)
+        if any(not a < b for a, b in zip(boundaries, boundaries[1:])):
+            raise ValueError('Boundaries must be unique and ascending.')
+        self.boundaries = boundaries
+        self.shard_count = len(boundaries) + 1
+
+    def shard_for(self, key):
+        return bisect.bisect_right(self.boundaries, key)
+
+    def shards_for(self, start, stop):
+        first = 0 if start is None else self.shard_for(start)
+        last = (len(self.boundaries) if stop is None else
+                bisect.bisect_left(self.boundaries, stop))
+        return list(range(first, last + 1))
+
+    def to_json(self):
+        return {'router': 'range', 'boundaries': self.boundaries}
+
+
+def router_from_json(manifest):
+    if manifest['router'] == 'hash':
+        return HashRouter(manifest['shards'])
+    elif manifest['router'] == 'range':
+        return RangeRouter(manifest['boundaries'])
+    raise ValueError('Unknown router: %r' % (manifest['router'],))
+
+
+def _write_durably(path, data):
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+    _sync_directory(path)
+
+
+def _sync_directory(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ShardedDB(object):
+    """A database spread over several dbdb files, with the DBDB interface.
+
+    `router` is needed to create the database, and must match if given
+    when opening it again. The rest of the options go to dbdb.connect()
+    for each shard.
+    """
+
+    def __init__(self, dbname, router=None, tree_class=None,
+                 **options):
+        # dbdb imports this module, so this can't be imported up top.
+        from dbdb import connect
+        self._dbname = dbname
+        self._router = self._open_manifest(router)
+        self._log_path = dbname + '.commit'
+        self._lock = threading.RLock()
+        self._batch_depth = 0
+        with self._manifest_locked():
+            self._undo_crashed_commit()
+        self.shards = [
+            connect(self.shard_name(i), tree_class=tree_class, **options)
+            for i in range(self._router.shard_count)]
+
+    def _open_manifest(self, router):
+        try:
+            self._manifest = open(self._dbname, 'r+b')
+        except IOError:
+            if router is None:
+                raise ValueError(
+                    '%s needs a router to create it.' % self._dbname)
+            _write_durably(self._dbname, json.dumps(
+                router.to_json()).encode('utf-8'))
+            self._manifest = open(self._dbname, 'r+b')
+            return router
+        saved = router_from_json(json.loads(
+            self._manifest.read().decode('utf-8')))
+        if router is not None and router.to_json() != saved.to_json():
+            self._manifest.close()
+            raise ValueError(
+                '%s was created with a different router.' % self._dbname)
+        return saved
+
+    def shard_name(self, index):
+        return '%s.%03d' % (self._dbname, index)
+
+    @contextlib.contextmanager
+    def _manifest_locked(self):
+        # Coordinated commits, and undoing them, take turns.
+        portalocker.lock(self._manifest, portalocker.LOCK_EX)
+        try:
+            yield
+        finally:
+            portalocker.unlock(self._manifest)
+
+    def _undo_crashed_commit(self):
+        try:
+            with open(self._log_path, 'rb') as f:
+                roots = json.loads(f.read().decode('utf-8'))
+        except IOError:
+            return
+        for index, (before, after) in sorted(roots.items()):
+            with open(self.shard_name(int(index)), 'r+b') as f:
+                storage = Storage(f)
+                storage.lock()
+                if storage.get_root_address() == after:
+                    storage.commit_root_address(before)
+                    storage.sync()
+                storage.close()
+        os.remove(self._log_path)
+        _sync_directory(self._log_path)
+
+    def close(self):
+        with self._lock:
+            for shard in self.shards:
+                shard.close()
+            self._manifest.close()
+
+    def shard_for(self, key):
+        """The DBDB that holds `key`."""
+        return self.shards[self._router.shard_for(key)]
+
+    def commit(self, coordinated=False):
+        """Commit each shard with changes.
+
+        Shards commit one at a time, unless `coordinated`, in which case a
+        crash part way through undoes them all.
+        """
+        with self._lock:
+            dirty = [shard for shard in self.shards if shard.dirty]
+            if coordinated and len(dirty) > 1:
+                self._commit_coordinated(dirty)
+            else:
+                for shard in dirty:
+                    shard.commit()
+
+    def commit_shard(self, index):
+        self.shards[index].commit()
+
+    def rollback(self):
+        with self._lock:
+            for shard in self.shards:
+                shard.rollback()
+
+    def _commit_coordinated(self, shards):
+        with self._manifest_locked():
+            roots = {}
+            for index, shard in enumerate(self.shards):
+                if shard in shards:
+                    roots[index] = shard.prepare_commit()
+            _write_durably(self._log_path, json.dumps(
+                roots).encode('utf-8'))
+            for shard in shards:
+                shard.commit(unlock=False)
+                shard.sync()
+            os.remove(self._log_path)
+            _sync_directory(self._log_path)
+            for shard in shards:
+                # Nothing's left to throw away: this just unlocks.
+                shard.rollback()
+
+    @contextlib.contextmanager
+    def batch(self, coordinated=False):
+        """Commit the changes in a `with` block when it ends, or throw them
+        all away if it raises. If the commit raises, whatever it hadn't
+        committed yet is thrown away.
+
+        With `coordinated`, every shard is locked up front and the changes
+        are committed as one coordinated commit.
+        """
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                if coordinated and self._batch_depth == 1:
+                    # Always in the same order, so that two coordinated
+                    # batches can't each wait for a shard the other has.
+                    for shard in self.shards:
+                        shard.lock()
+                yield self
+            except BaseException:
+                if self._batch_depth == 1:
+                    self.rollback()
+                raise
+            else:
+                if self._batch_depth == 1:
+                    try:
+                        self.commit(coordinated)
+                    finally:
+                        # Throw away whatever didn't get committed, and
+                        # unlock the shards that had nothing to commit.
+                        self.rollback()
+            finally:
+                self._batch_depth -= 1
+
+    def __getitem__(self, key):
+        return self.shard_for(key)[key]
+
+    def get(self, key, default=None):
+        return self.shard_for(key).get(key, default)
+
+    def __setitem__(self, key, value):
+        self.shard_for(key)[key] = value
+
+    def __delitem__(self, key):
+        del self.shard_for(key)[key]
+
+    def __contains__(self, key):
+        return key in self.shard_for(key)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def items(self, start=None, stop=None, reverse=False):
+        """Yield (key, value) for start <= key < stop, in key order, across
+        every shard the range touches."""
+        return self._scan(
+            lambda shard: shard.items(start, stop, reverse), start, stop,
+            reverse, lambda pair: pair[0])
+
+    def keys(self, start=None, stop=None, reverse=False):
+        return self._scan(
+            lambda shard: shard.keys(start, stop, reverse), start, stop,
+            reverse, None)
+
+    def _scan(self, scan, start, stop, reverse, sort_key):
+        shards = [self.shards[i]
+                  for i in self._router.shards_for(start, stop)]
+        if reverse:
+            shards.reverse()
+        scans = [scan(shard) for shard in shards]
+        if self._router.ordered:
+            # Each shard's keys all come before the next shard's.
+            return itertools.chain.from_iterable(scans)
+        return heapq.merge(*scans, key=sort_key, reverse=reverse)
+
+    def prefix_items(self, prefix, reverse=False):
+        return self.items(prefix, _prefix_stop(prefix), reverse)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __reversed__(self):
+        return self.keys(reverse=True)
@@ -0,0 +1,112 @@
+import random
+
+from nose.tools import assert_raises, eq_
+
+from dbdb.avl_tree import AVLNode, AVLNodeRef, AVLTree
+from dbdb.logical import ValueRef
+from dbdb.tests.test_binary_tree import StubStorage, check_scans
+
+
+class TestAVLTree(object):
+    def setup(self):
+        self.tree = AVLTree(StubStorage())
+
+    def _check_balanced(self, ref):
+        node = self.tree._follow(ref)
+        if node is None:
+            return 0, 0
+        left_length, left_height = self._check_balanced(node.left_ref)
+        right_length, right_height = self._check_balanced(node.right_ref)
+        assert abs(left_height - right_height) <= 1
+        eq_(node.length, left_length + right_length + 1)
+        eq_(node.height, max(left_height, right_height) + 1)
+        return node.length, node.height
+
+    def test_get_missing_key_raises_key_error(self):
+        with assert_raises(KeyError):
+            self.tree.get('Not A Key In The Tree')
+
+    def test_sequential_inserts_stay_balanced(self):
+        for i in range(1024):
+            self.tree.set(i, str(i))
+        length, height = self._check_balanced(self.tree._tree_ref)
+        eq_(length, 1024)
+        eq_(height, 11)
+        for i in range(1024):
+            eq_(self.tree.get(i), str(i))
+
+    def test_random_set_and_pop_keys(self):
+        keys = random.sample(range(10000), 300)
+        for i, k in enumerate(keys, start=1):
+            self.tree.set(k, str(k))
+            eq_(len(self.tree), i)
+        self._check_balanced(self.tree._tree_ref)
+        random.shuffle(keys)
+        for i, k in enumerate(keys, start=1):
+            self.tree.pop(k)
+            eq_(len(self.tree), len(keys) - i)
+            if i % 50 == 0:
+                self._check_balanced(self.tree._tree_ref)
+        with assert_raises(KeyError):
+            self.tree.get(keys[0])
+
+    def test_scans(self):
+        keys = random.sample(range(10000), 200)
+        for k in keys:
+            self.tree.set(k, str(k))
+        check_scans(self.tree, keys)
+        self.tree.commit()
+        check_scans(self.tree, keys)
+
+    def test_overwrite_and_get_key(self):
+        self.tree.set('a', 'b')
+        self.tree.set('a', 'c')
+        eq_(self.tree.get('a'), 'c')
+        eq_(len(self.tree), 1)
+
+    def test_pop_non_existent_key(self):
+        with assert_raises(KeyError):
+            self.tree.pop('Not A Key In The Tree')
+
+    def test_balanced_after_commit_and_reload(self):
+        storage = StubStorage()
+        tree = AVLTree(storage)
+        for i in range(100):
+            tree.set(i, str(i))
+        tree.commit()
+        self.tree = AVLTree(storage)
+        for i in range(100, 200):
+            self.tree.set(i, str(i))
+        length, height = self._check_balanced(self.tree._tree_ref)
+        eq_(length, 200)
+        assert height <= 9
+
+
+class TestAVLNodeRef(object):
+    def test_round_trip_keeps_child_shape(self):
+        left_ref = AVLNodeRef(address=123, length=4, height=3)
+        right_ref = AVLNodeRef(address=321, length=2, height=2)
+        n = AVLNode(left_ref, 'k', ValueRef(address=999), right_ref, 7, 4)
+        loaded = AVLNodeRef.string_to_referent(
+            AVLNodeRef.referent_to_string(n))
+        eq_(loaded.key, 'k')
+        eq_(loaded.value_ref.address, 999)
+        eq_(loaded.left_ref.address, 123)
+        eq_(loaded.left_ref.length, 4)
+        eq_(loaded.left_ref.height, 3)
+        eq_(loaded.right_ref.address, 321)
+        eq_(loaded.right_ref.length, 2)
+        eq_(loaded.right_ref.height, 2)
+        eq_(loaded.length, 7)
+        eq_(loaded.height, 4)
+
+    def test_reads_pickled_nodes(self):
+        n = AVLNode(
+            AVLNodeRef(address=123, length=4, height=3), 'k',
+            ValueRef(address=999), AVLNodeRef(address=321, length=2, height=2),
+            7, 4)
+        loaded = AVLNodeRef.string_to_referent(AVLNodeRef.referent_to_pickle(n))
+        eq_(loaded.key, 'k')
+        eq_(loaded.left_ref.address, 123)
+        eq_(loaded.right_ref.height, 2)
+        eq_(loaded.height, 4)
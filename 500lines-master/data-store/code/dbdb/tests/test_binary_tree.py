@@ -3,6 +3,7 @@ import random
 
 from nose.tools import assert_raises, eq_
 
+from dbdb import encoding
 from dbdb.binary_tree import BinaryNode, BinaryTree, BinaryNodeRef, ValueRef
 
 
@@ -10,6 +11,11 @@ class StubStorage(object):
     def __init__(self):
         self.d = [0]
         self.locked = False
+        self.root_address = 0
+        self.tree_kind = None
+
+    def record_tree_kind(self, kind):
+        self.tree_kind = kind
 
     def lock(self):
         if not self.locked:
@@ -21,18 +27,45 @@ class StubStorage(object):
     def unlock(self):
         pass
 
+    def commit_root_address(self, root_address, unlock=True):
+        self.root_address = root_address
+        self.locked = not unlock
+
     def get_root_address(self):
-        return 0
+        return self.root_address
 
     def write(self, string):
         address = len(self.d)
         self.d.append(string)
         return address
 
+    write_value = write
+
     def read(self, address):
         return self.d[address]
 
 
+def check_scans(tree, keys):
+    """Check items() and nth() against sorted `keys`, all set in `tree`."""
+    keys = sorted(keys)
+    eq_([k for k, v in tree.items()], keys)
+    eq_([v for k, v in tree.items()], [str(k) for k in keys])
+    eq_([k for k, v in tree.items(reverse=True)], keys[::-1])
+    for start, stop in [(keys[3], keys[-3]), (keys[3] - 1, keys[3] + 1),
+                        (None, keys[5]), (keys[-5], None), (keys[5], keys[5]),
+                        (keys[-1] + 1, None)]:
+        expected = [k for k in keys if (start is None or start <= k) and
+                    (stop is None or k < stop)]
+        eq_([k for k, v in tree.items(start, stop)], expected)
+        eq_([k for k, v in tree.items(start, stop, reverse=True)],
+            expected[::-1])
+    for i, key in enumerate(keys):
+        eq_(tree.nth(i), (key, str(key)))
+    eq_(tree.nth(-1), (keys[-1], str(keys[-1])))
+    with assert_raises(IndexError):
+        tree.nth(len(keys))
+
+
 class TestBinaryTree(object):
     def setup(self):
         self.tree = BinaryTree(StubStorage())
@@ -58,6 +91,27 @@ class TestBinaryTree(object):
             self.tree.pop(k)
             eq_(len(self.tree), len(pairs) - i)
 
+    def test_scans(self):
+        keys = random.sample(range(10000), 200)
+        for k in keys:
+            self.tree.set(k, str(k))
+        check_scans(self.tree, keys)
+        self.tree.commit()
+        check_scans(self.tree, keys)
+
+    def test_scan_is_lazy(self):
+        for k in random.sample(range(10000), 200):
+            self.tree.set(k, str(k))
+        self.tree.commit()
+        reads = []
+        storage_read = self.tree._storage.read
+        self.tree._storage.read = lambda address: (
+            reads.append(address) or storage_read(address))
+        items = self.tree.items()
+        next(items)
+        next(items)
+        assert len(reads) < 40
+
     def test_overwrite_and_get_key(self):
         self.tree.set('a', 'b')
         self.tree.set('a', 'c')
@@ -103,20 +157,59 @@ class TestBinaryTree(object):
 class TestBinaryNodeRef(object):
     def test_to_string_leaf(self):
         n = BinaryNode(BinaryNodeRef(), 'k', ValueRef(address=999), BinaryNodeRef(), 1)
-        pickled = BinaryNodeRef.referent_to_string(n)
-        d = pickle.loads(pickled)
-        eq_(d['left'], 0)
-        eq_(d['key'], 'k')
-        eq_(d['value'], 999)
-        eq_(d['right'], 0)
+        string = BinaryNodeRef.referent_to_string(n)
+        assert encoding.is_encoded(string)
+        loaded = BinaryNodeRef.string_to_referent(string)
+        eq_(loaded.left_ref.address, 0)
+        eq_(loaded.key, 'k')
+        eq_(loaded.value_ref.address, 999)
+        eq_(loaded.right_ref.address, 0)
+        eq_(loaded.length, 1)
 
     def test_to_string_nonleaf(self):
         left_ref = BinaryNodeRef(address=123)
         right_ref = BinaryNodeRef(address=321)
         n = BinaryNode(left_ref, 'k', ValueRef(address=999), right_ref, 3)
-        pickled = BinaryNodeRef.referent_to_string(n)
-        d = pickle.loads(pickled)
-        eq_(d['left'], 123)
-        eq_(d['key'], 'k')
-        eq_(d['value'], 999)
-        eq_(d['right'], 321)
+        loaded = BinaryNodeRef.string_to_referent(
+            memoryview(BinaryNodeRef.referent_to_string(n)))
+        eq_(loaded.left_ref.address, 123)
+        eq_(loaded.key, 'k')
+        eq_(loaded.value_ref.address, 999)
+        eq_(loaded.right_ref.address, 321)
+        eq_(loaded.length, 3)
+
+    def test_reads_pickled_nodes(self):
+        pickled = pickle.dumps({
+            'left': 123, 'key': 'k', 'value': 999, 'right': 321, 'length': 3,
+        })
+        loaded = BinaryNodeRef.string_to_referent(pickled)
+        eq_(loaded.left_ref.address, 123)
+        eq_(loaded.key, 'k')
+        eq_(loaded.value_ref.address, 999)
+        eq_(loaded.right_ref.address, 321)
+        eq_(loaded.length, 3)
+
+    def test_key_types_survive(self):
+        for key in ['k', u'\xe9', b'\x00b', 42, -7, 2 ** 70, (1, 'a')]:
+            n = BinaryNode(
+                BinaryNodeRef(), key, ValueRef(address=1), BinaryNodeRef(), 1)
+            loaded = BinaryNodeRef.string_to_referent(
+                BinaryNodeRef.referent_to_string(n))
+            eq_(loaded.key, key)
+            eq_(type(loaded.key), type(key))
+
+    def test_encoding_is_smaller_than_pickle(self):
+        n = BinaryNode(
+            BinaryNodeRef(address=123), 'key', ValueRef(address=999),
+            BinaryNodeRef(address=321), 3)
+        assert (len(BinaryNodeRef.referent_to_string(n)) <
+                len(BinaryNodeRef.referent_to_pickle(n)))
+
+    def test_wide_addresses(self):
+        n = BinaryNode(
+            BinaryNodeRef(address=2 ** 40), 'k', ValueRef(address=999),
+            BinaryNodeRef(address=321), 3)
+        loaded = BinaryNodeRef.string_to_referent(
+            BinaryNodeRef.referent_to_string(n))
+        eq_(loaded.left_ref.address, 2 ** 40)
+        eq_(loaded.value_ref.address, 999)
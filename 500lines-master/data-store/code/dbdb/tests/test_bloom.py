@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+
+from dbdb.bloom import BloomFilter
+
+
+class TestBloomFilter(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'test.bloom')
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000)
+        keys = ['key%d' % i for i in range(1000)] + [b'bytes', 7, (1, 2)]
+        for key in keys:
+            bloom.add(key)
+        for key in keys:
+            assert key in bloom
+        eq_(bloom.count, len(keys))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('in%d' % i)
+        false_positives = sum(1 for i in range(10000) if 'out%d' % i in bloom)
+        assert false_positives < 300
+        assert 0.005 < bloom.expected_false_positive_rate < 0.02
+        assert not bloom.full
+        bloom.add('one too many')
+        assert bloom.full
+
+    def test_save_and_load(self):
+        bloom = BloomFilter.from_keys(['a', 'b'], 2, 7, 4096)
+        bloom.save(self.path)
+        loaded = BloomFilter.load(self.path)
+        assert loaded.describes(7, 4096)
+        assert not loaded.describes(7, 4097)
+        assert 'a' in loaded and 'b' in loaded
+        eq_(loaded.count, 2)
+        eq_(os.listdir(self.temp_dir), ['test.bloom'])
+
+    def test_load_missing_or_damaged(self):
+        eq_(BloomFilter.load(self.path), None)
+        with open(self.path, 'wb') as f:
+            f.write(b'not a filter')
+        eq_(BloomFilter.load(self.path), None)
@@ -0,0 +1,137 @@
+import random
+
+from nose.tools import assert_raises, eq_
+
+from dbdb.bplus_tree import BPlusBranch, BPlusLeaf, BPlusNodeRef, BPlusTree
+from dbdb.logical import ValueRef
+from dbdb.tests.test_binary_tree import StubStorage, check_scans
+
+
+class SmallPageBPlusTree(BPlusTree):
+    max_keys = 4
+
+
+class TestBPlusTree(object):
+    def setup(self):
+        self.tree = SmallPageBPlusTree(StubStorage())
+
+    def _check_tree(self, ref, is_root=True, low=None, high=None):
+        node = self.tree._follow(ref)
+        if node is None:
+            return 0, 0
+        if not is_root:
+            assert self.tree.min_keys <= len(node.keys) <= self.tree.max_keys
+        eq_(node.keys, sorted(node.keys))
+        if low is not None:
+            assert low <= node.keys[0]
+        if high is not None:
+            assert node.keys[-1] < high
+        if node.is_leaf:
+            eq_(len(node.keys), len(node.value_refs))
+            return node.length, 1
+        eq_(len(node.child_refs), len(node.keys) + 1)
+        bounds = [low] + node.keys + [high]
+        depths = set()
+        for i, child_ref in enumerate(node.child_refs):
+            length, depth = self._check_tree(
+                child_ref, False, bounds[i], bounds[i + 1])
+            eq_(node.lengths[i], length)
+            depths.add(depth)
+        eq_(len(depths), 1)
+        return node.length, depths.pop() + 1
+
+    def test_get_missing_key_raises_key_error(self):
+        with assert_raises(KeyError):
+            self.tree.get('Not A Key In The Tree')
+
+    def test_sequential_inserts(self):
+        for i in range(500):
+            self.tree.set(i, str(i))
+        length, depth = self._check_tree(self.tree._tree_ref)
+        eq_(length, 500)
+        assert depth <= 8
+        for i in range(500):
+            eq_(self.tree.get(i), str(i))
+
+    def test_scans(self):
+        keys = random.sample(range(10000), 200)
+        for k in keys:
+            self.tree.set(k, str(k))
+        check_scans(self.tree, keys)
+        self.tree.commit()
+        check_scans(self.tree, keys)
+
+    def test_random_set_and_pop_keys(self):
+        keys = random.sample(range(10000), 300)
+        for i, k in enumerate(keys, start=1):
+            self.tree.set(k, str(k))
+            eq_(len(self.tree), i)
+        self._check_tree(self.tree._tree_ref)
+        for k in keys:
+            eq_(self.tree.get(k), str(k))
+        random.shuffle(keys)
+        for i, k in enumerate(keys, start=1):
+            self.tree.pop(k)
+            eq_(len(self.tree), len(keys) - i)
+            if i % 25 == 0:
+                self._check_tree(self.tree._tree_ref)
+            with assert_raises(KeyError):
+                self.tree.get(k)
+        eq_(self.tree._tree_ref.address, 0)
+
+    def test_overwrite_and_get_key(self):
+        self.tree.set('a', 'b')
+        self.tree.set('a', 'c')
+        eq_(self.tree.get('a'), 'c')
+        eq_(len(self.tree), 1)
+
+    def test_pop_non_existent_key(self):
+        self.tree.set('a', 'b')
+        with assert_raises(KeyError):
+            self.tree.pop('Not A Key In The Tree')
+
+    def test_commit_and_reload(self):
+        storage = StubStorage()
+        tree = SmallPageBPlusTree(storage)
+        for i in range(100):
+            tree.set(i, str(i))
+        tree.commit()
+        self.tree = SmallPageBPlusTree(storage)
+        eq_(len(self.tree), 100)
+        self.tree.pop(50)
+        self.tree.set(100, '100')
+        length, depth = self._check_tree(self.tree._tree_ref)
+        eq_(length, 100)
+        eq_(self.tree.get(99), '99')
+
+
+class TestBPlusNodeRef(object):
+    def test_leaf_round_trip(self):
+        n = BPlusLeaf(['a', 'b'], [ValueRef(address=10), ValueRef(address=20)])
+        loaded = BPlusNodeRef.string_to_referent(
+            BPlusNodeRef.referent_to_string(n))
+        assert loaded.is_leaf
+        eq_(loaded.keys, ['a', 'b'])
+        eq_([ref.address for ref in loaded.value_refs], [10, 20])
+
+    def test_branch_round_trip(self):
+        n = BPlusBranch(
+            ['m'], [BPlusNodeRef(address=10), BPlusNodeRef(address=20)],
+            [3, 4])
+        loaded = BPlusNodeRef.string_to_referent(
+            BPlusNodeRef.referent_to_string(n))
+        assert not loaded.is_leaf
+        eq_(loaded.keys, ['m'])
+        eq_([ref.address for ref in loaded.child_refs], [10, 20])
+        eq_(loaded.lengths, [3, 4])
+        eq_(loaded.length, 7)
+
+    def test_reads_pickled_pages(self):
+        n = BPlusBranch(
+            ['m'], [BPlusNodeRef(address=10), BPlusNodeRef(address=20)],
+            [3, 4])
+        loaded = BPlusNodeRef.string_to_referent(
+            BPlusNodeRef.referent_to_pickle(n))
+        eq_(loaded.keys, ['m'])
+        eq_([ref.address for ref in loaded.child_refs], [10, 20])
+        eq_(loaded.lengths, [3, 4])
@@ -0,0 +1,109 @@
+import tempfile
+
+from nose.tools import eq_
+
+from dbdb.binary_tree import BinaryTree
+from dbdb.bplus_tree import BPlusTree
+from dbdb.cache import NodeCache
+from dbdb.physical import Storage
+
+
+class CountingStorage(Storage):
+    def __init__(self, f):
+        self.reads = 0
+        super(CountingStorage, self).__init__(f)
+
+    def read(self, address):
+        self.reads += 1
+        return super(CountingStorage, self).read(address)
+
+
+class TestNodeCache(object):
+    def test_get_and_put(self):
+        cache = NodeCache(100)
+        eq_(cache.get('a'), None)
+        cache.put('a', 'aye', 10)
+        eq_(cache.get('a'), 'aye')
+        eq_((cache.hits, cache.misses), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        cache = NodeCache(30)
+        cache.put('a', 'aye', 10)
+        cache.put('b', 'bee', 10)
+        cache.put('c', 'see', 10)
+        cache.get('a')
+        cache.put('d', 'dee', 10)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('a'), 'aye')
+        eq_(cache.get('d'), 'dee')
+        eq_(cache.evictions, 1)
+        eq_(cache.size, 30)
+
+    def test_oversized_entries_are_not_cached(self):
+        cache = NodeCache(30)
+        cache.put('a', 'aye', 31)
+        eq_(len(cache), 0)
+        eq_(cache.size, 0)
+
+    def test_stats(self):
+        cache = NodeCache(30)
+        cache.put('a', 'aye', 10)
+        cache.get('a')
+        cache.get('b')
+        stats = cache.stats()
+        eq_(stats['hit_rate'], 0.5)
+        eq_(stats['bytes'], 10)
+        eq_(stats['entries'], 1)
+
+
+class TestCachedReads(object):
+    def setup(self):
+        self.f = tempfile.NamedTemporaryFile()
+        self.storage = CountingStorage(self.f)
+        tree = BinaryTree(self.storage)
+        for key in ['m', 'f', 't', 'a', 'h', 'p', 'z']:
+            tree.set(key, key.upper())
+        tree.commit()
+
+    def teardown(self):
+        self.f.close()
+
+    def test_reads_are_shared_through_the_cache(self):
+        cache = NodeCache()
+        tree = BinaryTree(self.storage, cache=cache)
+        eq_(tree.get('h'), 'H')
+        reads = self.storage.reads
+        other_tree = BinaryTree(self.storage, cache=cache)
+        eq_(other_tree.get('h'), 'H')
+        eq_(tree.get('h'), 'H')
+        eq_(self.storage.reads, reads)
+        eq_(cache.misses, reads)
+
+    def test_readers_do_not_pin_nodes(self):
+        cache = NodeCache()
+        tree = BinaryTree(self.storage, cache=cache)
+        tree.get('a')
+        root = tree._follow(tree._tree_ref)
+        eq_(root.left_ref._referent, None)
+
+    def test_small_budget_still_reads_correctly(self):
+        cache = NodeCache(0)
+        tree = BinaryTree(self.storage, cache=cache)
+        for key in ['m', 'f', 't', 'a', 'h', 'p', 'z']:
+            eq_(tree.get(key), key.upper())
+        eq_(len(cache), 0)
+
+    def test_writer_through_cache(self):
+        cache = NodeCache()
+        f = tempfile.NamedTemporaryFile()
+        storage = Storage(f)
+        tree = BPlusTree(storage, cache=cache)
+        tree.set('a', 'A')
+        tree.commit()
+        reader = BPlusTree(storage, cache=cache)
+        eq_(reader.get('a'), 'A')
+        tree.set('b', 'B')
+        tree.commit()
+        eq_(reader.get('b'), 'B')
+        eq_(reader.get('a'), 'A')
+        f.close()
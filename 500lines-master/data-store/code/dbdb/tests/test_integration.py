@@ -1,13 +1,22 @@
+import glob
+import io
 import os
 import os.path
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 
 from nose.tools import assert_raises, eq_
 
 import dbdb
 import dbdb.tool
+from dbdb import encoding
+from dbdb.binary_tree import BinaryNode, BinaryNodeRef
+from dbdb.bloom import BloomFilter
+from dbdb.logical import ValueRef
+from dbdb.physical import RetiredStorageError, Storage
 
 
 class TestDatabase(object):
@@ -44,6 +53,644 @@ class TestDatabase(object):
         eq_(len(db), 3)
         db.close()
 
+    def _count_commits(self, db):
+        commits = []
+        commit_root_address = db._storage.commit_root_address
+
+        def counting_commit_root_address(root_address, unlock=True):
+            commits.append(root_address)
+            commit_root_address(root_address, unlock)
+        db._storage.commit_root_address = counting_commit_root_address
+        return commits
+
+    def test_batch_commits_once(self):
+        db = dbdb.connect(self.tempfile_name)
+        commits = self._count_commits(db)
+        with db.batch():
+            for key in ['m', 'f', 't', 'a']:
+                db[key] = key.upper()
+            with db.batch():
+                del db['f']
+        eq_(len(commits), 1)
+        db.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(len(db), 3)
+        eq_(db['t'], 'T')
+        db.close()
+
+    def test_batch_rolls_back_on_error(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'aye'
+        db.commit()
+        with assert_raises(KeyError):
+            with db.batch():
+                db['b'] = 'bee'
+                del db['not there']
+        assert 'b' not in db
+        assert not db._storage.locked
+        db['c'] = 'see'
+        db.commit()
+        db.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(len(db), 2)
+        db.close()
+
+    def test_empty_batch_keeps_other_commits(self):
+        a = dbdb.connect(self.tempfile_name)
+        b = dbdb.connect(self.tempfile_name)
+        b['x'] = 'ex'
+        b.commit()
+        a['y'] = 'why'
+        a.commit()
+        commits = self._count_commits(b)
+        with b.batch():
+            pass
+        b.commit()
+        eq_(len(commits), 0)
+        assert not b._storage.locked
+        a.close()
+        b.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(db['y'], 'why')
+        db.close()
+
+    def test_batch_rolls_back_on_failed_commit(self):
+        db = dbdb.connect(self.tempfile_name)
+        with assert_raises(AttributeError):
+            with db.batch():
+                db['a'] = 5
+        assert not db.dirty
+        assert not db._storage.locked
+        with db.batch():
+            db['b'] = 'bee'
+        db.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(list(db.keys()), ['b'])
+        db.close()
+
+    def test_group_commit(self):
+        db = dbdb.connect(self.tempfile_name, group_commit=True,
+                          durability=dbdb.SYNC_EACH_COMMIT)
+        db.lock()
+        db.commit()
+        assert not db._storage.locked
+        commits = []
+        finish_commit = db._storage.finish_commit
+        sync_flushed = db._storage.sync_flushed
+
+        def counting_finish_commit(root_address, commit_address):
+            commits.append(root_address)
+            finish_commit(root_address, commit_address)
+
+        def slow_sync_flushed():
+            # As on a disk where syncs take a while.
+            time.sleep(0.005)
+            sync_flushed()
+        db._storage.finish_commit = counting_finish_commit
+        db._storage.sync_flushed = slow_sync_flushed
+        started = threading.Event()
+
+        def writer(i):
+            started.wait()
+            for j in range(20):
+                db['%02d-%02d' % (i, j)] = str(j)
+                db.commit()
+        threads = [threading.Thread(target=writer, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        started.set()
+        for thread in threads:
+            thread.join()
+        # Writers that committed while another's commit was syncing shared
+        # the next one.
+        assert len(commits) < 80, len(commits)
+        assert not db._storage.locked
+        assert not db.dirty
+        db.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(len(db), 160)
+        db.close()
+
+    def test_avl_tree_persistence(self):
+        db = dbdb.connect(self.tempfile_name, tree_class=dbdb.AVLTree)
+        for i in range(100):
+            db['%03d' % i] = str(i)
+        db.commit()
+        db.close()
+        db = dbdb.connect(self.tempfile_name, tree_class=dbdb.AVLTree)
+        eq_(len(db), 100)
+        eq_(db['042'], '42')
+        db.close()
+
+    def test_readonly_sees_new_commits(self):
+        db = dbdb.connect(self.tempfile_name, tree_class=dbdb.AVLTree)
+        db['a'] = 'aye'
+        db.commit()
+        reader = dbdb.connect(
+            self.tempfile_name, tree_class=dbdb.AVLTree, readonly=True)
+        eq_(reader['a'], 'aye')
+        for i in range(500):
+            db['%03d' % i] = str(i)
+        db.commit()
+        eq_(reader['499'], '499')
+        eq_(len(reader), 501)
+        with assert_raises(io.UnsupportedOperation):
+            reader['b'] = 'bee'
+        reader.close()
+        db.close()
+
+    def _fill_with_garbage(self, tree_class):
+        db = dbdb.connect(self.tempfile_name, tree_class=tree_class)
+        for i in range(50):
+            db['%02d' % i] = 'first'
+            db.commit()
+        for i in range(0, 50, 2):
+            db['%02d' % i] = 'second'
+            db.commit()
+        for i in range(0, 50, 5):
+            del db['%02d' % i]
+            db.commit()
+        db.close()
+
+    def _check_compact(self, tree_class):
+        self._fill_with_garbage(tree_class)
+        size_before = os.path.getsize(self.tempfile_name)
+        dbdb.compact(self.tempfile_name, tree_class=tree_class)
+        assert os.path.getsize(self.tempfile_name) < size_before / 4
+        db = dbdb.connect(self.tempfile_name, tree_class=tree_class)
+        eq_(len(db), 40)
+        eq_(db['01'], 'first')
+        eq_(db['02'], 'second')
+        assert '05' not in db
+        db['05'] = 'third'
+        db.commit()
+        db.close()
+
+    def test_compact_binary_tree(self):
+        self._check_compact(dbdb.BinaryTree)
+
+    def test_compact_avl_tree(self):
+        self._check_compact(dbdb.AVLTree)
+
+    def test_compact_bplus_tree(self):
+        self._check_compact(dbdb.BPlusTree)
+
+    def test_tree_kind_is_recorded(self):
+        self._fill_with_garbage(dbdb.AVLTree)
+        db = dbdb.connect(self.tempfile_name)
+        assert isinstance(db._tree, dbdb.AVLTree)
+        db.close()
+        with assert_raises(dbdb.WrongTreeError):
+            dbdb.connect(self.tempfile_name, tree_class=dbdb.BinaryTree)
+        with assert_raises(dbdb.WrongTreeError):
+            dbdb.connect(self.tempfile_name, tree_class=dbdb.BPlusTree,
+                         readonly=True)
+        with assert_raises(dbdb.WrongTreeError):
+            dbdb.compact(self.tempfile_name, tree_class=dbdb.BPlusTree)
+        dbdb.compact(self.tempfile_name)
+        db = dbdb.connect(self.tempfile_name, readonly=True)
+        assert isinstance(db._tree, dbdb.AVLTree)
+        eq_(len(db), 40)
+        db.close()
+        dbdb.bulk_load(self.new_tempfile_name, [('a', 'aye')],
+                       tree_class=dbdb.BPlusTree)
+        db = dbdb.connect(self.new_tempfile_name)
+        assert isinstance(db._tree, dbdb.BPlusTree)
+        db.close()
+
+    def test_migrate_pickled_file(self):
+        with open(self.tempfile_name, 'r+b') as f:
+            storage = Storage(f)
+            value_address = storage.write(b'aye')
+            root_address = storage.write(BinaryNodeRef.referent_to_pickle(
+                BinaryNode(BinaryNodeRef(), 'a', ValueRef(address=value_address),
+                           BinaryNodeRef(), 1)))
+            storage.commit_root_address(root_address)
+        db = dbdb.connect(self.tempfile_name)
+        eq_(db['a'], 'aye')
+        db.close()
+        eq_(dbdb.tool.main(['dbdb.tool', self.tempfile_name, 'migrate']),
+            dbdb.tool.OK)
+        with open(self.tempfile_name, 'rb') as f:
+            storage = Storage(f)
+            assert encoding.is_encoded(storage.read(storage.get_root_address()))
+        db = dbdb.connect(self.tempfile_name)
+        eq_(db['a'], 'aye')
+        db.close()
+
+    def test_compact_with_open_reader_and_writer(self):
+        self._fill_with_garbage(dbdb.BinaryTree)
+        reader = dbdb.connect(self.tempfile_name)
+        writer = dbdb.connect(self.tempfile_name)
+        eq_(reader['01'], 'first')
+        dbdb.compact(self.tempfile_name)
+        eq_(reader['03'], 'first')
+        with assert_raises(RetiredStorageError):
+            writer['03'] = 'lost'
+        reader.close()
+        writer.close()
+
+    def test_compression(self):
+        value = 'compressible ' * 100
+        db = dbdb.connect(self.tempfile_name, compression='zlib')
+        db['a'] = value
+        db['b'] = 'short'
+        db['c'] = encoding.PREFIX.decode('latin-1') + 'looks encoded'
+        db.commit()
+        db.close()
+        assert os.path.getsize(self.tempfile_name) < Storage.SUPERBLOCK_SIZE + 500
+        db = dbdb.connect(self.tempfile_name)
+        eq_(db['a'], value)
+        eq_(db['b'], 'short')
+        eq_(db['c'], encoding.PREFIX.decode('latin-1') + 'looks encoded')
+        db.close()
+        with assert_raises(ValueError):
+            dbdb.connect(self.tempfile_name, compression='rot13')
+
+    def test_overflow_survives_compaction(self):
+        values = dict(('%02d' % i, os.urandom(500).hex()) for i in range(20))
+        db = dbdb.connect(self.tempfile_name, tree_class=dbdb.AVLTree,
+                          overflow_threshold=256)
+        for key, value in sorted(values.items()):
+            db[key] = value
+            db.commit()
+        old_blobs = db._storage.blobs_name
+        db.close()
+        assert os.path.getsize(old_blobs) >= 20 * 1000
+        dbdb.compact(self.tempfile_name, dbdb.AVLTree, compression='lzma',
+                     overflow_threshold=256)
+        assert not os.path.exists(old_blobs)
+        db = dbdb.connect(self.tempfile_name, tree_class=dbdb.AVLTree)
+        eq_(dict(db.items()), values)
+        assert db._storage.blobs_name != old_blobs
+        db.close()
+        reader = dbdb.connect(self.tempfile_name, tree_class=dbdb.AVLTree,
+                              readonly=True)
+        eq_(reader['07'], values['07'])
+        reader.close()
+
+    def test_nodes_never_overflow(self):
+        db = dbdb.connect(self.tempfile_name, tree_class=dbdb.BPlusTree,
+                          overflow_threshold=512)
+        for i in range(500):
+            db['%03d' % i] = 'small'
+        db['big'] = 'x' * 1000
+        db.commit()
+        eq_(os.path.getsize(db._storage.blobs_name), 1000)
+        db.close()
+
+    def test_overflow_segment_made_only_when_needed(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'aye'
+        db.commit()
+        blobs_name = db._storage.blobs_name
+        db.close()
+        db = dbdb.connect(self.tempfile_name, overflow_threshold=256)
+        db['b'] = 'bee'
+        db.commit()
+        db.close()
+        dbdb.connect(self.tempfile_name, readonly=True).close()
+        assert not os.path.exists(blobs_name)
+        db = dbdb.connect(self.tempfile_name, overflow_threshold=256)
+        db['c'] = 'c' * 1000
+        db.commit()
+        db.close()
+        db = dbdb.connect(self.tempfile_name, overflow_threshold=256)
+        db['d'] = 'd' * 1000
+        db.commit()
+        eq_(os.path.getsize(blobs_name), 2000)
+        eq_(db['c'], 'c' * 1000)
+        db.close()
+
+    def test_bloom_filter(self):
+        db = dbdb.connect(self.tempfile_name, bloom=True)
+        for i in range(100):
+            db['%03d' % (i * 7919 % 1000)] = 'x'
+        db.commit()
+        assert os.path.exists(self.tempfile_name + '.bloom')
+        eq_(db.get('000'), 'x')
+        eq_(db.get('missing', 'default'), 'default')
+        reads = []
+        original_read = db._storage.read
+        db._storage.read = lambda address: reads.append(address) or \
+            original_read(address)
+        misses = sum(1 for i in range(1000) if 'miss%d' % i not in db)
+        eq_(misses, 1000)
+        stats = db.bloom_stats()
+        eq_(stats['negatives'] + stats['false_positives'], 1001)
+        assert stats['false_positive_rate'] < 0.05
+        assert len(reads) < 200
+        db.close()
+
+    def test_bloom_filter_follows_other_writers(self):
+        db = dbdb.connect(self.tempfile_name, bloom=True)
+        db['a'] = 'aye'
+        db.commit()
+        # A writer without the filter leaves it stale...
+        other = dbdb.connect(self.tempfile_name)
+        other['b'] = 'bee'
+        other.commit()
+        other.close()
+        loads = []
+        load = BloomFilter.__dict__['load']
+
+        def counting_load(cls, path):
+            loads.append(path)
+            return load.__func__(cls, path)
+        BloomFilter.load = classmethod(counting_load)
+        try:
+            eq_(db['b'], 'bee')
+            for key in 'xyz':
+                assert key not in db
+        finally:
+            BloomFilter.load = load
+        eq_(db.bloom_stats()['stale'], 4)
+        # The sidecar is only read once for the commit it doesn't describe.
+        eq_(len(loads), 1)
+        # ...until the next writer with one rebuilds it.
+        db['c'] = 'see'
+        db.commit()
+        reopened = dbdb.connect(self.tempfile_name, bloom=True)
+        for key in 'abc':
+            assert key in reopened
+        assert 'd' not in reopened
+        eq_(reopened.bloom_stats()['stale'], 0)
+        reopened.close()
+        db.close()
+        plain = dbdb.connect(self.tempfile_name)
+        eq_(plain.bloom_stats(), None)
+        plain.close()
+
+    def test_scans(self):
+        db = dbdb.connect(self.tempfile_name, tree_class=dbdb.AVLTree)
+        for key in ['apple', 'apricot', 'banana', 'cherry', u'b\U0010ffff']:
+            db[key] = key.upper()
+        db.commit()
+        eq_(list(db), ['apple', 'apricot', 'banana', u'b\U0010ffff', 'cherry'])
+        eq_(list(reversed(db))[0], 'cherry')
+        eq_(list(db.keys('apricot', 'cherry')), ['apricot', 'banana',
+                                                 u'b\U0010ffff'])
+        eq_(list(db.items('b', 'c')), [('banana', 'BANANA'),
+                                       (u'b\U0010ffff', u'B\U0010ffff')])
+        eq_(list(db.prefix_items('ap')), [('apple', 'APPLE'),
+                                          ('apricot', 'APRICOT')])
+        eq_([k for k, v in db.prefix_items('b', reverse=True)],
+            [u'b\U0010ffff', 'banana'])
+        eq_(list(db.prefix_items(u'b\U0010ffff')),
+            [(u'b\U0010ffff', u'B\U0010ffff')])
+        eq_(db.nth(2), ('banana', 'BANANA'))
+        eq_(db.nth(-1), ('cherry', 'CHERRY'))
+        keys = db.keys()
+        eq_(next(keys), 'apple')
+        db['aardvark'] = 'AARDVARK'
+        db.commit()
+        # A scan carries on with the tree it started with.
+        eq_(list(keys), ['apricot', 'banana', u'b\U0010ffff', 'cherry'])
+        db.close()
+
+    def test_snapshot_keeps_its_commit(self):
+        db = dbdb.connect(self.tempfile_name, tree_class=dbdb.AVLTree)
+        db['a'] = 'one'
+        db['b'] = 'one'
+        db.commit()
+        snapshot = db.snapshot()
+        db['a'] = 'two'
+        del db['b']
+        db['c'] = 'two'
+        # Uncommitted changes aren't in a new snapshot either.
+        eq_(db.snapshot()['a'], 'one')
+        db.commit()
+        eq_(snapshot['a'], 'one')
+        eq_(list(snapshot.items()), [('a', 'one'), ('b', 'one')])
+        eq_(len(snapshot), 2)
+        assert 'c' not in snapshot
+        eq_(db.snapshot()['a'], 'two')
+        eq_(len(db.snapshot()), 2)
+        dbdb.compact(self.tempfile_name, tree_class=dbdb.AVLTree)
+        eq_(snapshot['b'], 'one')
+        db.close()
+        with assert_raises(ValueError):
+            snapshot['a']
+
+    def test_snapshot_of_empty_database(self):
+        db = dbdb.connect(self.tempfile_name)
+        snapshot = db.snapshot()
+        eq_(len(snapshot), 0)
+        eq_(list(snapshot), [])
+        db.close()
+
+    def test_transaction_merges_with_other_writers(self):
+        db = dbdb.connect(self.tempfile_name)
+        other = dbdb.connect(self.tempfile_name)
+        db['count'] = '1'
+        db.commit()
+        calls = []
+
+        def increment(transaction):
+            calls.append(1)
+            count = int(transaction['count'])
+            if len(calls) == 1:
+                other['unrelated'] = 'x'
+                other.commit()
+            transaction['count'] = str(count + 1)
+            return count + 1
+
+        eq_(db.transaction(increment), 2)
+        eq_(len(calls), 1)
+        eq_(db['count'], '2')
+        eq_(db['unrelated'], 'x')
+        db.close()
+        other.close()
+
+    def test_transaction_retries_on_conflict(self):
+        db = dbdb.connect(self.tempfile_name)
+        other = dbdb.connect(self.tempfile_name)
+        db['count'] = '1'
+        db.commit()
+        calls = []
+
+        def increment(transaction):
+            calls.append(1)
+            count = int(transaction['count'])
+            if len(calls) == 1:
+                other['count'] = '10'
+                other.commit()
+            transaction['count'] = str(count + 1)
+
+        db.transaction(increment)
+        eq_(len(calls), 2)
+        eq_(db['count'], '11')
+
+        def always_loses(transaction):
+            # Each try starts without the lock.
+            assert not db._storage.locked
+            transaction['count'] = str(int(transaction['count']) + 1)
+            other['count'] = '0'
+            other.commit()
+
+        with assert_raises(dbdb.ConflictError):
+            db.transaction(always_loses, retries=2)
+        eq_(db['count'], '0')
+        # The lock was let go, so other writers aren't stuck.
+        other['count'] = '5'
+        other.commit()
+        db.close()
+        other.close()
+
+    def test_transaction_deletes(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = '1'
+        db.commit()
+
+        def move(transaction):
+            transaction['b'] = transaction['a']
+            del transaction['a']
+            assert 'a' not in transaction
+            with assert_raises(KeyError):
+                del transaction['a']
+
+        db.transaction(move)
+        eq_(list(db.items()), [('b', '1')])
+        db.close()
+
+    def test_transaction_refuses_uncommitted_changes(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = '1'
+        calls = []
+        with assert_raises(ValueError):
+            db.transaction(calls.append)
+        eq_(calls, [])
+        assert db.dirty
+        db.rollback()
+        db.transaction(calls.append)
+        eq_(len(calls), 1)
+        assert 'a' not in db
+        assert not db._storage.locked
+        db.close()
+
+    def test_durable_commits(self):
+        for durability in ('none', 'commit', 'periodic'):
+            db = dbdb.connect(self.tempfile_name, durability=durability,
+                              sync_interval=0.01)
+            db[durability] = 'yes'
+            db.commit()
+            db.close()
+        db = dbdb.connect(self.tempfile_name)
+        eq_(sorted(db), ['commit', 'none', 'periodic'])
+        db.close()
+
+    def test_recover(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'one'
+        db.commit()
+        db['a'] = 'two'
+        db.commit()
+        root_address = db._storage.get_root_address()
+        db.close()
+        with open(self.tempfile_name, 'r+b') as f:
+            # Damage the last node written, the root.
+            f.seek(root_address + Storage.RECORD_HEADER.size)
+            f.write(b'X')
+        db = dbdb.connect(self.tempfile_name)
+        with assert_raises(dbdb.CorruptRecordError):
+            db['a']
+        db.close()
+        eq_(dbdb.tool.main(['dbdb.tool', self.tempfile_name, 'recover']),
+            dbdb.tool.OK)
+        db = dbdb.connect(self.tempfile_name)
+        eq_(db['a'], 'one')
+        db.close()
+
+    def test_recover_renews_file_id(self):
+        cache = dbdb.NodeCache()
+        db = dbdb.connect(self.tempfile_name, cache=cache)
+        db['a'] = 'one'
+        db.commit()
+        db['a'] = 'two'
+        db.commit()
+        root_address = db._storage.get_root_address()
+        db.close()
+        reader = dbdb.connect(self.tempfile_name, cache=cache, readonly=True)
+        eq_(reader['a'], 'two')
+        with open(self.tempfile_name, 'r+b') as f:
+            f.seek(root_address + Storage.RECORD_HEADER.size)
+            f.write(b'X')
+        eq_(dbdb.tool.main(['dbdb.tool', self.tempfile_name, 'recover']),
+            dbdb.tool.OK)
+        # The new commit goes where the one cut off was; the reader mustn't
+        # take what it cached from there for it.
+        db = dbdb.connect(self.tempfile_name, cache=cache)
+        db['a'] = 'six'
+        db.commit()
+        eq_(db._storage.get_root_address(), root_address)
+        eq_(reader['a'], 'six')
+        reader.close()
+        db.close()
+
+    def _check_bulk_load(self, tree_class, count):
+        os.remove(self.tempfile_name)
+        keys = ['%05d' % i for i in range(count)]
+        dbdb.bulk_load(self.tempfile_name, ((key, key * 2) for key in keys),
+                       tree_class=tree_class)
+        db = dbdb.connect(self.tempfile_name, tree_class=tree_class)
+        eq_(len(db), count)
+        for key in keys:
+            eq_(db[key], key * 2)
+        assert '%05d' % count not in db
+        db['zzz'] = 'after'
+        for key in keys[::3]:
+            del db[key]
+        db.commit()
+        eq_(len(db), count + 1 - len(keys[::3]))
+        db.close()
+
+    def test_bulk_load_binary_tree(self):
+        for count in (0, 1, 2, 6, 7, 8, 100):
+            self._check_bulk_load(dbdb.BinaryTree, count)
+
+    def test_bulk_load_avl_tree(self):
+        self._check_bulk_load(dbdb.AVLTree, 1000)
+
+    def test_bulk_load_bplus_tree(self):
+        tree_class = type('SmallPageBPlusTree', (dbdb.BPlusTree,),
+                          {'max_keys': 4})
+        for count in (0, 1, 4, 5, 9, 20, 21, 22, 100):
+            self._check_bulk_load(tree_class, count)
+        self._check_bulk_load(dbdb.BPlusTree, 2000)
+
+    def test_bulk_load_balances_binary_tree(self):
+        os.remove(self.tempfile_name)
+        dbdb.bulk_load(self.tempfile_name, ((i, str(i)) for i in range(1000)))
+        with open(self.tempfile_name, 'r+b') as f:
+            storage = Storage(f)
+            tree = dbdb.BinaryTree(storage)
+
+            def height(ref):
+                node = ref.peek(storage)
+                if node is None:
+                    return 0
+                return max(height(node.left_ref), height(node.right_ref)) + 1
+            eq_(height(tree._tree_ref), 10)
+
+    def test_bulk_load_rejects_unsorted_input(self):
+        os.remove(self.tempfile_name)
+        with assert_raises(ValueError):
+            dbdb.bulk_load(self.tempfile_name, [('b', '1'), ('a', '2')])
+        assert not os.path.exists(self.tempfile_name)
+        assert not os.path.exists(self.tempfile_name + '.load')
+
+    def test_bulk_load_refuses_existing_data(self):
+        db = dbdb.connect(self.tempfile_name)
+        db['a'] = 'aye'
+        db.commit()
+        db.close()
+        with assert_raises(ValueError):
+            dbdb.bulk_load(self.tempfile_name, [('b', 'bee')])
+        db = dbdb.connect(self.tempfile_name)
+        eq_(db['a'], 'aye')
+        db.close()
+
 
 class TestTool(object):
     def setup(self):
@@ -66,6 +713,70 @@ class TestTool(object):
             self._tool('get', 'a')
         eq_(raised.exception.returncode, dbdb.tool.BAD_KEY)
 
+    def test_set_and_delete_many(self):
+        self._tool('set', 'a', b'1', 'b', b'2', 'c', b'3')
+        eq_(self._tool('get', 'b'), b'2')
+        self._tool('delete', 'a', 'c')
+        eq_(self._tool('get', 'b'), b'2')
+        with assert_raises(subprocess.CalledProcessError) as raised:
+            self._tool('get', 'c')
+        eq_(raised.exception.returncode, dbdb.tool.BAD_KEY)
+        with assert_raises(subprocess.CalledProcessError) as raised:
+            self._tool('set', 'a', b'1', 'b')
+        eq_(raised.exception.returncode, dbdb.tool.BAD_ARGS)
+
+    def test_compact(self):
+        self._tool('set', 'a', b'b')
+        self._tool('set', 'a', b'c')
+        self._tool('compact')
+        eq_(self._tool('get', 'a'), b'c')
+
+    def test_bad_args(self):
+        with assert_raises(subprocess.CalledProcessError) as raised:
+            self._tool('compact', 'a')
+        eq_(raised.exception.returncode, dbdb.tool.BAD_ARGS)
+        with assert_raises(subprocess.CalledProcessError) as raised:
+            self._tool('--tree', 'heap', 'compact')
+        eq_(raised.exception.returncode, dbdb.tool.BAD_ARGS)
+
+    def test_compact_options(self):
+        value = b'compressible ' * 100
+        self._tool('set', 'a', value)
+        self._tool('--compression', 'zlib', 'compact')
+        assert os.path.getsize(self.tempfile_name) < (
+            Storage.SUPERBLOCK_SIZE + 500)
+        blobs = glob.glob(self.tempfile_name + '.*.blobs')
+        try:
+            eq_(blobs, [])
+            self._tool('--overflow-threshold', '100', 'migrate')
+            blobs = glob.glob(self.tempfile_name + '.*.blobs')
+            eq_(len(blobs), 1)
+            eq_(os.path.getsize(blobs[0]), len(value))
+            eq_(self._tool('get', 'a'), value)
+        finally:
+            for name in blobs:
+                os.remove(name)
+
+    def test_tree_option(self):
+        self._tool('--tree', 'avl', 'set', 'a', b'1', 'b', b'2')
+        self._tool('set', 'c', b'3')
+        self._tool('compact')
+        eq_(self._tool('--tree=avl', 'get', 'c'), b'3')
+        with assert_raises(subprocess.CalledProcessError) as raised:
+            self._tool('--tree', 'bplus', 'compact')
+        eq_(raised.exception.returncode, dbdb.tool.BAD_TREE)
+        assert b"'avl'" in raised.exception.output
+
+    def test_import(self):
+        with tempfile.NamedTemporaryFile('w', delete=False) as pairs_f:
+            pairs_f.write('a\t1\nb\t2\nc\tthree\n')
+        try:
+            self._tool('import', pairs_f.name)
+        finally:
+            os.remove(pairs_f.name)
+        eq_(self._tool('get', 'c'), b'three')
+        eq_(self._tool('get', 'a'), b'1')
+
     def test_tool(self):
         expected = b'b'
         self._tool('set', 'a', expected)
@@ -1,9 +1,14 @@
+import io
 import os
+import struct
 import tempfile
+import time
+import zlib
 
-from nose.tools import eq_
+from nose.tools import assert_raises, eq_
 
-from dbdb.physical import Storage
+from dbdb.physical import (
+    CorruptRecordError, MmapStorage, RetiredStorageError, Storage)
 
 
 class TestStorage(object):
@@ -23,7 +28,11 @@ class TestStorage(object):
             return f.read()
 
     def test_init_ensures_superblock(self):
-        EMPTY_SUPERBLOCK = (b'\x00' * Storage.SUPERBLOCK_SIZE)
+        EMPTY_SUPERBLOCK = (
+            b'\x00' * Storage.RECORD_FORMAT_ADDRESS +
+            b'\x00\x00\x00\x00\x00\x00\x00\x01' +
+            b'\x00' * (Storage.SUPERBLOCK_SIZE -
+                       Storage.RECORD_FORMAT_ADDRESS - 8))
         self.f.seek(0, os.SEEK_END)
         value = self._get_f_contents()
         eq_(value, EMPTY_SUPERBLOCK)
@@ -32,14 +41,92 @@ class TestStorage(object):
         self.p.write(b'ABCDE')
         value = self._get_f_contents()
         superblock, data = self._get_superblock_and_data(value)
-        eq_(data, b'\x00\x00\x00\x00\x00\x00\x00\x05ABCDE')
+        prefix = b'\x00\x00\x00\x00\x00\x00\x00\x05d'
+        checksum = zlib.crc32(b'ABCDE', zlib.crc32(prefix)) & 0xffffffff
+        eq_(data, prefix + struct.pack('!I', checksum) + b'ABCDE')
 
     def test_read(self):
+        prefix = b'\x00\x00\x00\x00\x00\x00\x00\x08d'
+        checksum = zlib.crc32(b'01234567', zlib.crc32(prefix)) & 0xffffffff
         self.f.seek(Storage.SUPERBLOCK_SIZE)
-        self.f.write(b'\x00\x00\x00\x00\x00\x00\x00\x0801234567')
+        self.f.write(prefix + struct.pack('!I', checksum) + b'01234567')
         value = self.p.read(Storage.SUPERBLOCK_SIZE)
         eq_(value, b'01234567')
 
+    def test_read_damaged_record(self):
+        address = self.p.write(b'01234567')
+        self.f.flush()
+        self.f.seek(address + Storage.RECORD_HEADER.size + 3)
+        self.f.write(b'X')
+        with assert_raises(CorruptRecordError):
+            self.p.read(address)
+
+    def test_commit_appends_commit_record(self):
+        address = self.p.write(b'one')
+        self.p.commit_root_address(address)
+        self.f.seek(Storage.COMMIT_ADDRESS)
+        commit_address = struct.unpack('!Q', self.f.read(8))[0]
+        eq_(self.p._read_record(commit_address),
+            (Storage.COMMIT_RECORD, struct.pack('!Q', address)))
+
+    def test_open_cuts_torn_tail(self):
+        address = self.p.write(b'one')
+        self.p.commit_root_address(address)
+        size = len(self._get_f_contents())
+        self.p.write(b'never committed')
+        self.p.unlock()
+        self.f.write(b'\x00\x00\x00')
+        eq_(Storage(self.f).get_root_address(), address)
+        eq_(len(self._get_f_contents()), size)
+
+    def test_open_recovers_from_damaged_commit(self):
+        first = self.p.write(b'one')
+        self.p.commit_root_address(first)
+        size = len(self._get_f_contents())
+        second = self.p.write(b'two')
+        self.p.commit_root_address(second)
+        # As if the superblock reached the disk, but not the second node.
+        self.f.seek(second + Storage.RECORD_HEADER.size)
+        self.f.write(b'XXX')
+        self.f.flush()
+        p = Storage(self.f)
+        eq_(p.get_root_address(), second)
+        with assert_raises(CorruptRecordError):
+            p.read(second)
+        eq_(p.recover(), first)
+        eq_(p.get_root_address(), first)
+        eq_(p.read(first), b'one')
+        eq_(len(self._get_f_contents()), size)
+        # And with the commit record itself damaged, opening recovers.
+        p.commit_root_address(p.write(b'three'))
+        self.f.seek(Storage.COMMIT_ADDRESS)
+        commit_address = struct.unpack('!Q', self.f.read(8))[0]
+        self.f.seek(commit_address + Storage.RECORD_HEADER.size)
+        self.f.write(b'X')
+        self.f.flush()
+        eq_(Storage(self.f).get_root_address(), first)
+
+    def test_unknown_durability(self):
+        with assert_raises(ValueError):
+            Storage(self.f, durability='sometimes')
+
+    def test_sync_each_commit(self):
+        p = Storage(self.f, durability='commit')
+        syncs = []
+        p.sync = lambda: syncs.append(1)
+        p.commit_root_address(p.write(b'one'))
+        eq_(len(syncs), 2)
+
+    def test_sync_periodically(self):
+        p = Storage(self.f, durability='periodic', sync_interval=0.05)
+        p.commit_root_address(p.write(b'one'))
+        assert p._unsynced
+        assert p._sync_timer is not None
+        p.commit_root_address(p.write(b'two'))
+        time.sleep(0.2)
+        assert not p._unsynced
+        assert p._sync_timer is None
+
     def test_commit_root_address(self):
         self.p.commit_root_address(257)
         root_bytes = self._get_f_contents()[:8]
@@ -64,3 +151,164 @@ class TestStorage(object):
         eq_(self.p.read(a3), b'three')
         eq_(self.p.read(a4), b'four')
         eq_(self.p.get_root_address(), a4)
+
+    def test_retire(self):
+        self.p.retire()
+        self.p.unlock()
+        with assert_raises(RetiredStorageError):
+            self.p.write(b'one')
+        assert not self.p.locked
+
+    def test_identity_is_fixed_by_first_commit(self):
+        before = self.p.identity
+        eq_(before[-1], 0)
+        self.p.commit_root_address(self.p.write(b'one'))
+        after = self.p.identity
+        assert after[-1] != 0
+        eq_(Storage(self.f).identity, after)
+
+
+class TestPlainRecordStorage(object):
+    # Files written before records had checksums.
+
+    def setup(self):
+        self.f = tempfile.NamedTemporaryFile()
+        self.f.write(b'\x00' * Storage.SUPERBLOCK_SIZE)
+        self.f.flush()
+        self.p = Storage(self.f)
+
+    def _get_f_contents(self):
+        self.f.flush()
+        with open(self.f.name, 'rb') as f:
+            return f.read()
+
+    def test_write(self):
+        self.p.write(b'ABCDE')
+        data = self._get_f_contents()[Storage.SUPERBLOCK_SIZE:]
+        eq_(data, b'\x00\x00\x00\x00\x00\x00\x00\x05ABCDE')
+
+    def test_read(self):
+        self.f.seek(Storage.SUPERBLOCK_SIZE)
+        self.f.write(b'\x00\x00\x00\x00\x00\x00\x00\x0801234567')
+        value = self.p.read(Storage.SUPERBLOCK_SIZE)
+        eq_(value, b'01234567')
+
+    def test_workflow(self):
+        a1 = self.p.write(b'one')
+        self.p.commit_root_address(a1)
+        eq_(Storage(self.f).read(a1), b'one')
+        reader = MmapStorage(open(self.f.name, 'rb'))
+        eq_(bytes(reader.read(reader.get_root_address())), b'one')
+        reader.close()
+
+    def test_cannot_recover(self):
+        with assert_raises(io.UnsupportedOperation):
+            self.p.recover()
+
+
+class TestOverflowStorage(object):
+
+    def setup(self):
+        self.f = tempfile.NamedTemporaryFile()
+        self.p = Storage(self.f, overflow_threshold=100)
+
+    def teardown(self):
+        blobs_name = self.p.blobs_name
+        self.p.close()
+        if blobs_name and os.path.exists(blobs_name):
+            os.remove(blobs_name)
+
+    def test_small_records_stay_inline(self):
+        address = self.p.write_value(b'small')
+        eq_(self.p.read(address), b'small')
+        eq_(self.p.blobs_name, None)
+
+    def test_only_values_overflow(self):
+        address = self.p.write(b'x' * 1000)
+        self.p.commit_root_address(address)
+        eq_(self.p.read(address), b'x' * 1000)
+        assert not os.path.exists(self.p.blobs_name)
+
+    def test_large_records_overflow(self):
+        address = self.p.write_value(b'x' * 1000)
+        self.p.commit_root_address(address)
+        self.f.flush()
+        self.f.seek(0, os.SEEK_END)
+        assert self.f.tell() < Storage.SUPERBLOCK_SIZE + 100
+        eq_(self.p.read(address), b'x' * 1000)
+        eq_(os.path.getsize(self.p.blobs_name), 1000)
+        reader = Storage(open(self.f.name, 'r+b'))
+        eq_(reader.read(address), b'x' * 1000)
+        reader.close()
+        mapped = self.p.read_only()
+        eq_(bytes(mapped.read(address)), b'x' * 1000)
+        mapped.close()
+
+    def test_damaged_overflow(self):
+        address = self.p.write_value(b'x' * 1000)
+        self.p.commit_root_address(address)
+        with open(self.p.blobs_name, 'r+b') as blobs:
+            blobs.seek(10)
+            blobs.write(b'y')
+        with assert_raises(CorruptRecordError):
+            self.p.read(address)
+
+    def test_recover_checks_overflow(self):
+        first = self.p.write_value(b'x' * 1000)
+        self.p.commit_root_address(first)
+        second = self.p.write_value(b'y' * 1000)
+        self.p.commit_root_address(second)
+        with open(self.p.blobs_name, 'r+b') as blobs:
+            blobs.truncate(1500)
+        blobs_name = self.p.blobs_name
+        eq_(self.p.recover(), first)
+        # The file has a new id, and the segment its name.
+        assert self.p.blobs_name != blobs_name
+        assert not os.path.exists(blobs_name)
+        eq_(self.p.read(first), b'x' * 1000)
+
+
+class TestMmapStorage(object):
+
+    def setup(self):
+        self.f = tempfile.NamedTemporaryFile()
+        self.writer = Storage(self.f)
+        self.reader_f = open(self.f.name, 'rb')
+        self.p = MmapStorage(self.reader_f)
+
+    def teardown(self):
+        self.p.close()
+        self.f.close()
+
+    def test_read(self):
+        address = self.writer.write(b'ABCDE')
+        self.writer.commit_root_address(address)
+        eq_(self.p.get_root_address(), address)
+        eq_(bytes(self.p.read(address)), b'ABCDE')
+
+    def test_remaps_after_commit(self):
+        self.writer.commit_root_address(self.writer.write(b'one'))
+        eq_(bytes(self.p.read(self.p.get_root_address())), b'one')
+        address = self.writer.write(b'x' * 10000)
+        self.writer.commit_root_address(address)
+        eq_(self.p.get_root_address(), address)
+        eq_(bytes(self.p.read(address)), b'x' * 10000)
+
+    def test_identity_matches_writer(self):
+        self.writer.commit_root_address(self.writer.write(b'one'))
+        eq_(self.p.identity, self.writer.identity)
+
+    def test_read_damaged_record(self):
+        address = self.writer.write(b'ABCDE')
+        self.writer.commit_root_address(address)
+        self.f.seek(address + Storage.RECORD_HEADER.size)
+        self.f.write(b'X')
+        self.f.flush()
+        with assert_raises(CorruptRecordError):
+            self.p.read(address)
+
+    def test_read_only(self):
+        with assert_raises(io.UnsupportedOperation):
+            self.p.write(b'one')
+        with assert_raises(io.UnsupportedOperation):
+            self.p.commit_root_address(0)
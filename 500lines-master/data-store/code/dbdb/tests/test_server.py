@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from nose.tools import assert_raises, eq_
+
+import dbdb
+from dbdb import protocol
+from dbdb.client import Client, ServerError
+from dbdb.server import serve_in_thread
+
+
+class TestServer(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'served.db')
+        self.db = dbdb.connect(self.path, tree_class=dbdb.AVLTree,
+                               cache=dbdb.NodeCache())
+        self.server, self.stop = serve_in_thread(self.db, self.path + '.sock')
+        self.client = Client(self.path + '.sock')
+
+    def teardown(self):
+        self.client.close()
+        self.stop()
+        self.db.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_set_get_and_delete(self):
+        self.client['a'] = 'aye'
+        eq_(self.client['a'], 'aye')
+        eq_(len(self.client), 1)
+        del self.client['a']
+        assert 'a' not in self.client
+        with assert_raises(KeyError):
+            del self.client['a']
+        # It's committed, for anyone else reading the file.
+        self.client['b'] = 'bee'
+        db = dbdb.connect(self.path, tree_class=dbdb.AVLTree)
+        eq_(db['b'], 'bee')
+        db.close()
+
+    def test_pipelined_reads_see_earlier_writes(self):
+        results = self.client.pipeline([
+            ('set', ('a', '1')),
+            ('get', ('a',)),
+            ('delete', ('a',)),
+            ('get', ('a',)),
+            ('len', ()),
+        ])
+        eq_(results[:3], [None, '1', None])
+        assert isinstance(results[3], KeyError)
+        eq_(results[4], 0)
+
+    def test_scan_pages_through_long_ranges(self):
+        count = protocol.SCAN_LIMIT + 10
+        keys = ['%05d' % i for i in range(count)]
+        self.client.pipeline([('set', (key, key)) for key in keys])
+        eq_(list(self.client.keys()), keys)
+        eq_(list(self.client.items('00010', '00013')),
+            [('00010', '00010'), ('00011', '00011'), ('00012', '00012')])
+
+    def test_concurrent_writes_share_commits(self):
+        def write(n):
+            self.client.pipeline([
+                ('set', ('%d-%d' % (n, i), 'x')) for i in range(50)])
+
+        threads = [threading.Thread(target=write, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(len(self.client), 400)
+        assert self.server.commits < 400
+
+    def test_unknown_op(self):
+        with assert_raises(ServerError):
+            self.client._call('compact')
+
+    def test_bad_requests_are_answered_with_errors(self):
+        results = self.client.pipeline([
+            ('set', ('b', 5)),
+            ('set', ('c',)),
+            ('get', (None,)),
+            ('scan', ('a', 'b', True)),
+            ('scan', (None, None, -1)),
+            ('scan', (None, None, 0)),
+        ])
+        for result in results:
+            assert isinstance(result, ServerError)
+            assert str(result).startswith('BadRequest')
+        self.client['c'] = 'ok'
+        eq_(self.client['c'], 'ok')
+        assert 'b' not in self.client
+
+    def test_failed_commit_only_fails_its_own_write(self):
+        commit = self.db.commit
+
+        def failing_commit(unlock=True):
+            if self.db.get('bad') is not None:
+                raise IOError('No space left on device')
+            commit(unlock)
+        self.db.commit = failing_commit
+        results = self.client.pipeline([
+            ('set', ('a', 'aye')),
+            ('set', ('bad', 'x')),
+            ('set', ('c', 'see')),
+        ])
+        eq_(results[0], None)
+        assert isinstance(results[1], ServerError)
+        eq_(results[2], None)
+        eq_(list(self.client.keys()), ['a', 'c'])
+        self.client['d'] = 'dee'
+        eq_(self.client['d'], 'dee')
@@ -0,0 +1,157 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_raises, eq_
+
+import dbdb
+from dbdb.sharding import HashRouter, RangeRouter, ShardedDB
+
+
+def _write_shard(path, prefix):
+    db = ShardedDB(path, tree_class=dbdb.AVLTree)
+    for i in range(50):
+        db['%s%02d' % (prefix, i)] = prefix
+        db.commit()
+    db.close()
+
+
+class TestRouters(object):
+    def test_hash_router(self):
+        router = HashRouter(4)
+        shards = set(router.shard_for('key%d' % i) for i in range(100))
+        eq_(shards, set(range(4)))
+        eq_(router.shard_for('a'), HashRouter(4).shard_for('a'))
+        eq_(router.shards_for('a', 'b'), [0, 1, 2, 3])
+
+    def test_range_router(self):
+        router = RangeRouter(['g', 'p'])
+        eq_([router.shard_for(k) for k in ['a', 'g', 'o', 'p', 'z']],
+            [0, 1, 1, 2, 2])
+        eq_(router.shards_for('b', 'h'), [0, 1])
+        eq_(router.shards_for('h', 'p'), [1])
+        eq_(router.shards_for(None, None), [0, 1, 2])
+        with assert_raises(ValueError):
+            RangeRouter(['p', 'g'])
+
+
+class TestShardedDB(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'sharded.db')
+
+    def teardown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _fill(self, router):
+        db = ShardedDB(self.path, router, tree_class=dbdb.AVLTree)
+        self.keys = ['%03d' % (i * 37 % 200) for i in range(200)]
+        for key in self.keys:
+            db[key] = key.upper()
+        db.commit()
+        return db
+
+    def test_mapping(self):
+        db = self._fill(HashRouter(3))
+        eq_(len(db), 200)
+        eq_(db['042'], '042')
+        del db['042']
+        assert '042' not in db
+        eq_(db.get('042', 'gone'), 'gone')
+        db.commit()
+        db.close()
+        db = ShardedDB(self.path, tree_class=dbdb.AVLTree)
+        eq_(len(db), 199)
+        assert all(len(shard) < 199 for shard in db.shards)
+        db.close()
+
+    def test_merged_scans(self):
+        for router in [HashRouter(3), RangeRouter(['050', '120'])]:
+            db = self._fill(router)
+            keys = sorted(self.keys)
+            eq_(list(db), keys)
+            eq_(list(reversed(db)), keys[::-1])
+            eq_(list(db.keys('045', '125')),
+                [k for k in keys if '045' <= k < '125'])
+            eq_(list(db.items('118', '122')),
+                [(k, k.upper()) for k in ['118', '119', '120', '121']])
+            eq_([k for k, v in db.prefix_items('19', reverse=True)],
+                ['199', '198', '197', '196', '195', '194', '193', '192',
+                 '191', '190'])
+            db.close()
+            shutil.rmtree(self.temp_dir)
+            os.mkdir(self.temp_dir)
+
+    def test_router_must_match(self):
+        ShardedDB(self.path, HashRouter(2)).close()
+        with assert_raises(ValueError):
+            ShardedDB(self.path, HashRouter(3))
+        with assert_raises(ValueError):
+            ShardedDB(self.path + '.new')
+
+    def test_per_shard_commit(self):
+        db = ShardedDB(self.path, RangeRouter(['m']))
+        db['a'] = 'aye'
+        db['z'] = 'zed'
+        db.commit_shard(0)
+        # The other shard is still locked, so read the files directly.
+        for index, key, expected in [(0, 'a', True), (1, 'z', False)]:
+            shard = dbdb.connect(db.shard_name(index), readonly=True)
+            eq_(key in shard, expected)
+            shard.close()
+        db.close()
+
+    def test_batch(self):
+        db = ShardedDB(self.path, RangeRouter(['m']))
+        with assert_raises(KeyError):
+            with db.batch(coordinated=True):
+                db['a'] = 'aye'
+                db['z'] = 'zed'
+                del db['missing']
+        eq_(len(db), 0)
+        with db.batch(coordinated=True):
+            db['a'] = 'aye'
+            db['z'] = 'zed'
+        assert not os.path.exists(self.path + '.commit')
+        other = ShardedDB(self.path)
+        eq_(list(other.items()), [('a', 'aye'), ('z', 'zed')])
+        other.close()
+        db.close()
+
+    def test_crashed_coordinated_commit_is_undone(self):
+        db = ShardedDB(self.path, RangeRouter(['m']))
+        db['a'] = 'aye'
+        db['z'] = 'zed'
+        db.commit()
+        db['b'] = 'bee'
+        db['y'] = 'why'
+        # Crash after the first shard committed, with the log still there.
+        roots = {}
+        for index, shard in enumerate(db.shards):
+            roots[index] = shard.prepare_commit()
+        with open(self.path + '.commit', 'w') as f:
+            json.dump(roots, f)
+        db.shards[0].commit()
+        db.close()
+        db = ShardedDB(self.path)
+        eq_(list(db), ['a', 'z'])
+        assert not os.path.exists(self.path + '.commit')
+        db.close()
+
+    def test_writers_in_parallel_processes(self):
+        ShardedDB(self.path, RangeRouter(['b', 'c', 'd'])).close()
+        processes = [
+            multiprocessing.Process(target=_write_shard,
+                                    args=(self.path, prefix))
+            for prefix in 'abcd']
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            eq_(process.exitcode, 0)
+        db = ShardedDB(self.path, tree_class=dbdb.AVLTree)
+        eq_(len(db), 200)
+        eq_([len(shard) for shard in db.shards], [50, 50, 50, 50])
+        db.close()
@@ -2,44 +2,173 @@ from __future__ import print_function
 import sys
 
 import dbdb  # import一个文件夹，就是import这个文件夹下的__init__.py
+from dbdb import encoding
 
 
 OK = 0
 BAD_ARGS = 1
 BAD_VERB = 2
 BAD_KEY = 3
+BAD_INPUT = 4
+BAD_TREE = 5
 
 
 def usage():  # 这个usage的写法可以和argparse结合一下
     print("Usage:", file=sys.stderr)
     print("\tpython -m dbdb.tool DBNAME get KEY", file=sys.stderr)
-    print("\tpython -m dbdb.tool DBNAME set KEY VALUE", file=sys.stderr)
-    print("\tpython -m dbdb.tool DBNAME delete KEY", file=sys.stderr)
+    print("\tpython -m dbdb.tool DBNAME set KEY VALUE [KEY VALUE ...]",
+          file=sys.stderr)
+    print("\tpython -m dbdb.tool DBNAME delete KEY [KEY ...]", file=sys.stderr)
+    print("\tpython -m dbdb.tool DBNAME compact", file=sys.stderr)
+    print("\tpython -m dbdb.tool DBNAME migrate", file=sys.stderr)
+    print("\tpython -m dbdb.tool DBNAME recover", file=sys.stderr)
+    print("\tpython -m dbdb.tool DBNAME import FILE", file=sys.stderr)
+    print("\t(FILE has a KEY<tab>VALUE line per key, sorted by key; "
+          "'-' reads stdin)", file=sys.stderr)
+    print("Options, between DBNAME and the command:", file=sys.stderr)
+    print("\t--tree %s\t(defaults to the file's own, or binary)" %
+          '|'.join(sorted(dbdb.TREES)), file=sys.stderr)
+    print("\t--compression %s\t(for values written, compaction included)" %
+          '|'.join(sorted(encoding.COMPRESSORS)), file=sys.stderr)
+    print("\t--overflow-threshold BYTES", file=sys.stderr)
+    print("\t(Without them, compact and migrate write values uncompressed "
+          "and inline.)", file=sys.stderr)
+
+
+# How many arguments each verb takes after the verb itself.
+ARG_COUNTS = {
+    'get': 1,
+    'set': 2,
+    'delete': 1,
+    'compact': 0,
+    'migrate': 0,
+    'import': 1,
+    'recover': 0,
+}
+# These take their arguments again and again, and commit them all at once.
+REPEATABLE = {'set', 'delete'}
+
+
+def _compression(value):
+    if value not in encoding.COMPRESSORS:
+        raise ValueError('Unknown compression: %r' % (value,))
+    return value
+
+
+def _byte_count(value):
+    count = int(value)
+    if count <= 0:
+        raise ValueError('Not a byte count: %r' % (value,))
+    return count
+
+
+# Each option's keyword argument, and what makes it from the option's value.
+OPTIONS = {
+    '--tree': ('tree_class', dbdb.TREES.__getitem__),
+    '--compression': ('compression', _compression),
+    '--overflow-threshold': ('overflow_threshold', _byte_count),
+}
+
+
+def parse_options(args):
+    """Take --NAME VALUE or --NAME=VALUE options off the front of `args`.
+
+    Returns the keyword arguments they make and the rest of `args`, or None
+    if an option is unknown or its value is bad.
+    """
+    options = {}
+    while args and args[0].startswith('--'):
+        name, equals, value = args[0].partition('=')
+        if equals:
+            args = args[1:]
+        elif len(args) > 1:
+            value, args = args[1], args[2:]
+        else:
+            return None
+        if name not in OPTIONS:
+            return None
+        keyword, make = OPTIONS[name]
+        try:
+            options[keyword] = make(value)
+        except (KeyError, ValueError):
+            return None
+    return options, args
 
 
 def main(argv):
-    if not (4 <= len(argv) <= 5):
+    if len(argv) < 3:
         usage()
         return BAD_ARGS
-    dbname, verb, key, value = (argv[1:] + [None])[:4]  # (DBNAME, get, Key, VALUE) None是有可能用get，delete时无value
-    if verb not in {'get', 'set', 'delete'}:
+    parsed = parse_options(argv[2:])
+    if parsed is None or not parsed[1]:
+        usage()
+        return BAD_ARGS
+    options, args = parsed
+    dbname, verb, args = argv[1], args[0], args[1:]
+    if verb not in ARG_COUNTS:
         usage()
         return BAD_VERB
-    db = dbdb.connect(dbname)  # import dbdb from dbdb.__init__.py
+    count = ARG_COUNTS[verb]
+    if not (len(args) == count or
+            verb in REPEATABLE and args and len(args) % count == 0):
+        usage()
+        return BAD_ARGS
+    try:
+        return run(dbname, verb, args, options)
+    except dbdb.WrongTreeError as e:
+        print(e, file=sys.stderr)
+        return BAD_TREE
+
+
+def run(dbname, verb, args, options):
+    if verb in {'compact', 'migrate'}:
+        # Compaction writes every live node afresh, in the current encoding,
+        # so it doubles as the upgrade for files written by older versions.
+        dbdb.compact(dbname, **options)
+        return OK
+    if verb == 'recover':
+        dbdb.recover(dbname)
+        return OK
+    if verb == 'import':
+        return import_pairs(dbname, args[0], **options)
+    db = dbdb.connect(dbname, **options)  # import dbdb from dbdb.__init__.py
     try:
         if verb == 'get':
-            sys.stdout.write(db[key])
+            sys.stdout.write(db[args[0]])
         elif verb == 'set':
-            db[key] = value
-            db.commit()
+            with db.batch():
+                for key, value in zip(args[::2], args[1::2]):
+                    db[key] = value
         else:
-            del db[key]
-            db.commit()
+            with db.batch():
+                for key in args:
+                    del db[key]
     except KeyError:
         print("Key not found", file=sys.stderr)
         return BAD_KEY
     return OK
 
 
+def _read_pairs(f):
+    for line in f:
+        key, tab, value = line.rstrip('\n').partition('\t')
+        if not tab:
+            raise ValueError('No tab in line: %r' % line)
+        yield key, value
+
+
+def import_pairs(dbname, filename, **options):
+    f = sys.stdin if filename == '-' else open(filename)
+    try:
+        dbdb.bulk_load(dbname, _read_pairs(f), **options)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return BAD_INPUT
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return OK
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -0,0 +1,140 @@
+"""Benchmarks for templite.
+
+Usage::
+
+    python bench_templite.py [json] [SIZE ...]
+
+Renders representative templates, each at several SIZEs (10, 100 and 1000
+by default):
+
+- `deep_dots`: a loop over SIZE rows, each looking up values four dots
+  deep, and one lookup that doesn't change from row to row.
+- `large_loop`: a loop over SIZE numbers, making a list item of each.
+- `many_filters`: a loop over SIZE words, each through a chain of filters.
+- `wide_page`: SIZE different expressions in a row, so a long template.
+
+For each, it times constructing the Templite with no cache, constructing it
+again from a warm CodeCache, and rendering it, the best of several runs.
+With `json`, it prints the results as JSON, for comparing across runs.
+"""
+from __future__ import print_function
+import json
+import sys
+import time
+
+from templite import CodeCache, Templite
+
+
+class Obj(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+def deep_dots(size):
+    text = (
+        "{% for row in rows %}"
+        "<td>{{row.user.profile.address.city}}</td>"
+        "<td>{{row.user.profile.address.zip}}</td>"
+        "<td>{{site.owner.profile.name}}</td>"
+        "{% endfor %}")
+    rows = [
+        Obj(user=Obj(profile=Obj(address={'city': 'City %d' % i, 'zip': i})))
+        for i in range(size)]
+    site = Obj(owner=Obj(profile=Obj(name='Owner')))
+    return text, {}, {'rows': rows, 'site': site}
+
+
+def large_loop(size):
+    text = "<ul>{% for n in nums %}<li>{{n}}</li>{% endfor %}</ul>"
+    return text, {}, {'nums': list(range(size))}
+
+
+def _quote(text):
+    return '"%s"' % text
+
+
+def many_filters(size):
+    text = (
+        "{% for word in words %}"
+        "{{word|strip|lower|title|quote}} "
+        "{% endfor %}")
+    filters = {
+        'strip': str.strip, 'lower': str.lower, 'title': str.title,
+        'quote': _quote,
+    }
+    words = ['  Word%d  ' % i for i in range(size)]
+    return text, filters, {'words': words}
+
+
+def wide_page(size):
+    text = "".join("<p>{{v%d}}</p>\n" % i for i in range(size))
+    return text, {}, dict(('v%d' % i, i) for i in range(size))
+
+
+TEMPLATES = [
+    ('deep_dots', deep_dots),
+    ('large_loop', large_loop),
+    ('many_filters', many_filters),
+    ('wide_page', wide_page),
+]
+
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+
+def _best(function, repeat=5):
+    """The shortest time `function` takes, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = _clock()
+        function()
+        seconds = _clock() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def run(make_template, size):
+    text, contexts, data = make_template(size)
+    cache = CodeCache()
+    Templite(text, contexts, cache=cache)
+    templite = Templite(text, contexts, cache=cache)
+    return {
+        'compile_seconds': _best(
+            lambda: Templite(text, contexts, cache=None)),
+        'cached_seconds': _best(
+            lambda: Templite(text, contexts, cache=cache)),
+        'render_seconds': _best(lambda: templite.render(data)),
+        'output_characters': len(templite.render(data)),
+    }
+
+
+def main(argv):
+    args = argv[1:]
+    as_json = bool(args) and args[0] == 'json'
+    if as_json:
+        args.pop(0)
+    sizes = [int(arg) for arg in args] or [10, 100, 1000]
+    results = []
+    for name, make_template in TEMPLATES:
+        for size in sizes:
+            result = {'template': name, 'size': size}
+            result.update(run(make_template, size))
+            results.append(result)
+            if not as_json:
+                print(
+                    '%-12s %6d  compile %9.6fs  cached %9.6fs  '
+                    'render %9.6fs  %8d chars' % (
+                        name, size, result['compile_seconds'],
+                        result['cached_seconds'], result['render_seconds'],
+                        result['output_characters']))
+    if as_json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
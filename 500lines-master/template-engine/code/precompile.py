@@ -0,0 +1,110 @@
+"""Compile a directory of templates ahead of time.
+
+Usage::
+
+    python precompile.py TEMPLATE_DIR [--pattern GLOB] [--jobs N]
+                         [--autoescape] [--output FILE]
+
+Every file under TEMPLATE_DIR matching GLOB (*.html by default) is compiled
+as `Loader(TEMPLATE_DIR).load(name)` would compile it, by a pool of N
+processes, and the results are written to one CodeBundle, by default
+Loader.BUNDLE_NAME in TEMPLATE_DIR, where a Loader finds it on startup.
+Templates with syntax errors are reported, and make the exit status 1.
+
+Only templates loaded with no constructor contexts, and with the same
+`autoescape`, use the bundled code: folded values are part of the key.
+Run it on the directory as the application will name it, since that's part
+of the key too. An entry whose template has changed since is compiled
+again, as usual.
+"""
+from __future__ import print_function
+import argparse
+import fnmatch
+import marshal
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from templite import CodeBundle, CodeCache, Loader, TempliteSyntaxError
+
+
+def find_templates(directory, pattern):
+    """The names of the templates under `directory` matching `pattern`."""
+    names = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for filename in sorted(files):
+            if fnmatch.fnmatch(filename, pattern):
+                path = os.path.join(root, filename)
+                names.append(os.path.relpath(path, directory))
+    return names
+
+
+def compile_template(directory, name, autoescape):
+    """Compile template `name`, in a worker.
+
+    Returns the name, the marshalled cache entries made, and the syntax
+    error if there was one.
+
+    """
+    cache = CodeCache()
+    loader = Loader(directory, cache=cache)
+    try:
+        loader.load(name, autoescape=autoescape)
+    except TempliteSyntaxError as e:
+        return name, {}, str(e)
+    entries = dict(
+        (key, marshal.dumps(entry))
+        for key, entry in cache.entries().items())
+    return name, entries, None
+
+
+def precompile(directory, pattern="*.html", jobs=None, autoescape=False,
+               output=None):
+    """Compile the templates, and write them to a CodeBundle at `output`.
+
+    Returns a dict of the syntax errors found, by template name.
+
+    """
+    directory = os.path.abspath(directory)
+    if output is None:
+        output = os.path.join(directory, Loader.BUNDLE_NAME)
+    names = find_templates(directory, pattern)
+    entries = {}
+    errors = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            compile_template, [directory] * len(names), names,
+            [autoescape] * len(names))
+        for name, marshalled, error in results:
+            if error is not None:
+                errors[name] = error
+            for key, data in marshalled.items():
+                entries[key] = marshal.loads(data)
+    CodeBundle.write(output, entries)
+    return errors
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Compile a directory of templates ahead of time.")
+    parser.add_argument("directory")
+    parser.add_argument("--pattern", default="*.html",
+                        help="which files are templates (default *.html)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="processes to compile with (default: one a CPU)")
+    parser.add_argument("--autoescape", action="store_true",
+                        help="compile as the application will, autoescaped")
+    parser.add_argument("--output",
+                        help="the bundle to write (default: %s in the "
+                             "directory)" % Loader.BUNDLE_NAME)
+    args = parser.parse_args(argv[1:])
+    errors = precompile(args.directory, args.pattern, args.jobs,
+                        args.autoescape, args.output)
+    for name, error in sorted(errors.items()):
+        print("%s: %s" % (name, error), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
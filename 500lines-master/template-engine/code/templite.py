@@ -2,7 +2,18 @@
 
 # Coincidentally named the same as http://code.activestate.com/recipes/496702/
 
+import hashlib
+import importlib.util
+import marshal
+import mmap
+import os
 import re
+import struct
+import tempfile
+import threading
+import time
+import types
+from collections import OrderedDict
 
 
 class TempliteSyntaxError(ValueError):
@@ -34,6 +45,10 @@ class CodeBuilder(object):
         self.code.append(section)
         return section
 
+    def clear(self):
+        """Remove everything added so far, to fill a section in again."""
+        del self.code[:]
+
     INDENT_STEP = 4      # PEP8 says so!
 
     def indent(self):
@@ -44,18 +59,373 @@ class CodeBuilder(object):
         """Decrease the current indent for following lines."""
         self.indent_level -= self.INDENT_STEP
 
-    def get_globals(self):
-        """Execute the code, and return a dict of globals it defines."""
+    def get_code(self, python_source=None):
+        """Compile the code, or `python_source` if given, and return the
+        code object."""
         # A check that the caller really finished all the blocks they started.
         assert self.indent_level == 0
-        # Get the Python source as a single string.
-        python_source = str(self)
-        # Execute the source, defining globals, and return them.
+        # Get the Python source as a single string, and compile it.
+        if python_source is None:
+            python_source = str(self)
+        return compile(python_source, "<templite>", "exec")
+
+    def get_globals(self):
+        """Execute the code, and return a dict of globals it defines."""
         global_namespace = {}
-        exec(python_source, global_namespace)
+        exec(self.get_code(), global_namespace)
         return global_namespace
 
 
+# The umask can only be read by setting it, which isn't safe once other
+# threads may be making files, so it's read once, on import.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _mkstemp(directory):
+    """Like tempfile.mkstemp, but the file gets the permissions open()
+    would have given it, rather than being private to this user: an app
+    may run as another user than the one who compiled its templates."""
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    os.chmod(temp_path, 0o666 & ~_UMASK)
+    return fd, temp_path
+
+
+class CodeBundle(object):
+    """Many compiled templates in one file, read through an mmap.
+
+    The file has a header, an index of the entries' keys and where they
+    are, and then each entry marshalled. Made by `write`, usually through
+    precompile.py, and read by a CodeCache it's added to.
+
+    """
+
+    # Magic, the Python's own magic number, and how many entries.
+    HEADER = struct.Struct("!4s4sI")
+    MAGIC = b"TPLB"
+    # Key (a sha256), offset and length of each entry.
+    INDEX = struct.Struct("!32sQI")
+
+    def __init__(self, path):
+        """Open the bundle at `path`. Raises ValueError if it isn't one,
+        or was written by another version of Python."""
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < self.HEADER.size:
+            raise ValueError("Not a template bundle: %r" % path)
+        magic, python_magic, count = self.HEADER.unpack_from(self._map)
+        if magic != self.MAGIC or python_magic != importlib.util.MAGIC_NUMBER:
+            raise ValueError(
+                "Not a template bundle for this Python: %r" % path)
+        self._index = {}
+        for i in range(count):
+            key, offset, length = self.INDEX.unpack_from(
+                self._map, self.HEADER.size + i * self.INDEX.size)
+            self._index[key.hex()] = (offset, length)
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key):
+        """Return the entry for `key`, or None."""
+        place = self._index.get(key)
+        if place is None:
+            return None
+        offset, length = place
+        try:
+            return marshal.loads(self._map[offset:offset + length])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    @classmethod
+    def write(cls, path, entries):
+        """Write `entries`, a dict of CodeCache entries by key, to `path`,
+        replacing what was there atomically."""
+        data = [(key, marshal.dumps(entry)) for key, entry in entries.items()]
+        offset = cls.HEADER.size + len(data) * cls.INDEX.size
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = _mkstemp(directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(cls.HEADER.pack(
+                cls.MAGIC, importlib.util.MAGIC_NUMBER, len(data)))
+            for key, marshalled in data:
+                f.write(cls.INDEX.pack(
+                    bytes.fromhex(key), offset, len(marshalled)))
+                offset += len(marshalled)
+            for _, marshalled in data:
+                f.write(marshalled)
+        os.rename(temp_path, path)
+
+
+class CodeCache(object):
+    """Compiled templates, so that each is parsed and compiled only once.
+
+    Entries are keyed by a hash of the template text and a description of
+    its constructor contexts: their names, and any values that could be
+    folded into the code. They are kept in memory, up to `max_entries` of
+    them, and if `directory` is given, also as marshalled code objects in
+    files there, so that a new process can skip compiling too. Entries are
+    also found in any CodeBundles added with `add_bundle`.
+
+    """
+
+    # Bumped whenever templates compile to different code, so that nothing
+    # compiled by an older Templite is loaded from the disk.
+    COMPILER_VERSION = 7
+
+    def __init__(self, directory=None, max_entries=1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bundles = []
+        self._lock = threading.Lock()
+
+    def add_bundle(self, path):
+        """Find entries in the CodeBundle at `path` too.
+
+        Returns False, and adds nothing, if there's no usable bundle there.
+
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            if any(bundle.path == path for bundle in self._bundles):
+                return True
+        try:
+            bundle = CodeBundle(path)
+        except (IOError, ValueError):
+            return False
+        with self._lock:
+            self._bundles.append(bundle)
+        return True
+
+    def key(self, text, names):
+        """The key for `text` compiled with contexts described by `names`,
+        a string for each name, with its value if that was folded in."""
+        digest = hashlib.sha256()
+        digest.update(("%d\0%s\0" % (
+            self.COMPILER_VERSION, " ".join(sorted(names)))).encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the entry for `key`, or None if it hasn't been stored."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            bundles = list(self._bundles)
+        if entry is None:
+            for bundle in bundles:
+                entry = bundle.get(key)
+                if entry is not None:
+                    self._remember(key, entry)
+                    break
+        if entry is None and self.directory:
+            entry = self._load(key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """Store `entry`: a code object and the template's variable names."""
+        self._remember(key, entry)
+        if self.directory:
+            self._save(key, entry)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def entries(self):
+        """A dict of the entries held in memory, by key."""
+        with self._lock:
+            return dict(self._entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".tpc")
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        # Marshalled code only loads into the Python that wrote it.
+        magic = importlib.util.MAGIC_NUMBER
+        if not data.startswith(magic):
+            return None
+        try:
+            return marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def _save(self, key, entry):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, temp_path = _mkstemp(self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(importlib.util.MAGIC_NUMBER + marshal.dumps(entry))
+        os.rename(temp_path, self._path(key))
+
+
+# The cache Templites use unless they're given another, or None.
+DEFAULT_CACHE = CodeCache()
+
+# Constructor context values of exactly these types are folded into the code.
+FOLDABLE_TYPES = (str, int, float, bool, type(None))
+
+# What Templite._fold returns when an expression has to wait for rendering.
+NOT_FOLDED = object()
+
+
+class Loader(object):
+    """Templates kept as files under `directory`, found by name.
+
+    Give one to a Templite as its `loader` to use {% include %} and
+    {% extends %}. Each file is read once, and again only if it changes.
+    Templites it loads use its `cache` and `render_hook`.
+
+    If precompile.py has made a bundle of the templates, BUNDLE_NAME in
+    `directory`, it's added to `cache`, so that they needn't be compiled.
+
+    """
+
+    BUNDLE_NAME = "__templite__.tpb"
+
+    def __init__(self, directory, cache=DEFAULT_CACHE, render_hook=None):
+        self.directory = os.path.abspath(directory)
+        self.cache = cache
+        self.render_hook = render_hook
+        bundle = os.path.join(self.directory, self.BUNDLE_NAME)
+        if cache is not None and os.path.exists(bundle):
+            cache.add_bundle(bundle)
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        """The file holding the template called `name`."""
+        path = os.path.normpath(os.path.join(self.directory, name))
+        if not path.startswith(self.directory + os.sep):
+            raise TempliteSyntaxError("Template outside the loader: %r" % name)
+        return path
+
+    def get_source(self, name):
+        """Return the text of template `name`, and a digest of it."""
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise TempliteSyntaxError("Can't find template: %r" % name)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            source = self._sources.get(name)
+        if source is None or source[0] != version:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            source = (version, text, digest)
+            with self._lock:
+                self._sources[name] = source
+        return source[1:]
+
+    def load(self, name, *contexts, **options):
+        """Make a Templite from template `name`."""
+        options.setdefault("cache", self.cache)
+        options.setdefault("name", name)
+        options.setdefault("render_hook", self.render_hook)
+        return Templite(
+            self.get_source(name)[0], *contexts, loader=self, **options)
+
+
+class RenderStats(object):
+    """A render hook that keeps totals for each template name.
+
+    For each name, `templates` has the count of renders, their total and
+    slowest seconds, and the total characters they made.
+
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, templite, seconds, length):
+        with self._lock:
+            stats = self.templates.get(templite.name)
+            if stats is None:
+                stats = self.templates[templite.name] = {
+                    'renders': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'characters': 0,
+                }
+            stats['renders'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['characters'] += length
+
+    def snapshot(self):
+        """A copy of `templates`, to report while renders go on."""
+        with self._lock:
+            return dict(
+                (name, dict(stats)) for name, stats in self.templates.items())
+
+
+class Markup(str):
+    """A string that's HTML already, so autoescaping leaves it alone."""
+
+    def __html__(self):
+        return self
+
+
+_needs_escape = re.compile(r"[&<>\"']").search
+
+
+def escape_html(value):
+    """Return `value` as text that's safe to put in HTML.
+
+    Anything with an __html__ method, like Markup, gives its own HTML. Other
+    values are made strings, and their special characters replaced.
+
+    """
+    if type(value) is not str:
+        if hasattr(value, "__html__"):
+            return value.__html__()
+        value = str(value)
+    if _needs_escape(value) is None:
+        return value
+    return (value.replace("&", "&amp;").replace("<", "&lt;")
+            .replace(">", "&gt;").replace('"', "&#34;").replace("'", "&#39;"))
+
+
+def _filter_name(func):
+    """A name for `func` that means the same function in any process, or
+    None if it doesn't have one, like a lambda or a bound method."""
+    if isinstance(func, type):
+        if func.__module__ != "builtins":
+            return None
+    elif isinstance(func, types.BuiltinFunctionType):
+        if not isinstance(func.__self__, types.ModuleType):
+            return None
+    elif not isinstance(
+            func, (types.FunctionType, types.MethodDescriptorType)):
+        return None
+    if "<" in func.__qualname__:
+        return None
+    return "%s.%s" % (getattr(func, "__module__", None), func.__qualname__)
+
+
 class Templite(object):
     """A simple template renderer, for a nano-subset of Django syntax.
 
@@ -63,14 +433,36 @@ class Templite(object):
 
         {{var.modifer.modifier|filter|filter}}
 
-    loops::
+    loops, with what to show if there's nothing to loop over::
+
+        {% for var in list %}...{% empty %}...{% endfor %}
+
+    in which `forloop.counter` counts from 1, `forloop.counter0` from 0, and
+    `forloop.first` is true the first time around. Filters can be given
+    arguments, numbers, quoted strings or variables::
 
-        {% for var in list %}...{% endfor %}
+        {{var|truncate:20,"..."}}
 
-    and ifs::
+    ifs::
 
         {% if var %}...{% endif %}
 
+    and, with a `loader`, other templates by name::
+
+        {% include "header.html" %}
+
+        {% extends "base.html" %}
+        {% block content %}...{% endblock %}
+
+    A template that extends another is that one, with any blocks of the
+    same name replaced by its own. Everything is joined into one template
+    as it's compiled, so rendering calls no more code for it.
+
+    With `autoescape`, every `{{...}}` is escaped for HTML, unless its
+    value is Markup or its last filter is `safe`::
+
+        {{comment.text}} {{comment.html|safe}}
+
     Comments are within curly-hash markers::
 
         {# This will be ignored #}
@@ -91,37 +483,166 @@ class Templite(object):
             'topics': ['Python', 'Geometry', 'Juggling'],
         })
 
+    `stream` produces the same text as an iterator of chunks instead.
+
     """
-    def __init__(self, text, *contexts):
+    # How many pieces of output stream() gathers before checking whether
+    # they add up to a chunk.
+    CHECK_PIECES = 32
+
+    # The chunk size stream() aims for, in characters.
+    DEFAULT_FLUSH_SIZE = 8192
+
+    def __init__(self, text, *contexts, cache=DEFAULT_CACHE, fold=True,
+                 pure_filters=(), types=None, loader=None, autoescape=False,
+                 name=None, render_hook=None):
         """Construct a Templite with the given `text`.
 
         `contexts` are dictionaries of values to use for future renderings.
         These are good for filters and global values.
 
+        With `fold`, expressions made only of strings, numbers, booleans and
+        None from `contexts` are worked out once here instead of at every
+        rendering. So are such values passed through filters named in
+        `pure_filters`, which must be functions or builtins from `contexts`
+        that give the same answer every time; other filters, like
+        time.strftime, are always called when rendering. A rendering whose
+        context replaces a folded value still sees the new value, but takes
+        a slower path to do it.
+
+        `types` maps variable names to dict or object, to say that `{{x.y}}`
+        is always x["y"] or always x.y, never called, so that the lookup is
+        made directly instead of by trying one and then the other. Inside a
+        loop that doesn't change x, it's then made just once. Other dotted
+        lookups are made every time, since they may call something.
+
+        `loader`, a Loader, finds the templates named by include and extends.
+
+        With `autoescape`, the values of expressions are escaped for HTML as
+        they're output. Values that are folded in are escaped just once,
+        here, and text in the template itself never is.
+
+        `render_hook`, if given, is called after each `render` as
+        render_hook(templite, seconds, length): how long it took, and how
+        many characters it made. RenderStats is one to use. `name` says
+        which template it was; Templites from a Loader are named after
+        their file.
+
+        The compiled template comes from `cache`, a CodeCache, if the same
+        text has been compiled before, and no template it took in from
+        `loader` has changed since. Pass None to always compile.
+
         """
         self.context = {}
         for context in contexts:
             self.context.update(context)
+        self.types = dict(types or {})
+        for var, kind in self.types.items():
+            if kind is not dict and kind is not object:
+                raise ValueError(
+                    "Type of %r must be dict or object: %r" % (var, kind))
+        self._text = text
+        self._cache = cache
+        self._fold_constants = fold
+        self.pure_filters = frozenset(pure_filters)
+        self._unfolded = None
+        self.loader = loader
+        self.autoescape = autoescape
+        self.name = name
+        self.render_hook = render_hook
+
+        key = entry = None
+        if cache is not None:
+            key = cache.key(text, self._signature())
+            entry = cache.get(key)
+            if entry is not None and not self._is_current(entry[4]):
+                entry = None
+        if entry is None:
+            entry = self._compile(text)
+            if cache is not None:
+                cache.put(key, entry)
+        code, all_vars, loop_vars, folded_vars, templates = entry
+        self.all_vars = set(all_vars)
+        self.loop_vars = set(loop_vars)
+        self.folded_vars = frozenset(folded_vars)
+        global_namespace = {'escape_html': escape_html}
+        exec(code, global_namespace)
+        self._render_function = global_namespace['render_function']
+        self._stream_function = global_namespace['stream_function']
 
+    def _signature(self):
+        """Describe the contexts and types, for the cache key: everything
+        but the text that the compiled code depends on."""
+        names = []
+        for name, value in self.context.items():
+            if self._fold_constants:
+                if type(value) in FOLDABLE_TYPES:
+                    name = "%s=%r" % (name, value)
+                elif _filter_name(value):
+                    name = "%s=%s" % (name, _filter_name(value))
+            names.append(name)
+        for name, kind in self.types.items():
+            names.append("%s:%s" % (name, kind.__name__))
+        if self._fold_constants:
+            names.extend("pure:%s" % name for name in self.pure_filters)
+        if self.loader is not None:
+            names.append("loader:%s" % self.loader.directory)
+        if self.autoescape:
+            names.append("autoescape")
+        return names
+
+    def _is_current(self, templates):
+        """Are `templates`, (name, digest) pairs, still what the loader has?"""
+        for name, digest in templates:
+            try:
+                if self.loader.get_source(name)[1] != digest:
+                    return False
+            except TempliteSyntaxError:
+                return False
+        return True
+
+    def _compile(self, text):
+        """Compile `text`, returning the code and the names it uses."""
         self.all_vars = set()  # 所有模板类中使用的变量在这个set中，如上例中的user_name
         self.loop_vars = set()	 # 所有模板中定义的变量在这个set中，如上例中的product.name，在它的循环中定义的。
+        self.folded_vars = set()
+        # A dict for each loop we're inside, outermost first. See _start_loop.
+        self._loops = []
+        self._loop_count = 0
+        self._hoisted_count = 0
+        # The digest of each template included or extended.
+        self._templates = {}
 
         # We construct a function in source form, then compile it and hold onto
         # it, and execute it to render the template.
         code = CodeBuilder()
 
-        code.add_line("def render_function(context, do_dots):")
+        # The same code makes two functions: render_function, which returns
+        # the whole result, and stream_function, a generator that hands it
+        # over in chunks. Only these sections differ between them.
+        header = code.add_section()
         code.indent()
+        checkpoints = []
         vars_code = code.add_section()  # another code builder instance
         code.add_line("result = []")
         code.add_line("append_result = result.append")  # one line adds
         code.add_line("extend_result = result.extend")	 # more lines add
         code.add_line("to_str = str")
+        if self.autoescape:
+            code.add_line("escape = escape_html")
 
         buffered = []
+        literal = []
+
+        def flush_literal():
+            """Turn the text in `literal` into one string in `buffered`."""
+            if literal:
+                buffered.append(repr("".join(literal)))
+                del literal[:]
 
         def flush_output():
             """Force `buffered` to the code builder."""
+            flush_literal()
             if len(buffered) == 1:
                 code.add_line("append_result(%s)" % buffered[0])
             elif len(buffered) > 1:
@@ -129,9 +650,12 @@ class Templite(object):
             del buffered[:]
 
         ops_stack = []
+        # The loop of each 'for' in ops_stack, still there after its empty.
+        for_stack = []
 
-        # Split the text to form a list of tokens.
-        tokens = re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", text)
+        # Split the text to form a list of tokens, with other templates
+        # already put in.
+        tokens = self._tokens(text, [])
 
         for token in tokens:
             if token.startswith('{#'):
@@ -139,9 +663,25 @@ class Templite(object):
                 continue
             elif token.startswith('{{'):
                 # An expression to evaluate. 变量
-                expr = self._expr_code(token[2:-2].strip())
+                expr = token[2:-2].strip()
+                escape = self.autoescape
+                if escape and expr.endswith("|safe"):
+                    expr = expr[:-len("|safe")]
+                    escape = False
+                value = self._fold(expr)
+                if value is not NOT_FOLDED:
+                    # Known already: it's just more text.
+                    if escape:
+                        value = escape_html(value)
+                    literal.append(str(value))
+                    continue
+                expr = self._expr_code(expr)
                 # 去掉双大括号后，将里面是string变为python的表达式expr
-                buffered.append("to_str(%s)" % expr)
+                flush_literal()
+                if escape:
+                    buffered.append("escape(%s)" % expr)
+                else:
+                    buffered.append("to_str(%s)" % expr)
                 # to_str(expr)是个函数被str化
             elif token.startswith('{%'):
                 # Action tag: split into words and parse further.
@@ -161,13 +701,29 @@ class Templite(object):
                     ops_stack.append('for')
                     self._variable(words[1], self.loop_vars)
                     # 加入word[1]合法，将其加入到loop_vars的set()中
-                    code.add_line(
-                        "for c_%s in %s:" % (
-                            words[1],
-                            self._expr_code(words[3])
-                        )  # 将for从句加入到code builder的实例中
-                    )
-                    code.indent()  # for从句以下的内容，indent + 4
+                    loop = self._start_loop(
+                        words[1], self._expr_code(words[3]), code)
+                    for_stack.append(loop)
+                    self._loops.append(loop)
+                elif words[0] == 'empty':
+                    # What to show instead if the loop had nothing.
+                    if len(words) != 1:
+                        self._syntax_error("Don't understand empty", token)
+                    if not ops_stack or ops_stack[-1] != 'for' or \
+                            for_stack[-1]['empty']:
+                        self._syntax_error("Empty outside a for", token)
+                    loop = self._loops.pop()
+                    loop['empty'] = True
+                    empty_test = self._finish_loop(loop)
+                    checkpoints.append(code.add_section())
+                    code.dedent()
+                    code.add_line("if %s:" % empty_test)
+                    code.indent()
+                elif words[0] == 'block':
+                    # Already filled in by _tokens: it only has to match.
+                    if len(words) != 2:
+                        self._syntax_error("Don't understand block", token)
+                    ops_stack.append('block')
                 elif words[0].startswith('end'):
                     # Endsomething.  Pop the ops stack.
                     if len(words) != 1:  # endif or endfor
@@ -178,13 +734,17 @@ class Templite(object):
                     start_what = ops_stack.pop()
                     if start_what != end_what:  # 必须是if==if 或者 for==for
                         self._syntax_error("Mismatched end tag", end_what)
-                    code.dedent()  # 从句完成后，缩进 - 4
+                    if start_what == 'for' and not for_stack.pop()['empty']:
+                        self._finish_loop(self._loops.pop())
+                        checkpoints.append(code.add_section())
+                    if start_what != 'block':
+                        code.dedent()  # 从句完成后，缩进 - 4
                 else:
                     self._syntax_error("Don't understand tag", words[0])
             else:
                 # Literal content.  If it isn't empty, output it.
                 if token:  # 例如带<p><li>标签的文字内容，直接输出
-                    buffered.append(repr(token))  # repr为token加“”
+                    literal.append(token)  # 之后和相邻的文字一起repr
         if ops_stack:  # miss了一个end tag
             self._syntax_error("Unmatched action tag", ops_stack[-1])
         flush_output()
@@ -193,31 +753,345 @@ class Templite(object):
             # 在all而不在loop中的，即所有在模板类中用到的，而不是在模板类中定义的。见all_vars
             # 因为在模板中定义的，如product.name已经在翻译时(在循环中)定义过；其他的需要真正定义一次。
             vars_code.add_line("c_%s = context[%r]" % (var_name, var_name))  # 定义
+        if self._hoisted_count:
+            # What hoisted lookups hold until they're first needed.
+            vars_code.add_line("missing = object()")
 
-        code.add_line("return ''.join(result)")  # def render_function的return
+        footer = code.add_section()
         code.dedent()  # 针对def那个indent而有的dedent
 
-        self._render_function = code.get_globals()['render_function']
-        # run code and return a dict[render_function]
+        header.add_line("def render_function(context, do_dots):")
+        footer.add_line("return ''.join(result)")  # def render_function的return
+        render_source = str(code)
+
+        header.clear()
+        header.add_line("def stream_function(context, do_dots, flush_size):")
+        for checkpoint in checkpoints:
+            # At the end of each pass through a loop, hand over what's
+            # accumulated once it's big enough. Joining only every so many
+            # pieces keeps short passes from copying the chunk each time.
+            checkpoint.add_line("if len(result) >= %d:" % self.CHECK_PIECES)
+            checkpoint.indent()
+            checkpoint.add_line("chunk = ''.join(result)")
+            checkpoint.add_line("del result[:]")
+            checkpoint.add_line("if len(chunk) >= flush_size:")
+            checkpoint.indent()
+            checkpoint.add_line("yield chunk")
+            checkpoint.dedent()
+            checkpoint.add_line("else:")
+            checkpoint.indent()
+            checkpoint.add_line("append_result(chunk)")
+            checkpoint.dedent()
+            checkpoint.dedent()
+        footer.clear()
+        footer.add_line("if result:")
+        footer.indent()
+        footer.add_line("yield ''.join(result)")
+        footer.dedent()
+        stream_source = str(code)
+
+        return (
+            code.get_code(render_source + stream_source),
+            tuple(sorted(self.all_vars)), tuple(sorted(self.loop_vars)),
+            tuple(sorted(self.folded_vars)),
+            tuple(sorted(self._templates.items())),
+        )
+
+    def _start_loop(self, var, iterable, code):
+        """Start a loop over `iterable`, setting `var`, in `code`.
+
+        The for line itself is written by _finish_loop, once the body has
+        shown what it needs. Returns the loop's dict, which holds:
+
+        'var': the loop variable, and 'iterable': the code for its values.
+        'before': a section before the loop, for lookups hoisted out of it.
+        'hoisted': the names hoisted lookups are kept in, by their code.
+        'head': the section for the for line, and 'top': the first section
+        inside the loop.
+        'id': a number to name the loop's own variables by.
+        'counter': whether the body uses forloop, so needs a count.
+        'empty': whether there's an empty branch.
+
+        """
+        loop = {
+            'var': var, 'iterable': iterable, 'before': code.add_section(),
+            'hoisted': {}, 'head': code.add_section(), 'id': self._loop_count,
+            'counter': False, 'empty': False,
+        }
+        self._loop_count += 1
+        code.indent()  # for从句以下的内容，indent + 4
+        loop['top'] = code.add_section()
+        return loop
+
+    def _finish_loop(self, loop):
+        """Write the for line of `loop`, and what it needs.
+
+        Returns an expression that's true if the loop had nothing.
+
+        """
+        head = loop['head']
+        if loop['counter']:
+            counter = "i_%d" % loop['id']
+            if loop['empty']:
+                head.add_line("%s = 0" % counter)
+            head.add_line("for %s, c_%s in enumerate(%s, 1):" % (
+                counter, loop['var'], loop['iterable']))
+            return "not %s" % counter
+        flag = "e_%d" % loop['id']
+        if loop['empty']:
+            head.add_line("%s = True" % flag)
+            loop['top'].add_line("%s = False" % flag)
+        head.add_line("for c_%s in %s:" % (loop['var'], loop['iterable']))
+        return flag
+
+    def _tokens(self, text, including):
+        """Split `text` into tokens, with other templates put in where it
+        includes them, or it put into the one it extends.
+
+        `including` lists the templates we're already inside. Block tags are
+        left in, so that a template extending this one can find them.
+
+        """
+        tokens = []
+        parent = None
+        for token in re.split(r"(?s)({{.*?}}|{%.*?%}|{#.*?#})", text):
+            words = token[2:-2].split() if token.startswith('{%') else []
+            if words and words[0] == 'extends':
+                if parent or any(
+                        t.strip() and not t.startswith('{#') for t in tokens):
+                    self._syntax_error("Extends must come first", token)
+                parent = self._template_name(words, token)
+            elif words and words[0] == 'include':
+                tokens.extend(self._template_tokens(
+                    self._template_name(words, token), including))
+            else:
+                tokens.append(token)
+        if parent is None:
+            return tokens
+        blocks = self._blocks(tokens)
+        tokens = self._template_tokens(parent, including)
+        return self._override(tokens, blocks)
+
+    def _template_name(self, words, token):
+        """The quoted template name in an include or extends tag."""
+        if len(words) != 2 or len(words[1]) < 3 or \
+                words[1][0] not in "'\"" or words[1][-1] != words[1][0]:
+            self._syntax_error("Don't understand %s" % words[0], token)
+        return words[1][1:-1]
+
+    def _template_tokens(self, name, including):
+        """The tokens of template `name`, from the loader."""
+        if self.loader is None:
+            self._syntax_error("No loader to find template", name)
+        if name in including:
+            self._syntax_error("Template includes itself", name)
+        text, self._templates[name] = self.loader.get_source(name)
+        return self._tokens(text, including + [name])
+
+    def _block_tag(self, token):
+        """'block' and the block's name, or 'endblock' and None, or None."""
+        if not token.startswith('{%'):
+            return None
+        words = token[2:-2].split()
+        if words and words[0] == 'block':
+            if len(words) != 2:
+                self._syntax_error("Don't understand block", token)
+            return 'block', words[1]
+        if words == ['endblock']:
+            return 'endblock', None
+        return None
+
+    def _blocks(self, tokens):
+        """Map the name of each block in `tokens` to the tokens inside it."""
+        blocks = {}
+        started = []
+        for i, token in enumerate(tokens):
+            tag = self._block_tag(token)
+            if tag is None:
+                continue
+            if tag[0] == 'block':
+                if tag[1] in blocks or tag[1] in [b[0] for b in started]:
+                    self._syntax_error("Block defined twice", tag[1])
+                started.append((tag[1], i + 1))
+            else:
+                if not started:
+                    self._syntax_error("Too many ends", token)
+                name, start = started.pop()
+                blocks[name] = tokens[start:i]
+        if started:
+            self._syntax_error("Unmatched action tag", 'block')
+        return blocks
+
+    def _override(self, tokens, blocks):
+        """`tokens`, with the insides of blocks replaced from `blocks`."""
+        result = []
+        tokens = iter(tokens)
+        for token in tokens:
+            result.append(token)
+            tag = self._block_tag(token)
+            if tag and tag[0] == 'block' and tag[1] in blocks:
+                result.extend(blocks[tag[1]])
+                # Skip what was inside, up to the block's own end.
+                depth = 1
+                for token in tokens:
+                    tag = self._block_tag(token)
+                    if tag:
+                        depth += 1 if tag[0] == 'block' else -1
+                    if depth == 0:
+                        result.append(token)
+                        break
+        return result
+
+    def _fold(self, expr):
+        """Work out `expr` now, from the constructor contexts, if it can be.
+
+        Returns the value, or NOT_FOLDED if it has to wait for rendering.
+
+        """
+        if not self._fold_constants:
+            return NOT_FOLDED
+        pipes = expr.split("|")
+        dots = pipes[0].split(".")
+        if dots[0] == 'forloop' and self._loops:
+            return NOT_FOLDED
+        filters = [self._filter(pipe) for pipe in pipes[1:]]
+        names = [dots[0]] + [func for func, _ in filters]
+        looped = [loop['var'] for loop in self._loops]
+        for name in names:
+            if name in looped or name not in self.context:
+                return NOT_FOLDED
+        value = self.context[dots[0]]
+        if not type(value) in FOLDABLE_TYPES:
+            return NOT_FOLDED
+        if not all(func in self.pure_filters and _filter_name(self.context[func])
+                   for func in names[1:]):
+            return NOT_FOLDED
+        arg_values = []
+        for _, args in filters:
+            arg_values.append([self._literal(arg) for arg in args])
+            for i, arg in enumerate(args):
+                if arg_values[-1][i] is NOT_FOLDED:
+                    arg_values[-1][i] = self._fold(arg)
+                    if arg_values[-1][i] is NOT_FOLDED:
+                        return NOT_FOLDED
+        try:
+            value = self._do_dots(value, *dots[1:])
+            for (func, _), args in zip(filters, arg_values):
+                value = self.context[func](value, *args)
+        except Exception:
+            # Let it go wrong when rendering, as it would have.
+            return NOT_FOLDED
+        if not type(value) in FOLDABLE_TYPES:
+            return NOT_FOLDED
+        self.folded_vars.update(names)
+        return value
+
+    def _hoist(self, name, code):
+        """Evaluate `code`, a lookup on the variable `name`, only once for
+        all the passes of the loops it doesn't change in.
+
+        The value is worked out the first time it's needed, so that it
+        isn't looked up at all if it never would have been. Only lookups
+        that call nothing, by `types`, may be hoisted.
+
+        """
+        first = 0
+        for i, loop in enumerate(self._loops):
+            if loop['var'] == name:
+                first = i + 1
+        if first == len(self._loops):
+            return code
+        section = self._loops[first]['before']
+        hoisted = self._loops[first]['hoisted']
+        if code not in hoisted:
+            hoisted[code] = "h_%d" % self._hoisted_count
+            self._hoisted_count += 1
+            section.add_line("%s = missing" % hoisted[code])
+        var = hoisted[code]
+        return "(%s if %s is not missing else (%s := %s))" % (
+            var, var, var, code)
 
     def _expr_code(self, expr):
         """Generate a Python expression for `expr`."""
+        value = self._fold(expr)
+        if value is not NOT_FOLDED:
+            return repr(value)
         if "|" in expr:
             pipes = expr.split("|")
             code = self._expr_code(pipes[0])
-            for func in pipes[1:]:
+            for pipe in pipes[1:]:
+                func, args = self._filter(pipe)
                 self._variable(func, self.all_vars)
-                code = "c_%s(%s)" % (func, code)  # 将管道中的函数编程c_xxx,如c_lower(obj)
+                args = [code] + [self._arg_code(arg) for arg in args]
+                code = "c_%s(%s)" % (func, ", ".join(args))  # 将管道中的函数编程c_xxx,如c_lower(obj)
+        elif expr.startswith("forloop.") and self._loops:
+            # The innermost loop's count, from enumerate.
+            dots = expr.split(".")
+            loop = self._loops[-1]
+            loop['counter'] = True
+            counter = "i_%d" % loop['id']
+            if dots[1] == 'counter':
+                code = counter
+            elif dots[1] == 'counter0':
+                code = "(%s - 1)" % counter
+            elif dots[1] == 'first':
+                code = "(%s == 1)" % counter
+            else:
+                self._syntax_error("Don't understand forloop", expr)
+            if len(dots) > 2:
+                args = ", ".join(repr(d) for d in dots[2:])
+                code = "do_dots(%s, %s)" % (code, args)
         elif "." in expr:
             dots = expr.split(".")
             code = self._expr_code(dots[0])
-            args = ", ".join(repr(d) for d in dots[1:])
-            code = "do_dots(%s, %s)" % (code, args)  # 将html中的a.b编程python的a.b
+            kind = self.types.get(dots[0])
+            if kind is dict:
+                code = "%s[%r]" % (code, dots[1])
+                dots = dots[1:]
+            elif kind is object:
+                if not re.match(r"[_a-zA-Z][_a-zA-Z0-9]*$", dots[1]):
+                    self._syntax_error("Not a valid attribute", dots[1])
+                code = "%s.%s" % (code, dots[1])
+                dots = dots[1:]
+            if len(dots) > 1:
+                args = ", ".join(repr(d) for d in dots[1:])
+                code = "do_dots(%s, %s)" % (code, args)  # 将html中的a.b编程python的a.b
+            else:
+                # do_dots calls what it finds, which may give something new
+                # every time; only a declared-type lookup calls nothing.
+                code = self._hoist(expr.split(".")[0], code)
         else:
             self._variable(expr, self.all_vars)
             code = "c_%s" % expr
         return code
 
+    def _filter(self, pipe):
+        """Split `pipe`, like "func" or "func:arg,arg", into the filter's name
+        and a list of its arguments."""
+        func, colon, args = pipe.partition(":")
+        args = args.split(",") if colon else []
+        if not all(args):
+            self._syntax_error("Don't understand filter", pipe)
+        return func, args
+
+    def _literal(self, arg):
+        """The value of `arg` if it's a number or a quoted string, or
+        NOT_FOLDED."""
+        if re.match(r"-?[0-9]+$", arg):
+            return int(arg)
+        if re.match(r"-?[0-9]*\.[0-9]+$", arg):
+            return float(arg)
+        if len(arg) >= 2 and arg[0] in "'\"" and arg[-1] == arg[0]:
+            return arg[1:-1]
+        return NOT_FOLDED
+
+    def _arg_code(self, arg):
+        """Generate a Python expression for a filter's argument."""
+        value = self._literal(arg)
+        if value is not NOT_FOLDED:
+            return repr(value)
+        return self._expr_code(arg)
+
     def _syntax_error(self, msg, thing):
         """Raise a syntax error using `msg`, and showing `thing`."""
         raise TempliteSyntaxError("%s: %r" % (msg, thing))  # 这里的ERROR类就是pass
@@ -244,7 +1118,44 @@ class Templite(object):
         render_context = dict(self.context)   # self本来就是dict
         if context:
             render_context.update(context)
-        return self._render_function(render_context, self._do_dots)  # 这个self._render_function是html汇编成python的
+            if not self.folded_vars.isdisjoint(context):
+                return self._without_folding().render(context)
+        if self.render_hook is None:
+            return self._render_function(render_context, self._do_dots)
+        start = time.perf_counter()
+        result = self._render_function(render_context, self._do_dots)
+        self.render_hook(self, time.perf_counter() - start, len(result))
+        return result  # 这个self._render_function是html汇编成python的
+
+    def stream(self, context=None, flush_size=DEFAULT_FLUSH_SIZE):
+        """Render this template by applying it to `context`, a chunk at a
+        time.
+
+        Returns an iterator of strings that add up to what `render` returns.
+        Chunks are handed over at the end of a loop pass, once there are
+        `flush_size` characters or more to send, so that a long loop is
+        never held in memory all at once.
+
+        """
+        render_context = dict(self.context)
+        if context:
+            render_context.update(context)
+            if not self.folded_vars.isdisjoint(context):
+                return self._without_folding().stream(context, flush_size)
+        return self._stream_function(
+            render_context, self._do_dots, flush_size)
+
+    def _without_folding(self):
+        """This template compiled again with nothing folded in, for contexts
+        that replace folded values."""
+        if self._unfolded is None:
+            self._unfolded = Templite(
+                self._text, self.context, cache=self._cache, fold=False,
+                pure_filters=self.pure_filters,
+                types=self.types, loader=self.loader,
+                autoescape=self.autoescape, name=self.name,
+                render_hook=self.render_hook)
+        return self._unfolded
 
     def _do_dots(self, value, *dots):  # 传进渲染函数的第二个参数是_do_dots
         """Evaluate dotted expressions at runtime."""
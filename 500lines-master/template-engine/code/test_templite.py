@@ -1,7 +1,15 @@
 """Tests for templite."""
 
+import os
 import re
-from templite import Templite, TempliteSyntaxError
+import shutil
+import stat
+import tempfile
+import precompile
+import templite as templite_module
+from templite import (
+    CodeBundle, CodeCache, Loader, Markup, RenderStats, Templite,
+    TempliteSyntaxError, escape_html)
 from unittest import TestCase
 
 # pylint: disable=W0612,E1101
@@ -273,3 +281,428 @@ class TempliteTest(TestCase):
             self.try_render("{% if x %}X{% end if %}")
         with self.assertSynErr("Don't understand end: '{% endif now %}'"):
             self.try_render("{% if x %}X{% endif now %}")
+
+    def test_stream(self):
+        text = "<ul>{% for n in nums %}<li>{{n}}</li>{% endfor %}</ul>"
+        nums = list(range(1000))
+        templite = Templite(text)
+        expected = templite.render({'nums': nums})
+        self.assertEqual("".join(templite.stream({'nums': nums})), expected)
+        chunks = list(templite.stream({'nums': nums}, flush_size=1000))
+        self.assertEqual("".join(chunks), expected)
+        self.assertGreater(len(chunks), 5)
+        self.assertTrue(all(len(c) >= 1000 for c in chunks[:-1]))
+        self.assertEqual(list(Templite("Hello").stream()), ["Hello"])
+        self.assertEqual(list(Templite("").stream()), [])
+
+    def test_stream_is_lazy(self):
+        def numbers():
+            for n in range(100):
+                yield n
+            raise RuntimeError("Read too far")
+        chunks = Templite(
+            "{% for n in nums %}{% for m in nums2 %}{{m}}{% endfor %}"
+            "{% endfor %}"
+            ).stream({'nums': numbers(), 'nums2': range(10)}, flush_size=10)
+        # The first chunk comes out long before the loop gets to the end.
+        self.assertTrue(next(chunks).startswith("0123456789" * 3))
+
+    def test_folding(self):
+        # Constant values from the constructor are compiled in.
+        templite = Templite(
+            "{{site|upper}}: {{site.lower}} {{name}}", {'site': "Home"},
+            {'upper': str.upper}, pure_filters={'upper'}, cache=None)
+        self.assertEqual(templite.folded_vars, {'site', 'upper'})
+        self.assertEqual(templite.all_vars, {'name'})
+        self.assertEqual(templite.render({'name': "Ned"}), "HOME: home Ned")
+        # Lambdas might be anything, so aren't called until rendering.
+        templite = Templite(
+            "{{site|shout}}", {'site': "Home", 'shout': lambda s: s + "!"},
+            pure_filters={'shout'}, cache=None)
+        self.assertEqual(templite.folded_vars, {'site'})
+        self.assertEqual(templite.render(), "Home!")
+
+    def test_filters_are_not_folded_unless_pure(self):
+        os.environ['TEMPLITE_TEST'] = "before"
+        self.addCleanup(os.environ.pop, 'TEMPLITE_TEST')
+        text = "{{var|getenv}}"
+        context = {'var': 'TEMPLITE_TEST', 'getenv': os.getenv}
+        templite = Templite(text, context)
+        self.assertEqual(templite.folded_vars, {'var'})
+        self.assertEqual(templite.render(), "before")
+        os.environ['TEMPLITE_TEST'] = "after"
+        self.assertEqual(templite.render(), "after")
+        # Not even when built again from the same cached code.
+        self.assertEqual(Templite(text, context).render(), "after")
+        # Declared pure, it's worked out once.
+        templite = Templite(text, context, pure_filters={'getenv'})
+        self.assertEqual(templite.folded_vars, {'var', 'getenv'})
+        os.environ['TEMPLITE_TEST'] = "later"
+        self.assertEqual(templite.render(), "after")
+
+    def test_folded_values_can_be_replaced(self):
+        templite = Templite(
+            "{% if debug %}debug {% endif %}{{title}}",
+            {'debug': False, 'title': "Home"})
+        self.assertEqual(templite.render(), "Home")
+        self.assertEqual(templite.render({'debug': True}), "debug Home")
+        self.assertEqual(
+            "".join(templite.stream({'title': "Away"})), "Away")
+        self.assertEqual(
+            Templite("{{x}}", {'x': 1}, fold=False).folded_vars, set())
+
+    def test_forloop(self):
+        self.try_render(
+            "{% for n in nums %}{% if forloop.first %}[{% endif %}"
+            "{{forloop.counter}}:{{n}} "
+            "{% for m in nums %}{{forloop.counter0}}{% endfor %} "
+            "{% endfor %}",
+            {'nums': "ab"},
+            "[1:a 01 2:b 01 "
+            )
+        with self.assertSynErr("Don't understand forloop: 'forloop.last'"):
+            Templite("{% for n in nums %}{{forloop.last}}{% endfor %}")
+
+    def test_empty(self):
+        for text, result in [
+                ("{% for n in nums %}{{n}}{% empty %}None{% endfor %}", "ab"),
+                ("{% for n in nums %}{{forloop.counter}}{{n}}"
+                 "{% empty %}None{% endfor %}", "1a2b"),
+        ]:
+            templite = Templite(text)
+            self.assertEqual(templite.render({'nums': []}), "None")
+            self.assertEqual(templite.render({'nums': iter("ab")}), result)
+        with self.assertSynErr("Empty outside a for: '{% empty %}'"):
+            Templite("{% if x %}{% empty %}{% endif %}")
+        with self.assertSynErr("Empty outside a for: '{% empty %}'"):
+            Templite("{% for n in nums %}{% empty %}{% empty %}{% endfor %}")
+
+    def test_filter_arguments(self):
+        def cut(text, length, end="..."):
+            return text[:length] + end if len(text) > length else text
+        self.try_render(
+            "{{text|cut:5}} {{text|cut:3,'!'}} {{text|cut:size,end.mark}} "
+            "{% for w in words|cut:2,'' %}{{w}}{% endfor %}",
+            {'text': "Templite", 'cut': cut, 'size': 4,
+             'end': {'mark': '~'}, 'words': "abc"},
+            "Templ... Tem! Temp~ ab"
+            )
+        # Constant arguments fold too.
+        templite = Templite("{{pi|round:2}}", {'pi': 3.14159, 'round': round},
+                            pure_filters={'round'})
+        self.assertEqual(templite.folded_vars, {'pi', 'round'})
+        self.assertEqual(templite.render(), "3.14")
+        with self.assertSynErr("Don't understand filter: 'cut:'"):
+            Templite("{{text|cut:}}")
+
+    def test_hoisting(self):
+        class Counter(object):
+            def __init__(self):
+                self.count = 0
+            def tick(self):
+                self.count += 1
+                return self.count
+        # A lookup that might call something is made on every pass.
+        self.try_render(
+            "{% for n in nums %}{{o.tick}} {% endfor %}",
+            {'o': Counter(), 'nums': [1, 2, 3]},
+            "1 2 3 "
+            )
+        # A declared-type lookup that doesn't change in a loop is made once.
+        class CountingDict(dict):
+            count = 0
+            def __getitem__(self, key):
+                self.count += 1
+                return dict.__getitem__(self, key)
+        d = CountingDict(name="d")
+        templite = Templite(
+            "{% for n in nums %}{{d.name}}{{n}}"
+            "{% for m in nums %}{{n.real}}{{d.name}}{% endfor %}"
+            "{% endfor %}",
+            types={'d': dict})
+        self.assertEqual(templite.render({'d': d, 'nums': [1, 2]}),
+                         "d11d1dd22d2d")
+        self.assertEqual(d.count, 1)
+        # A lookup that's never reached isn't made.
+        self.assertEqual(
+            Templite(
+                "{% for n in nums %}{% if obj %}{{obj.name}}{% endif %}"
+                "{% endfor %}", types={'obj': object}
+                ).render({'obj': None, 'nums': [1, 2]}),
+            "")
+
+    def test_declared_types(self):
+        class Thing(object):
+            name = "thing"
+            def items(self):
+                return "items"
+        # Declared a dict, d.items is d['items'], not d.items().
+        templite = Templite(
+            "{{d.items}} {{t.name}} {{d.sub.name}}",
+            types={'d': dict, 't': object})
+        self.assertEqual(
+            templite.render({'d': {'items': 1, 'sub': {'name': 'sub'}},
+                             't': Thing()}),
+            "1 thing sub")
+        with self.assertSynErr("Not a valid attribute: '0'"):
+            Templite("{{t.0}}", types={'t': object})
+        with self.assertRaises(ValueError):
+            Templite("{{t}}", types={'t': list})
+
+
+class CodeCacheTest(TestCase):
+    """Tests for caching compiled templates."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def test_compiles_once(self):
+        cache = CodeCache()
+        text = "{% for n in nums %}{{n|str}}{% endfor %}"
+        first = Templite(text, {'str': str}, cache=cache)
+        second = Templite(text, {'str': str}, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(second.render({'nums': [1, 2]}), "12")
+        self.assertEqual(second.all_vars, first.all_vars)
+        self.assertEqual(second.loop_vars, {'n'})
+        # Different context names make a different entry.
+        Templite(text, {'str': str, 'other': 1}, cache=cache)
+        self.assertEqual(cache.misses, 2)
+        # So do different values that are folded in.
+        text = "{{greeting}}"
+        self.assertEqual(
+            Templite(text, {'greeting': "Hi"}, cache=cache).render(), "Hi")
+        self.assertEqual(
+            Templite(text, {'greeting': "Yo"}, cache=cache).render(), "Yo")
+
+    def test_disk_cache(self):
+        text = "Hello, {{name}}!"
+        Templite(text, cache=CodeCache(self.temp_dir))
+        self.assertEqual(len(os.listdir(self.temp_dir)), 1)
+        # A fresh cache, as in a new process, reads it from the disk.
+        cache = CodeCache(self.temp_dir)
+        templite = Templite(text, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(templite.render({'name': 'Ned'}), "Hello, Ned!")
+
+    def test_damaged_disk_cache(self):
+        text = "Hello, {{name}}!"
+        cache = CodeCache(self.temp_dir)
+        path = os.path.join(self.temp_dir, cache.key(text, {}) + ".tpc")
+        with open(path, "wb") as f:
+            f.write(b"junk")
+        templite = Templite(text, cache=cache)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(templite.render({'name': 'Ned'}), "Hello, Ned!")
+
+    def test_bounded(self):
+        cache = CodeCache(max_entries=2)
+        for i in range(3):
+            Templite("%d" % i, cache=cache)
+        Templite("0", cache=cache)
+        self.assertEqual(cache.misses, 4)
+
+    def test_no_cache(self):
+        self.assertEqual(Templite("{{x}}", cache=None).render({'x': 1}), "1")
+
+
+class LoaderTest(TestCase):
+    """Tests for include and extends."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.loader = Loader(self.temp_dir, cache=CodeCache())
+
+    def write(self, name, text):
+        with open(os.path.join(self.temp_dir, name), "w") as f:
+            f.write(text)
+
+    def assertSynErr(self, msg):
+        pat = "^" + re.escape(msg) + "$"
+        return self.assertRaisesRegex(TempliteSyntaxError, pat)
+
+    def test_include(self):
+        self.write("item.html", "<li>{{n}}</li>")
+        self.write("list.html",
+                   "<ul>{% for n in nums %}{% include 'item.html' %}"
+                   "{% endfor %}</ul>")
+        templite = self.loader.load("list.html")
+        self.assertEqual(
+            templite.render({'nums': [1, 2]}), "<ul><li>1</li><li>2</li></ul>")
+
+    def test_extends(self):
+        self.write("base.html",
+                   "<title>{% block title %}Site{% endblock %}</title>"
+                   "{% block body %}<p>{% block text %}{% endblock %}</p>"
+                   "{% endblock %}")
+        self.write("page.html",
+                   "{# A page #}\n{% extends 'base.html' %}"
+                   "Ignored{% block text %}Hi {{name}}{% endblock %}")
+        self.write("other.html",
+                   "{% extends 'page.html' %}"
+                   "{% block title %}Other{% endblock %}")
+        self.assertEqual(
+            self.loader.load("page.html").render({'name': "Ned"}),
+            "<title>Site</title><p>Hi Ned</p>")
+        self.assertEqual(
+            self.loader.load("other.html").render({'name': "Ned"}),
+            "<title>Other</title><p>Hi Ned</p>")
+
+    def test_changed_templates_are_recompiled(self):
+        self.write("part.html", "one")
+        self.write("whole.html", "{% include 'part.html' %}")
+        self.assertEqual(self.loader.load("whole.html").render(), "one")
+        self.assertEqual(self.loader.load("whole.html").render(), "one")
+        self.write("part.html", "two!")
+        self.assertEqual(self.loader.load("whole.html").render(), "two!")
+
+    def test_errors(self):
+        with self.assertSynErr("No loader to find template: 'x.html'"):
+            Templite("{% include 'x.html' %}")
+        with self.assertSynErr("Can't find template: 'x.html'"):
+            Templite("{% include 'x.html' %}", loader=self.loader)
+        with self.assertSynErr("Don't understand include: '{% include x %}'"):
+            Templite("{% include x %}", loader=self.loader)
+        self.write("loop.html", "{% include 'loop.html' %}")
+        with self.assertSynErr("Template includes itself: 'loop.html'"):
+            self.loader.load("loop.html")
+        self.write("base.html", "{% block a %}{% endblock %}")
+        with self.assertSynErr(
+                "Extends must come first: \"{% extends 'base.html' %}\""):
+            Templite("Hi{% extends 'base.html' %}", loader=self.loader)
+        with self.assertSynErr("Block defined twice: 'a'"):
+            Templite("{% extends 'base.html' %}{% block a %}{% endblock %}"
+                     "{% block a %}{% endblock %}", loader=self.loader)
+        with self.assertSynErr("Mismatched end tag: 'if'"):
+            Templite("{% block a %}{% endif %}")
+        with self.assertSynErr("Template outside the loader: '../x.html'"):
+            self.loader.load("../x.html")
+
+
+class AutoescapeTest(TestCase):
+    """Tests for autoescaping."""
+
+    def test_escaping(self):
+        templite = Templite(
+            "<p>{{text}}</p>{{n}}", autoescape=True, cache=None)
+        self.assertEqual(
+            templite.render({'text': "<b>\"Tom\" & 'Jerry'</b>", 'n': 3}),
+            "<p>&lt;b&gt;&#34;Tom&#34; &amp; &#39;Jerry&#39;&lt;/b&gt;</p>3")
+        # Without autoescape, nothing changes.
+        self.assertEqual(Templite("{{x}}").render({'x': "<"}), "<")
+
+    def test_safe_values(self):
+        templite = Templite(
+            "{{html|safe}} {{html|bold}} {{html}}",
+            {'bold': lambda s: Markup("<b>%s</b>" % s)}, autoescape=True)
+        self.assertEqual(
+            templite.render({'html': "<i>"}),
+            "<i> <b><i></b> &lt;i&gt;")
+        self.assertEqual(
+            templite.render({'html': Markup("<i>")}), "<i> <b><i></b> <i>")
+
+    def test_folded_values_are_escaped_once(self):
+        templite = Templite(
+            "{{title}} {{title|safe}}", {'title': "R&D"}, autoescape=True)
+        self.assertEqual(templite.folded_vars, {'title'})
+        self.assertEqual(templite.render(), "R&amp;D R&D")
+        self.assertEqual(escape_html(Markup("<i>")), "<i>")
+
+
+class RenderHookTest(TestCase):
+    """Tests for timing renders."""
+
+    def test_render_hook(self):
+        calls = []
+        templite = Templite(
+            "{{x}}!", name="bang",
+            render_hook=lambda *args: calls.append(args))
+        self.assertEqual(templite.render({'x': "Hi"}), "Hi!")
+        [(hooked, seconds, length)] = calls
+        self.assertIs(hooked, templite)
+        self.assertGreaterEqual(seconds, 0)
+        self.assertEqual(length, 3)
+
+    def test_render_stats(self):
+        stats = RenderStats()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        with open(os.path.join(temp_dir, "page.html"), "w") as f:
+            f.write("{{greeting}}, {{name}}")
+        loader = Loader(temp_dir, render_hook=stats)
+        templite = loader.load("page.html", {'greeting': "Hello"})
+        templite.render({'name': "Ned"})
+        # Replacing a folded value still counts once.
+        templite.render({'name': "Ned", 'greeting': "Hi"})
+        Templite("{{n}}", render_hook=stats).render({'n': 12})
+        # Declaring types doesn't change the name renders are filed under.
+        Templite("{{user.name}}", types={'user': dict}, name="page.html",
+                 render_hook=stats).render({'user': {'name': "Ned"}})
+        snapshot = stats.snapshot()
+        self.assertEqual(set(snapshot), {None, "page.html"})
+        self.assertEqual(snapshot["page.html"]["renders"], 3)
+        self.assertEqual(snapshot["page.html"]["characters"], 20)
+        self.assertEqual(snapshot[None]["characters"], 2)
+
+
+class PrecompileTest(TestCase):
+    """Tests for bundles of precompiled templates."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        os.mkdir(os.path.join(self.temp_dir, "parts"))
+        for name, text in [
+                ("page.html", "{% include 'parts/item.html' %}!"),
+                ("parts/item.html", "<i>{{name}}</i>"),
+                ("notes.txt", "{% if %}"),
+        ]:
+            with open(os.path.join(self.temp_dir, name), "w") as f:
+                f.write(text)
+
+    def test_bundle(self):
+        cache = CodeCache()
+        Templite("{{a}}", cache=cache)
+        Templite("{{b}}", cache=cache)
+        path = os.path.join(self.temp_dir, "test.tpb")
+        CodeBundle.write(path, cache.entries())
+        self.assertEqual(len(CodeBundle(path)), 2)
+        cache = CodeCache()
+        self.assertTrue(cache.add_bundle(path))
+        self.assertEqual(Templite("{{b}}", cache=cache).render({'b': 2}), "2")
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        # A file that isn't a bundle is left out.
+        self.assertFalse(cache.add_bundle(os.path.join(self.temp_dir,
+                                                       "notes.txt")))
+
+    def test_files_honour_umask(self):
+        # Not private to whoever compiled them, as mkstemp's files are.
+        expected = 0o666 & ~templite_module._UMASK
+        cache_dir = os.path.join(self.temp_dir, "cache")
+        cache = CodeCache(cache_dir)
+        Templite("{{a}}", cache=cache)
+        path = os.path.join(self.temp_dir, "test.tpb")
+        CodeBundle.write(path, cache.entries())
+        for name in [path] + [
+                os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]:
+            self.assertEqual(stat.S_IMODE(os.stat(name).st_mode), expected)
+
+    def test_precompile(self):
+        errors = precompile.precompile(self.temp_dir, jobs=2)
+        self.assertEqual(errors, {})
+        bundle = CodeBundle(os.path.join(self.temp_dir, Loader.BUNDLE_NAME))
+        self.assertEqual(len(bundle), 2)
+        # A Loader finds the bundle, and needn't compile anything.
+        cache = CodeCache()
+        loader = Loader(self.temp_dir, cache=cache)
+        templite = loader.load("page.html")
+        self.assertEqual(templite.render({'name': "Ned"}), "<i>Ned</i>!")
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_syntax_errors(self):
+        errors = precompile.precompile(
+            self.temp_dir, pattern="*.txt", jobs=1)
+        self.assertEqual(
+            errors, {'notes.txt': "Don't understand if: '{% if %}'"})